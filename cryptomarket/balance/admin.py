@@ -1,4 +1,31 @@
 from django.contrib import admin
-from .models import Balance
+from .models import Balance, LedgerEntry, LedgerCheckpoint
+
+
+class ReadOnlyAdmin(admin.ModelAdmin):
+    """Журнал только дополняется кодом balance.services - в админке его можно лишь просматривать"""
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class LedgerEntryAdmin(ReadOnlyAdmin):
+    list_display = ("id", "user_id", "ticker", "kind", "amount", "reserved", "timestamp")
+    list_filter = ("kind", "ticker")
+    search_fields = ("user__id",)
+
+
+class LedgerCheckpointAdmin(ReadOnlyAdmin):
+    list_display = ("id", "user_id", "ticker", "entry_id", "amount", "reserved", "timestamp")
+    list_filter = ("ticker",)
+
 
 admin.site.register(Balance)
+admin.site.register(LedgerEntry, LedgerEntryAdmin)
+admin.site.register(LedgerCheckpoint, LedgerCheckpointAdmin)
@@ -0,0 +1,182 @@
+"""
+Журнал движений по балансам и контрольные точки.
+
+Каждое изменение баланса в balance.services в той же транзакции добавляет запись
+LedgerEntry: вид движения (сделка, пополнение, вывод, резерв, снятие резерва, списание
+при удалении пользователя) и изменения amount/reserved. Записи только добавляются, поэтому баланс счета на любой момент - сумма
+его движений до этого момента.
+
+Чтобы не суммировать всю историю, checkpoint() (команда ledger_checkpoint, запускается
+периодически, например из cron) сохраняет в LedgerCheckpoint балансы счетов, по которым
+были движения после прошлого прохода: новая точка = предыдущая точка счета + движения
+после нее. Баланс на момент и сверка читают последнюю точку и только движения после нее.
+"""
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from django.db import transaction
+from django.db.models import Max, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
+
+from .models import LedgerCheckpoint, LedgerEntry
+
+# Сколько контрольных точек записывать одним INSERT
+CHECKPOINT_CHUNK = 1000
+
+# (user_id, ticker, изменение amount, изменение reserved)
+Movement = Tuple[object, str, int, int]
+
+
+def record(kind: str, movements: Iterable[Movement]):
+    """Добавляет движения одного вида одним INSERT (вызывается внутри транзакции изменения баланса)"""
+    now = timezone.now()
+    entries = [
+        LedgerEntry(user_id=user_id, ticker=ticker, kind=kind, amount=amount, reserved=reserved, timestamp=now)
+        for user_id, ticker, amount, reserved in movements
+        if amount or reserved
+    ]
+    if entries:
+        LedgerEntry.objects.bulk_create(entries)
+
+
+def checkpoint() -> dict:
+    """
+    Контрольные точки для всех счетов с движениями после прошлого прохода.
+    Проход идет в одной транзакции (в SQLite - IMMEDIATE, записи балансов ждут ее),
+    поэтому все движения до водяного знака уже закоммичены и ни одно не потеряется.
+    Возвращает {'entry_id': водяной знак - id последнего учтенного движения, 'accounts': число новых точек}
+    """
+    with transaction.atomic():
+        last = LedgerCheckpoint.objects.aggregate(entry_id=Max('entry_id'))['entry_id'] or 0
+        watermark = LedgerEntry.objects.aggregate(entry_id=Max('id'))['entry_id'] or 0
+        if watermark <= last:
+            return {'entry_id': last, 'accounts': 0}
+
+        previous = (
+            LedgerCheckpoint.objects
+            .filter(user_id=OuterRef('user_id'), ticker=OuterRef('ticker'))
+            .order_by('-entry_id')
+        )
+        accounts = (
+            LedgerEntry.objects
+            .filter(id__gt=last, id__lte=watermark)
+            .values('user_id', 'ticker')
+            .annotate(
+                amount_delta=Sum('amount'),
+                reserved_delta=Sum('reserved'),
+                amount_before=Subquery(previous.values('amount')[:1]),
+                reserved_before=Subquery(previous.values('reserved')[:1]),
+            )
+            .order_by()
+        )
+
+        now = timezone.now()
+        created = 0
+        chunk = []
+        for account in accounts.iterator(chunk_size=CHECKPOINT_CHUNK):
+            chunk.append(LedgerCheckpoint(
+                user_id=account['user_id'],
+                ticker=account['ticker'],
+                entry_id=watermark,
+                amount=(account['amount_before'] or 0) + account['amount_delta'],
+                reserved=(account['reserved_before'] or 0) + account['reserved_delta'],
+                timestamp=now,
+            ))
+            if len(chunk) >= CHECKPOINT_CHUNK:
+                LedgerCheckpoint.objects.bulk_create(chunk)
+                created += len(chunk)
+                chunk = []
+        if chunk:
+            LedgerCheckpoint.objects.bulk_create(chunk)
+            created += len(chunk)
+    return {'entry_id': watermark, 'accounts': created}
+
+
+def account_balances(accounts: Sequence[Tuple[object, str]]) -> Dict[Tuple[object, str], Tuple[int, int]]:
+    """
+    Балансы счетов по журналу: {(user_id, ticker): (amount, reserved)}.
+    Для каждого счета берется последняя контрольная точка и движения после нее;
+    счета передаются пачкой (до сотен) - три запроса на всю пачку
+    """
+    accounts = set(accounts)
+    if not accounts:
+        return {}
+    latest = (
+        LedgerCheckpoint.objects
+        .filter(user_id__in={user_id for user_id, _ in accounts})
+        .values_list('user_id', 'ticker')
+        .annotate(entry_id=Max('entry_id'))
+        .order_by()
+    )
+    points = {(user_id, ticker): entry_id for user_id, ticker, entry_id in latest if (user_id, ticker) in accounts}
+
+    # Условия группируются по (ticker, точка): у счетов, затронутых одним проходом checkpoint(),
+    # точка общая, поэтому условий немного при любом числе счетов
+    by_point = defaultdict(list)
+    for user_id, ticker in accounts:
+        by_point[(ticker, points.get((user_id, ticker), 0))].append(user_id)
+
+    balances: Dict[Tuple[object, str], Tuple[int, int]] = {}
+    if points:
+        condition = Q()
+        for (ticker, entry_id), user_ids in by_point.items():
+            if entry_id:
+                condition |= Q(user_id__in=user_ids, ticker=ticker, entry_id=entry_id)
+        rows = LedgerCheckpoint.objects.filter(condition).values_list('user_id', 'ticker', 'amount', 'reserved')
+        balances = {(user_id, ticker): (amount, reserved) for user_id, ticker, amount, reserved in rows}
+
+    after_points = Q()
+    for (ticker, entry_id), user_ids in by_point.items():
+        after_points |= Q(user_id__in=user_ids, ticker=ticker, id__gt=entry_id)
+    deltas = (
+        LedgerEntry.objects
+        .filter(after_points)
+        .values_list('user_id', 'ticker')
+        .annotate(amount=Sum('amount'), reserved=Sum('reserved'))
+        .order_by()
+    )
+    for user_id, ticker, amount, reserved in deltas:
+        before_amount, before_reserved = balances.get((user_id, ticker), (0, 0))
+        balances[(user_id, ticker)] = (before_amount + amount, before_reserved + reserved)
+    return balances
+
+
+def balances_at(user_id, at: Optional[datetime] = None) -> Dict[str, Tuple[int, int]]:
+    """
+    Балансы пользователя на момент at (по умолчанию - сейчас): {ticker: (amount, reserved)}.
+    Для каждого счета берется последняя контрольная точка не позже at и движения после нее
+    """
+    at = at or timezone.now()
+    latest = (
+        LedgerCheckpoint.objects
+        .filter(user_id=user_id, timestamp__lte=at)
+        .values('ticker')
+        .annotate(entry_id=Max('entry_id'))
+        .order_by()
+    )
+    points = {row['ticker']: row['entry_id'] for row in latest}
+
+    balances: Dict[str, Tuple[int, int]] = {}
+    if points:
+        condition = Q()
+        for ticker, entry_id in points.items():
+            condition |= Q(ticker=ticker, entry_id=entry_id)
+        rows = LedgerCheckpoint.objects.filter(condition, user_id=user_id).values_list('ticker', 'amount', 'reserved')
+        balances = {ticker: (amount, reserved) for ticker, amount, reserved in rows}
+
+    # Движения после точки счета; счета без точки суммируются с начала истории
+    after_points = ~Q(ticker__in=list(points))
+    for ticker, entry_id in points.items():
+        after_points |= Q(ticker=ticker, id__gt=entry_id)
+    deltas = (
+        LedgerEntry.objects
+        .filter(after_points, user_id=user_id, timestamp__lte=at)
+        .values('ticker')
+        .annotate(amount=Sum('amount'), reserved=Sum('reserved'))
+        .order_by()
+    )
+    for row in deltas:
+        amount, reserved = balances.get(row['ticker'], (0, 0))
+        balances[row['ticker']] = (amount + row['amount'], reserved + row['reserved'])
+    return balances
@@ -0,0 +1,102 @@
+import csv
+import json
+import uuid
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+
+from balance import services as balance_services
+
+# Сколько строк файла читать и проводить за раз
+READ_CHUNK = 5000
+
+
+class Command(BaseCommand):
+    help = (
+        "Пакетное пополнение (или вывод с --withdraw) балансов из файла CSV "
+        "(заголовок user_id,ticker,amount) или NDJSON. Файл читается частями, "
+        "строки проводятся пачками по одной транзакции; итог и ошибки по строкам - JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Файл со строками user_id, ticker, amount")
+        parser.add_argument('--format', choices=['csv', 'ndjson'], help="По умолчанию - по расширению файла")
+        parser.add_argument('--withdraw', action='store_true', help="Списать вместо зачисления")
+        parser.add_argument('--output', help="Файл для JSON-отчета (по умолчанию stdout)")
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        if not path.exists():
+            raise CommandError(f"File not found: {path}")
+        file_format = options['format'] or ('ndjson' if path.suffix in ('.ndjson', '.jsonl') else 'csv')
+
+        report = {'processed': 0, 'succeeded': 0, 'failed': []}
+        with open(path, newline='') as f:
+            records = self._read_csv(f) if file_format == 'csv' else self._read_ndjson(f)
+            chunk: List[Tuple[int, tuple]] = []
+            for line, row, error in records:
+                report['processed'] += 1
+                if error is not None:
+                    report['failed'].append({'line': line, 'detail': error})
+                    continue
+                chunk.append((line, row))
+                if len(chunk) >= READ_CHUNK:
+                    self._apply(chunk, options['withdraw'], report)
+                    chunk = []
+            if chunk:
+                self._apply(chunk, options['withdraw'], report)
+
+        report['failed'].sort(key=lambda failure: failure['line'])
+        report['succeeded'] = report['processed'] - len(report['failed'])
+        self.stderr.write(
+            f"{'Withdrawn' if options['withdraw'] else 'Deposited'}: "
+            f"{report['succeeded']} of {report['processed']} rows, {len(report['failed'])} failed"
+        )
+
+        payload = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(payload)
+            self.stderr.write(f"Report written to {options['output']}")
+        else:
+            self.stdout.write(payload)
+
+    @staticmethod
+    def _apply(chunk: List[Tuple[int, tuple]], withdraw: bool, report: dict):
+        errors = balance_services.transfer_many([row for _, row in chunk], withdraw=withdraw)
+        for index, detail in errors.items():
+            report['failed'].append({'line': chunk[index][0], 'detail': detail})
+
+    @staticmethod
+    def _parse(user_id, ticker, amount) -> tuple:
+        """Та же проверка, что у DepositWithdrawSerializer"""
+        amount = int(amount)
+        if amount < 1:
+            raise ValueError("amount must be positive")
+        if not ticker:
+            raise ValueError("ticker is required")
+        return uuid.UUID(str(user_id)), str(ticker), amount
+
+    def _read_csv(self, f) -> Iterator[Tuple[int, tuple, str]]:
+        reader = csv.DictReader(f)
+        missing = {'user_id', 'ticker', 'amount'} - set(reader.fieldnames or [])
+        if missing:
+            raise CommandError(f"CSV header must contain user_id, ticker, amount (missing: {', '.join(sorted(missing))})")
+        for record in reader:
+            # Строка 1 - заголовок
+            line = reader.line_num
+            try:
+                yield line, self._parse(record['user_id'], record['ticker'], record['amount']), None
+            except (TypeError, ValueError) as e:
+                yield line, None, str(e)
+
+    def _read_ndjson(self, f) -> Iterator[Tuple[int, tuple, str]]:
+        for line, text in enumerate(f, 1):
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text)
+                yield line, self._parse(record['user_id'], record['ticker'], record['amount']), None
+            except (TypeError, ValueError, KeyError) as e:
+                yield line, None, f"Invalid row: {e}"
@@ -0,0 +1,31 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from balance import ledger
+
+
+class Command(BaseCommand):
+    help = (
+        "Контрольные точки журнала движений: балансы счетов, по которым были движения "
+        "после прошлого прохода. Запускается периодически (например, из cron); итог - JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help="Файл для JSON-отчета (по умолчанию stdout)")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        report = {'timestamp': timezone.now().isoformat(), **ledger.checkpoint()}
+        report['seconds'] = round(time.perf_counter() - started, 3)
+        self.stderr.write(f"Checkpointed {report['accounts']} accounts up to entry {report['entry_id']}")
+
+        payload = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(payload)
+            self.stderr.write(f"Report written to {options['output']}")
+        else:
+            self.stdout.write(payload)
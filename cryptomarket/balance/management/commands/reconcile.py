@@ -0,0 +1,79 @@
+import json
+import os
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from balance import ledger, reconciliation
+
+
+class Command(BaseCommand):
+    help = (
+        "Сверка инвариантов: балансы не отрицательны, filled <= qty, балансы счетов и суммы "
+        "по тикерам совпадают с журналом движений. С --state итоги журнала досчитываются "
+        "от водяного знака прошлой успешной сверки. Итог - JSON; при нарушениях код возврата 1"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--state', help="Файл с водяным знаком и итогами журнала (читается и обновляется)")
+        parser.add_argument('--full', action='store_true', help="Пересчитать журнал с начала, не читая --state")
+        parser.add_argument('--checkpoint', action='store_true',
+                            help="Сначала записать контрольные точки журнала (как ledger_checkpoint)")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Размер порции при потоковом чтении")
+        parser.add_argument('--sample', type=int, default=20, help="Сколько нарушений каждой проверки выводить")
+        parser.add_argument('--output', help="Файл для JSON-отчета (по умолчанию stdout)")
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be positive")
+
+        state_path = Path(options['state']) if options['state'] else None
+        state = {}
+        if state_path and state_path.exists() and not options['full']:
+            with open(state_path) as f:
+                state = json.load(f)
+
+        started = time.perf_counter()
+        report = {
+            'timestamp': timezone.now().isoformat(),
+            'mode': 'incremental' if state else 'full',
+        }
+        if options['checkpoint']:
+            report['checkpoint'] = ledger.checkpoint()
+        result, totals = reconciliation.reconcile(
+            state.get('totals'), state.get('entry_id', 0),
+            chunk_size=options['chunk_size'], sample_size=options['sample'],
+        )
+        report.update(result)
+        report['seconds'] = round(time.perf_counter() - started, 3)
+
+        failed_tickers = [ticker for ticker, totals_report in report['tickers'].items() if not totals_report['ok']]
+        self.stderr.write(
+            f"{'OK' if report['ok'] else 'FAILED'}: "
+            f"balances {report['balances']['violations']}, "
+            f"orders {sum(orders['violations'] for orders in report['orders'].values())}, "
+            f"accounts {report['accounts']['violations']} of {report['accounts']['checked']}, "
+            f"tickers {len(failed_tickers)} of {len(report['tickers'])} violations; "
+            f"ledger {report['from_entry_id']}..{report['entry_id']}"
+        )
+
+        # Водяной знак двигается только после успешной сверки
+        if state_path and report['ok']:
+            tmp_path = state_path.with_name(state_path.name + '.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump({'timestamp': report['timestamp'], 'entry_id': report['entry_id'], 'totals': totals}, f)
+            os.replace(tmp_path, state_path)
+
+        payload = json.dumps(report, indent=2, ensure_ascii=False, cls=DjangoJSONEncoder)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(payload)
+            self.stderr.write(f"Report written to {options['output']}")
+        else:
+            self.stdout.write(payload)
+
+        if not report['ok']:
+            raise CommandError(f"Reconciliation failed (tickers: {', '.join(failed_tickers) or '-'})")
@@ -0,0 +1,60 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def reserve_active_orders(apps, schema_editor):
+    """
+    Резервирует средства под уже стоящие в стакане лимитные ордера.
+    Ордера, под которые средств не хватает, отменяются (сначала более старые получают резерв)
+    """
+    Balance = apps.get_model('balance', 'Balance')
+    LimitOrder = apps.get_model('order', 'LimitOrder')
+
+    amounts = {
+        (user_id, ticker): amount
+        for user_id, ticker, amount in Balance.objects.values_list('user_id', 'ticker', 'amount')
+    }
+    reserved = defaultdict(int)
+    cancelled = []
+
+    active_orders = (
+        LimitOrder.objects
+        .filter(status__in=['NEW', 'PARTIALLY_EXECUTED'])
+        .order_by('timestamp')
+        .values_list('id', 'user_id', 'ticker', 'direction', 'price', 'qty', 'filled')
+    )
+    for order_id, user_id, ticker, direction, price, qty, filled in active_orders.iterator(chunk_size=2000):
+        if direction == 'BUY':
+            key, hold = (user_id, 'RUB'), (qty - filled) * price
+        else:
+            key, hold = (user_id, ticker), qty - filled
+        if reserved[key] + hold > amounts.get(key, 0):
+            cancelled.append(order_id)
+            continue
+        reserved[key] += hold
+
+    if cancelled:
+        LimitOrder.objects.filter(id__in=cancelled).update(status='CANCELLED')
+    for (user_id, ticker), hold in reserved.items():
+        if hold:
+            Balance.objects.filter(user_id=user_id, ticker=ticker).update(reserved=hold)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('balance', '0002_balance_balances_user_id_62ea2c_idx'),
+        ('order', '0002_limitorder_limit_order_ticker_d90a0b_idx_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='balance',
+            name='reserved',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(reserve_active_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:19
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def open_ledger(apps, schema_editor):
+    """Текущие балансы становятся первыми движениями журнала, чтобы суммы движений совпадали с балансами"""
+    Balance = apps.get_model('balance', 'Balance')
+    LedgerEntry = apps.get_model('balance', 'LedgerEntry')
+
+    now = django.utils.timezone.now()
+    entries = []
+    balances = Balance.objects.exclude(amount=0, reserved=0).values_list('user_id', 'ticker', 'amount', 'reserved')
+    for user_id, ticker, amount, reserved in balances.iterator(chunk_size=2000):
+        entries.append(LedgerEntry(
+            user_id=user_id, ticker=ticker, kind='OPENING', amount=amount, reserved=reserved, timestamp=now
+        ))
+        if len(entries) >= 2000:
+            LedgerEntry.objects.bulk_create(entries)
+            entries = []
+    if entries:
+        LedgerEntry.objects.bulk_create(entries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('balance', '0003_balance_reserved'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ticker', models.CharField(max_length=10)),
+                ('entry_id', models.BigIntegerField()),
+                ('amount', models.BigIntegerField()),
+                ('reserved', models.BigIntegerField()),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='ledger_checkpoints', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'ledger_checkpoints',
+                'constraints': [models.UniqueConstraint(fields=('user', 'ticker', 'entry_id'), name='ledger_checkpoint_account_entry_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ticker', models.CharField(max_length=10)),
+                ('kind', models.CharField(choices=[('OPENING', 'Opening balance'), ('DEPOSIT', 'Deposit'), ('WITHDRAWAL', 'Withdrawal'), ('HOLD', 'Hold'), ('RELEASE', 'Release'), ('TRADE', 'Trade'), ('CLOSING', 'Closing balance')], max_length=10)),
+                ('amount', models.BigIntegerField(default=0)),
+                ('reserved', models.BigIntegerField(default=0)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='ledger_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'ledger_entries',
+                'indexes': [models.Index(fields=['user', 'ticker', 'id'], name='ledger_entr_user_id_8fd65a_idx')],
+            },
+        ),
+        migrations.RunPython(open_ledger, migrations.RunPython.noop),
+    ]
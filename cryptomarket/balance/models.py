@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from users.models import User
 from order.models import Instrument
 import uuid
@@ -8,6 +9,8 @@ class Balance(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="balances")
     ticker = models.CharField(max_length=10)
     amount = models.PositiveIntegerField(default=0)
+    # Часть amount, зарезервированная под активные лимитные ордера
+    reserved = models.PositiveIntegerField(default=0)
     
     class Meta:
         db_table = "balances"
@@ -16,5 +19,63 @@ class Balance(models.Model):
             models.Index(fields=['user']),
         ]
         
+    @property
+    def available(self) -> int:
+        return self.amount - self.reserved
+
     def __str__(self):
         return f"{self.user.name}: {self.ticker} - {self.amount}"
+
+
+class LedgerKind(models.TextChoices):
+    OPENING = "OPENING", "Opening balance"
+    DEPOSIT = "DEPOSIT", "Deposit"
+    WITHDRAWAL = "WITHDRAWAL", "Withdrawal"
+    HOLD = "HOLD", "Hold"
+    RELEASE = "RELEASE", "Release"
+    TRADE = "TRADE", "Trade"
+    # Списание балансов удаленного пользователя: его движения остаются в журнале
+    CLOSING = "CLOSING", "Closing balance"
+
+
+class LedgerEntry(models.Model):
+    """
+    Движение по балансу (только добавляется): на сколько изменились amount и reserved.
+    Сумма движений счета равна его балансу; id задает порядок движений.
+    Движения удаленного пользователя остаются (без внешнего ключа в базе): иначе сделки
+    по тикеру в сумме перестали бы давать ноль
+    """
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name="ledger_entries")
+    ticker = models.CharField(max_length=10)
+    kind = models.CharField(max_length=10, choices=LedgerKind.choices)
+    amount = models.BigIntegerField(default=0)
+    reserved = models.BigIntegerField(default=0)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = "ledger_entries"
+        indexes = [
+            models.Index(fields=['user', 'ticker', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.user_id} {self.ticker}: {self.amount:+} ({self.reserved:+} reserved)"
+
+
+class LedgerCheckpoint(models.Model):
+    """Баланс счета после всех движений с id <= entry_id (балансы на момент timestamp); хранится, как и движения"""
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name="ledger_checkpoints")
+    ticker = models.CharField(max_length=10)
+    entry_id = models.BigIntegerField()
+    amount = models.BigIntegerField()
+    reserved = models.BigIntegerField()
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = "ledger_checkpoints"
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'ticker', 'entry_id'], name='ledger_checkpoint_account_entry_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} {self.ticker} @{self.entry_id}: {self.amount} ({self.reserved} reserved)"
@@ -0,0 +1,193 @@
+"""
+Сверка инвариантов балансов и ордеров (команда reconcile).
+
+Проверяется:
+- балансы: amount и reserved не отрицательны, резерв не больше баланса;
+- ордера: filled <= qty;
+- счета: каждый баланс совпадает с журналом движений (последняя контрольная точка
+  счета + движения после нее, см. balance.ledger);
+- тикеры: сумма балансов равна открытию + пополнениям - выводам + сделкам по журналу,
+  а сделки по тикеру в сумме дают ноль.
+
+Таблицы в память не читаются: нарушения ищутся условиями в базе и читаются потоково
+(.iterator), итоги считаются агрегатными запросами, счета сверяются страницами.
+Журнал только дополняется, поэтому итоги по нему переносятся между запусками вместе
+с водяным знаком (id последнего учтенного движения) и досчитываются только по новым
+движениям. Движения удаленного пользователя остаются в журнале, а его балансы списываются
+движениями CLOSING (users.signals), поэтому удаление не требует полной сверки.
+
+SQLite не дает писать, пока идет чтение, поэтому долгие проходы разбиты на короткие
+запросы, а согласованное чтение балансов с журналом - на короткие транзакции.
+"""
+import copy
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from django.db import transaction
+from django.db.models import F, Max, Q, Sum
+
+from order.models import LimitOrder, MarketOrder
+from . import ledger
+from .models import Balance, LedgerEntry, LedgerKind
+
+# Сколько счетов сверять одной транзакцией (условия по счетам - в одном запросе, как в services)
+ACCOUNT_CHUNK = 200
+# Сколько id движений суммировать одним агрегатным запросом
+LEDGER_RANGE = 100000
+
+# Итоги журнала: {ticker: {'amount': {вид движения: сумма}, 'reserved': сумма}}
+Totals = Dict[str, dict]
+
+
+class Violations:
+    """Число нарушений и первые sample_size из них"""
+
+    def __init__(self, columns: Sequence[str], sample_size: int):
+        self.columns = columns
+        self.sample_size = sample_size
+        self.count = 0
+        self.sample = []
+
+    def add(self, row: tuple):
+        self.count += 1
+        if len(self.sample) < self.sample_size:
+            self.sample.append(dict(zip(self.columns, row)))
+
+    def extend(self, rows: Iterable[tuple]) -> 'Violations':
+        for row in rows:
+            self.add(row)
+        return self
+
+    def report(self) -> dict:
+        return {'violations': self.count, 'sample': self.sample}
+
+
+def check_balances(chunk_size: int, sample_size: int) -> dict:
+    """Балансы с отрицательными amount/reserved или резервом больше баланса"""
+    columns = ('user_id', 'ticker', 'amount', 'reserved')
+    rows = (
+        Balance.objects
+        .filter(Q(amount__lt=0) | Q(reserved__lt=0) | Q(reserved__gt=F('amount')))
+        .values_list(*columns)
+    )
+    return Violations(columns, sample_size).extend(rows.iterator(chunk_size=chunk_size)).report()
+
+
+def check_orders(chunk_size: int, sample_size: int) -> dict:
+    """Ордера, исполненные больше своего объема"""
+    columns = ('id', 'user_id', 'ticker', 'qty', 'filled')
+    return {
+        name: Violations(columns, sample_size).extend(
+            model.objects.filter(filled__gt=F('qty')).values_list(*columns).iterator(chunk_size=chunk_size)
+        ).report()
+        for name, model in (('limit_orders', LimitOrder), ('market_orders', MarketOrder))
+    }
+
+
+def check_accounts(sample_size: int) -> dict:
+    """
+    Каждый баланс против журнала. Балансы читаются страницами по (user_id, ticker);
+    страница и журнал по ее счетам читаются в одной короткой транзакции
+    """
+    violations = Violations(
+        ('user_id', 'ticker', 'amount', 'reserved', 'expected_amount', 'expected_reserved'), sample_size
+    )
+    checked = 0
+    after = Q()
+    while True:
+        with transaction.atomic():
+            page = list(
+                Balance.objects
+                .filter(after)
+                .order_by('user_id', 'ticker')
+                .values_list('user_id', 'ticker', 'amount', 'reserved')[:ACCOUNT_CHUNK]
+            )
+            expected = ledger.account_balances([(user_id, ticker) for user_id, ticker, _, _ in page])
+        for user_id, ticker, amount, reserved in page:
+            expected_amount, expected_reserved = expected.get((user_id, ticker), (0, 0))
+            if (amount, reserved) != (expected_amount, expected_reserved):
+                violations.add((user_id, ticker, amount, reserved, expected_amount, expected_reserved))
+        checked += len(page)
+        if len(page) < ACCOUNT_CHUNK:
+            break
+        user_id, ticker = page[-1][:2]
+        after = Q(user_id__gt=user_id) | Q(user_id=user_id, ticker__gt=ticker)
+    return {'checked': checked, **violations.report()}
+
+
+def _last_entry_id() -> int:
+    return LedgerEntry.objects.aggregate(entry_id=Max('id'))['entry_id'] or 0
+
+
+def add_ledger_totals(totals: Totals, after: int, until: int):
+    """Добавляет в totals движения с after < id <= until, по LEDGER_RANGE id за запрос"""
+    for start in range(after, until, LEDGER_RANGE):
+        rows = (
+            LedgerEntry.objects
+            .filter(id__gt=start, id__lte=min(start + LEDGER_RANGE, until))
+            .values_list('ticker', 'kind')
+            .annotate(amount=Sum('amount'), reserved=Sum('reserved'))
+            .order_by()
+        )
+        for ticker, kind, amount, reserved in rows:
+            ticker_totals = totals.setdefault(ticker, {'amount': {}, 'reserved': 0})
+            ticker_totals['amount'][kind] = ticker_totals['amount'].get(kind, 0) + amount
+            ticker_totals['reserved'] += reserved
+
+
+def check_tickers(totals: Optional[Totals] = None, watermark: int = 0) -> Tuple[dict, Totals, int]:
+    """
+    Суммы балансов каждого тикера против итогов журнала.
+    totals/watermark - итоги и водяной знак прошлой сверки (для полной - пусто и 0).
+    Возвращает (отчет по тикерам, новые итоги, новый водяной знак)
+    """
+    totals = copy.deepcopy(totals) if totals else {}
+    # Основная часть журнала - вне транзакции: учтенные движения уже не меняются
+    until = _last_entry_id()
+    add_ledger_totals(totals, watermark, until)
+    with transaction.atomic():
+        # Движения, добавленные за время прохода, и суммы балансов - на один момент
+        watermark = max(_last_entry_id(), watermark)
+        add_ledger_totals(totals, until, watermark)
+        balances = {
+            ticker: (amount, reserved)
+            for ticker, amount, reserved in (
+                Balance.objects
+                .values_list('ticker')
+                .annotate(amount=Sum('amount'), reserved=Sum('reserved'))
+                .order_by()
+            )
+        }
+
+    report = {}
+    for ticker in sorted(set(balances) | set(totals)):
+        amount, reserved = balances.get(ticker, (0, 0))
+        ticker_totals = totals.get(ticker, {'amount': {}, 'reserved': 0})
+        report[ticker] = {
+            'amount': amount,
+            'reserved': reserved,
+            'ledger': dict(sorted(ticker_totals['amount'].items())),
+            'ledger_reserved': ticker_totals['reserved'],
+            'ok': (
+                amount == sum(ticker_totals['amount'].values())
+                and reserved == ticker_totals['reserved']
+                and ticker_totals['amount'].get(LedgerKind.TRADE, 0) == 0
+            ),
+        }
+    return report, totals, watermark
+
+
+def reconcile(totals: Optional[Totals] = None, watermark: int = 0,
+              chunk_size: int = 2000, sample_size: int = 20) -> Tuple[dict, Totals]:
+    """Все проверки. Возвращает (отчет, итоги журнала для следующей сверки)"""
+    report = {'from_entry_id': watermark}
+    report['balances'] = check_balances(chunk_size, sample_size)
+    report['orders'] = check_orders(chunk_size, sample_size)
+    report['accounts'] = check_accounts(sample_size)
+    report['tickers'], totals, report['entry_id'] = check_tickers(totals, watermark)
+    report['ok'] = (
+        report['balances']['violations'] == 0
+        and all(orders['violations'] == 0 for orders in report['orders'].values())
+        and report['accounts']['violations'] == 0
+        and all(ticker['ok'] for ticker in report['tickers'].values())
+    )
+    return report, totals
@@ -18,4 +18,20 @@ class BalanceResponseSerializer(serializers.Serializer):
 class DepositWithdrawSerializer(serializers.Serializer):
     user_id = serializers.UUIDField()
     ticker = serializers.CharField()
-    amount = serializers.IntegerField(min_value=1) 
\ No newline at end of file
+    amount = serializers.IntegerField(min_value=1) 
+
+class TransferFailureSerializer(serializers.Serializer):
+    index = serializers.IntegerField()
+    user_id = serializers.UUIDField()
+    ticker = serializers.CharField()
+    detail = serializers.CharField()
+
+class BatchTransferResponseSerializer(serializers.Serializer):
+    """Итог пакетного пополнения/вывода: ошибки только по непроведенным строкам"""
+    processed = serializers.IntegerField()
+    succeeded = serializers.IntegerField()
+    failed = TransferFailureSerializer(many=True)
+
+class BalanceAtQuerySerializer(serializers.Serializer):
+    """Параметры запроса баланса на момент: ?at=<ISO-время>, по умолчанию - сейчас"""
+    at = serializers.DateTimeField(required=False)
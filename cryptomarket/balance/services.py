@@ -0,0 +1,205 @@
+"""
+Изменение балансов одиночными UPDATE-запросами.
+
+Баланс состоит из amount (все средства) и reserved (часть, зарезервированная
+под активные лимитные ордера); свободный остаток - amount - reserved.
+
+Новое значение вычисляется в самой базе (amount = amount +/- x), списание
+выполняется только при достаточном остатке (WHERE amount - reserved >= x), а нехватка
+средств определяется по числу обновленных строк. Баланс не читается в Python
+и не блокируется между запросами, поэтому параллельные изменения не теряются.
+Каждое изменение в той же транзакции добавляется в журнал движений (balance.ledger).
+Изменения amount меняют версию снимка баланса пользователя (balance.snapshots).
+"""
+from collections import defaultdict
+from typing import Dict, Optional, Sequence, Tuple
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Q, When
+
+from users.models import User
+from . import ledger
+from .models import Balance, LedgerKind
+from .snapshots import balance_snapshots
+
+# Сколько счетов обновлять одним UPDATE, чтобы не упереться в лимит параметров SQLite
+BULK_UPDATE_CHUNK = 200
+# Сколько строк пакетного пополнения/вывода обрабатывать одной транзакцией
+TRANSFER_CHUNK = 500
+
+
+class InsufficientFunds(ValueError):
+    """Не хватает средств на балансе"""
+
+    def __init__(self, user_id=None, ticker: str = None):
+        super().__init__("Insufficient funds")
+        self.user_id = user_id
+        self.ticker = ticker
+
+
+def credit(user_id, ticker: str, amount: int):
+    """Зачисляет amount на баланс, создавая его при необходимости"""
+    with transaction.atomic():
+        balance_snapshots.changed([user_id])
+        ledger.record(LedgerKind.DEPOSIT, [(user_id, ticker, amount, 0)])
+        updated = Balance.objects.filter(user_id=user_id, ticker=ticker).update(amount=F('amount') + amount)
+        if updated:
+            return
+        try:
+            with transaction.atomic():
+                Balance.objects.create(user_id=user_id, ticker=ticker, amount=amount)
+        except IntegrityError:
+            # Баланс успели создать параллельно
+            Balance.objects.filter(user_id=user_id, ticker=ticker).update(amount=F('amount') + amount)
+
+
+def debit(user_id, ticker: str, amount: int):
+    """
+    Списывает amount с баланса, если достаточно свободных (не зарезервированных) средств,
+    иначе InsufficientFunds
+    """
+    with transaction.atomic():
+        balance_snapshots.changed([user_id])
+        updated = (
+            Balance.objects
+            .filter(user_id=user_id, ticker=ticker, amount__gte=F('reserved') + amount)
+            .update(amount=F('amount') - amount)
+        )
+        if not updated:
+            raise InsufficientFunds(user_id, ticker)
+        ledger.record(LedgerKind.WITHDRAWAL, [(user_id, ticker, -amount, 0)])
+
+
+def reserve(user_id, ticker: str, amount: int):
+    """Резервирует amount под лимитный ордер, если достаточно свободных средств, иначе InsufficientFunds"""
+    updated = (
+        Balance.objects
+        .filter(user_id=user_id, ticker=ticker, amount__gte=F('reserved') + amount)
+        .update(reserved=F('reserved') + amount)
+    )
+    if not updated:
+        raise InsufficientFunds(user_id, ticker)
+    ledger.record(LedgerKind.HOLD, [(user_id, ticker, 0, amount)])
+
+
+def release(user_id, ticker: str, amount: int):
+    """Снимает резерв (отмена ордера)"""
+    if amount <= 0:
+        return
+    updated = (
+        Balance.objects
+        .filter(user_id=user_id, ticker=ticker, reserved__gte=amount)
+        .update(reserved=F('reserved') - amount)
+    )
+    if not updated:
+        raise InsufficientFunds(user_id, ticker)
+    ledger.record(LedgerKind.RELEASE, [(user_id, ticker, 0, -amount)])
+
+
+def available(user_id, ticker: str) -> int:
+    """Свободный (не зарезервированный) остаток"""
+    row = Balance.objects.filter(user_id=user_id, ticker=ticker).values_list('amount', 'reserved').first()
+    return row[0] - row[1] if row else 0
+
+
+def apply_deltas(deltas: Dict[Tuple[object, str], int], reserved_deltas: Optional[Dict[Tuple[object, str], int]] = None,
+                 kind: str = LedgerKind.TRADE):
+    """
+    Применяет изменения сразу ко многим балансам: {(user_id, ticker): delta} для amount
+    и такой же словарь для reserved; в журнал они попадают движениями вида kind. Один UPDATE на пачку счетов; строка обновляется,
+    только если после изменения резерв не отрицателен и не превышает баланс.
+    Если хотя бы одно изменение не прошло - InsufficientFunds (вызывающий код должен откатить транзакцию).
+    """
+    reserved_deltas = reserved_deltas or {}
+    keys = [key for key in set(deltas) | set(reserved_deltas) if deltas.get(key) or reserved_deltas.get(key)]
+    if not keys:
+        return
+    balance_snapshots.changed(user_id for user_id, ticker in keys if deltas.get((user_id, ticker)))
+
+    missing = [Balance(user_id=user_id, ticker=ticker, amount=0) for user_id, ticker in keys
+               if deltas.get((user_id, ticker), 0) > 0]
+    if missing:
+        Balance.objects.bulk_create(missing, ignore_conflicts=True)
+
+    for start in range(0, len(keys), BULK_UPDATE_CHUNK):
+        chunk = keys[start:start + BULK_UPDATE_CHUNK]
+        condition = Q()
+        amount_whens = []
+        reserved_whens = []
+        for user_id, ticker in chunk:
+            delta = deltas.get((user_id, ticker), 0)
+            reserved_delta = reserved_deltas.get((user_id, ticker), 0)
+            # amount + delta >= reserved + reserved_delta и reserved + reserved_delta >= 0
+            row = Q(user_id=user_id, ticker=ticker, amount__gte=F('reserved') + (reserved_delta - delta))
+            if reserved_delta < 0:
+                row &= Q(reserved__gte=-reserved_delta)
+            condition |= row
+            amount_whens.append(When(user_id=user_id, ticker=ticker, then=F('amount') + delta))
+            reserved_whens.append(When(user_id=user_id, ticker=ticker, then=F('reserved') + reserved_delta))
+        updated = Balance.objects.filter(condition).update(
+            amount=Case(*amount_whens),
+            reserved=Case(*reserved_whens)
+        )
+        if updated != len(chunk):
+            raise InsufficientFunds()
+
+    ledger.record(kind, (
+        (user_id, ticker, deltas.get((user_id, ticker), 0), reserved_deltas.get((user_id, ticker), 0))
+        for user_id, ticker in keys
+    ))
+
+
+def transfer_many(rows: Sequence[Tuple[object, str, int]], withdraw: bool = False) -> Dict[int, str]:
+    """
+    Пакетное пополнение (или вывод) по строкам (user_id, ticker, amount).
+    Строки обрабатываются пачками по TRANSFER_CHUNK, каждая пачка - одна транзакция:
+    пользователи проверяются одним запросом, при выводе балансы читаются одним запросом,
+    а все изменения пачки применяются apply_deltas.
+    Возвращает ошибки по строкам: {номер строки: причина}; остальные строки проведены
+    """
+    errors: Dict[int, str] = {}
+    for start in range(0, len(rows), TRANSFER_CHUNK):
+        chunk = list(enumerate(rows[start:start + TRANSFER_CHUNK], start))
+        try:
+            errors.update(_transfer_chunk(chunk, withdraw))
+        except InsufficientFunds:
+            # Балансы пачки изменились параллельно между чтением и записью - пачка откатилась целиком
+            for index, _ in chunk:
+                errors[index] = "Balance changed concurrently, rows were not applied"
+    return errors
+
+
+def _transfer_chunk(chunk, withdraw: bool) -> Dict[int, str]:
+    errors: Dict[int, str] = {}
+    with transaction.atomic():
+        user_ids = {user_id for _, (user_id, _, _) in chunk}
+        known_users = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+
+        available: Dict[Tuple[object, str], int] = {}
+        if withdraw:
+            tickers = {ticker for _, (_, ticker, _) in chunk}
+            rows = (
+                Balance.objects
+                .select_for_update()
+                .filter(user_id__in=known_users, ticker__in=tickers)
+                .values_list('user_id', 'ticker', 'amount', 'reserved')
+            )
+            available = {(user_id, ticker): amount - reserved for user_id, ticker, amount, reserved in rows}
+
+        deltas: Dict[Tuple[object, str], int] = defaultdict(int)
+        for index, (user_id, ticker, amount) in chunk:
+            key = (user_id, ticker)
+            if user_id not in known_users:
+                errors[index] = "User not found"
+            elif not withdraw:
+                deltas[key] += amount
+            elif key not in available:
+                errors[index] = f"Пользователь не имеет баланса {ticker}"
+            elif available[key] < amount:
+                errors[index] = f"Недостаточно средств. Доступно: {available[key]}"
+            else:
+                available[key] -= amount
+                deltas[key] -= amount
+
+        apply_deltas(deltas, kind=LedgerKind.WITHDRAWAL if withdraw else LedgerKind.DEPOSIT)
+    return errors
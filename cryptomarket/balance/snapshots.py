@@ -0,0 +1,122 @@
+"""
+Снимки балансов пользователей для GET /api/v1/balance.
+
+Снимок ({ticker: amount}) хранится в памяти процесса вместе с версией, при которой он прочитан.
+Версия пользователя лежит в общем кэше (CACHES['default']) и меняется на новое случайное
+значение после коммита каждого изменения amount его балансов (balance.services: расчеты матчинга,
+пополнение и вывод). Запрос баланса читает только версию и, если она совпала со снимком,
+отвечает без запроса к базе.
+
+Изменения балансов не пишут в общий кэш сами: расчет сделки идет под блокировкой стакана,
+а запись в FileBasedCache там слишком дорога (каждая запись перечисляет каталог кэша).
+До коммита снимок этого процесса выбрасывается, после коммита пользователь помечается
+ожидающим публикации, и новые версии пишет отдельный поток. Пока версия не опубликована,
+запрос баланса в этом процессе читает базу; другие процессы видят изменение с задержкой
+на публикацию. Снимок, прочитанный во время транзакции (еще со старыми балансами),
+сбрасывает смена версии.
+
+Версии могут вытесняться из кэша (размер задан в CACHES), тогда версия заводится заново
+и снимки просто перечитываются.
+
+Резервирование (reserve/release) не меняет amount, поэтому версию не трогает.
+"""
+import threading
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Balance
+
+
+def snapshot_settings() -> dict:
+    return getattr(settings, 'BALANCE_SNAPSHOTS', {})
+
+
+def _version_key(user_id) -> str:
+    return f'balance:version:{user_id}'
+
+
+class BalanceSnapshots:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # user_id -> (версия, {ticker: amount})
+        self._entries: OrderedDict = OrderedDict()
+        # Пользователи с закоммиченными, но еще не опубликованными изменениями
+        self._pending = Counter()
+        self._publisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='balance-versions')
+
+    def _version(self, user_id) -> str:
+        key = _version_key(user_id)
+        version = cache.get(key)
+        if version is None:
+            # Версии нет (еще не было изменений или ключ вытеснен) - заводим новую,
+            # снимки со старой версией при этом перестают совпадать
+            cache.add(key, uuid.uuid4().hex, None)
+            version = cache.get(key)
+        return version
+
+    def get(self, user_id) -> Dict[str, int]:
+        """Балансы пользователя: из снимка, если его версия актуальна, иначе из базы"""
+        version = self._version(user_id)
+        with self._lock:
+            pending = user_id in self._pending
+            entry = self._entries.get(user_id)
+            if not pending and entry is not None and entry[0] == version:
+                self._entries.move_to_end(user_id)
+                return dict(entry[1])
+
+        # Версия прочитана до базы: изменение, закоммиченное после нее, сменит версию
+        balances = dict(Balance.objects.filter(user_id=user_id).values_list('ticker', 'amount'))
+        if pending:
+            # Версия, при которой прочитан снимок, вот-вот сменится
+            return balances
+        with self._lock:
+            self._entries[user_id] = (version, balances)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > snapshot_settings().get('MAX_ENTRIES', 10000):
+                self._entries.popitem(last=False)
+        return dict(balances)
+
+    def changed(self, user_ids: Iterable):
+        """
+        Балансы пользователей меняются текущей транзакцией: снимки процесса выбрасываются
+        сразу, новые версии публикуются в фоне после коммита
+        """
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+        def committed():
+            with self._lock:
+                self._pending.update(user_ids)
+            self._publisher.submit(self._publish, user_ids)
+
+        transaction.on_commit(committed)
+
+    def _publish(self, user_ids: set):
+        try:
+            cache.set_many({_version_key(user_id): uuid.uuid4().hex for user_id in user_ids}, None)
+        finally:
+            with self._lock:
+                self._pending.subtract(user_ids)
+                self._pending = +self._pending
+
+    def flush(self):
+        """Дожидается публикации версий по всем закоммиченным изменениям"""
+        self._publisher.submit(lambda: None).result()
+
+    def reset(self):
+        self.flush()
+        with self._lock:
+            self._entries.clear()
+
+
+balance_snapshots = BalanceSnapshots()
@@ -1,3 +1,122 @@
-from django.test import TestCase
+from django.contrib import admin
+from django.core.cache import cache
+from django.test import RequestFactory
 
-# Create your tests here.
+from cryptomarket.testing import ExchangeTestCase
+from users.models import User
+from . import ledger, reconciliation, services as balance_services
+from .models import Balance, LedgerCheckpoint, LedgerEntry, LedgerKind
+from .snapshots import balance_snapshots
+
+
+class BalanceTestCase(ExchangeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.get(name='admin')
+
+
+class WithdrawTests(BalanceTestCase):
+    def withdraw(self, user: User, ticker: str, amount: int):
+        return self.client_for(self.admin).post(
+            '/api/v1/admin/balance/withdraw',
+            {'user_id': str(user.id), 'ticker': ticker, 'amount': amount},
+            format='json'
+        )
+
+    def test_reserved_funds_are_not_available(self):
+        user = User.objects.create_user(name='trader')
+        balance_services.credit(user.id, 'MEM', 7)
+        balance_services.reserve(user.id, 'MEM', 6)
+
+        response = self.withdraw(user, 'MEM', 2)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['detail'], "Недостаточно средств. Доступно: 1")
+        self.assertEqual(self.withdraw(user, 'MEM', 1).status_code, 200)
+        self.assertEqual(Balance.objects.get(user=user, ticker='MEM').amount, 6)
+
+    def test_missing_balance(self):
+        user = User.objects.create_user(name='trader')
+        response = self.withdraw(user, 'MEM', 1)
+        self.assertEqual(response.json()['detail'], "Пользователь не имеет баланса MEM")
+
+
+class BalanceSnapshotTests(BalanceTestCase):
+    def test_snapshot_is_dropped_before_commit(self):
+        user = User.objects.create_user(name='trader')
+        balance_services.credit(user.id, 'MEM', 5)
+        self.assertEqual(balance_snapshots.get(user.id)['MEM'], 5)
+        version = cache.get(f'balance:version:{user.id}')
+
+        # Коммит теста не наступает: версия в общем кэше та же, снимок процесса выброшен
+        balance_services.debit(user.id, 'MEM', 2)
+        self.assertEqual(cache.get(f'balance:version:{user.id}'), version)
+        self.assertEqual(balance_snapshots.get(user.id)['MEM'], 3)
+
+    def test_version_changes_after_commit(self):
+        user = User.objects.create_user(name='trader')
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            balance_services.credit(user.id, 'MEM', 5)
+            version = cache.get(f'balance:version:{user.id}')
+        for callback in callbacks:
+            callback()
+        balance_snapshots.flush()
+        self.assertNotEqual(cache.get(f'balance:version:{user.id}'), version)
+
+
+class LedgerRetentionTests(BalanceTestCase):
+    def test_ledger_is_kept_after_user_deletion(self):
+        user = User.objects.create_user(name='trader')
+        balance_services.credit(user.id, 'MEM', 5)
+        ledger.checkpoint()
+        user_id = user.id
+
+        user.delete()
+
+        self.assertFalse(Balance.objects.filter(user_id=user_id).exists())
+        self.assertEqual(
+            list(LedgerEntry.objects.filter(user_id=user_id, ticker='MEM').order_by('id').values_list('kind', 'amount')),
+            [(LedgerKind.DEPOSIT, 5), (LedgerKind.CLOSING, -5)]
+        )
+        self.assertTrue(LedgerCheckpoint.objects.filter(user_id=user_id).exists())
+
+    def test_ledger_admin_is_read_only(self):
+        request = RequestFactory().get('/')
+        request.user = self.admin
+        for model in (LedgerEntry, LedgerCheckpoint):
+            model_admin = admin.site._registry[model]
+            with self.subTest(model=model.__name__):
+                self.assertFalse(model_admin.has_add_permission(request))
+                self.assertFalse(model_admin.has_change_permission(request))
+                self.assertFalse(model_admin.has_delete_permission(request))
+
+
+class ReconcileTests(BalanceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.buyer = User.objects.create_user(name='buyer')
+        self.seller = User.objects.create_user(name='seller')
+        balance_services.credit(self.buyer.id, 'RUB', 1000)
+        balance_services.credit(self.seller.id, 'MEM', 10)
+        balance_services.reserve(self.seller.id, 'MEM', 4)
+        balance_services.apply_deltas(
+            {(self.buyer.id, 'RUB'): -200, (self.buyer.id, 'MEM'): 2,
+             (self.seller.id, 'RUB'): 200, (self.seller.id, 'MEM'): -2},
+            {(self.seller.id, 'MEM'): -2},
+        )
+
+    def assertReconciled(self, report):
+        self.assertTrue(report['ok'], report)
+
+    def test_user_deletion_keeps_totals(self):
+        report, totals = reconciliation.reconcile()
+        self.assertReconciled(report)
+
+        self.seller.delete()
+
+        # И полная сверка, и досчет от водяного знака до удаления
+        self.assertReconciled(reconciliation.reconcile()[0])
+        report, _ = reconciliation.reconcile(totals, report['entry_id'])
+        self.assertReconciled(report)
+        self.assertEqual(report['tickers']['MEM']['ledger'][LedgerKind.CLOSING], -8)
+        self.assertEqual(report['tickers']['MEM']['ledger'][LedgerKind.TRADE], 0)
@@ -3,6 +3,9 @@ from . import views
 
 urlpatterns = [
     path('balance', views.BalanceView.as_view(), name='balance'),
+    path('admin/balance/<uuid:user_id>', views.AdminBalanceAtView.as_view(), name='admin-balance-at'),
     path('admin/balance/deposit', views.AdminBalanceDepositView.as_view(), name='admin-balance-deposit'),
     path('admin/balance/withdraw', views.AdminBalanceWithdrawView.as_view(), name='admin-balance-withdraw'),
+    path('admin/balance/deposit/batch', views.AdminBalanceBatchDepositView.as_view(), name='admin-balance-deposit-batch'),
+    path('admin/balance/withdraw/batch', views.AdminBalanceBatchWithdrawView.as_view(), name='admin-balance-withdraw-batch'),
 ] 
\ No newline at end of file
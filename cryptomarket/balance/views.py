@@ -5,14 +5,19 @@ from rest_framework.decorators import api_view, permission_classes, authenticati
 from rest_framework.permissions import IsAuthenticated
 from users.models import User, UserRole
 from users.authentication import APITokenAuthentication
-from order.models import Instrument
 from cryptomarket.permissions import IsAdmin
 
 from .models import Balance
+from . import ledger
+from . import services as balance_services
+from .snapshots import balance_snapshots
+from .services import InsufficientFunds
 from .serializers import (
     BalanceSerializer,
     BalanceResponseSerializer,
-    DepositWithdrawSerializer
+    DepositWithdrawSerializer,
+    BatchTransferResponseSerializer,
+    BalanceAtQuerySerializer
 )
 from order.serializers import OkSerializer
 
@@ -23,24 +28,26 @@ class BalanceView(views.APIView):
     
     def get(self, request):
         """Получить баланс авторизованного пользователя"""
-        # Получаем все существующие тикеры
-        all_tickers = Instrument.objects.values_list('ticker', flat=True)
-        
-        # Создаем балансы для всех тикеров, если их нет
-        # for ticker in all_tickers:
-        #     Balance.objects.get_or_create(
-        #         user=request.user,
-        #         ticker=ticker,
-        #         defaults={'amount': 0}
-        #     )
-        
-        # Получаем балансы пользователя
-        user_balances = Balance.objects.filter(user=request.user)
-        
-        # Создаем словарь с балансами
-        balance_dict = {balance.ticker: balance.amount for balance in user_balances}
-            
-        return Response(balance_dict)
+        # Балансы из снимка, если после него балансы пользователя не менялись
+        return Response(balance_snapshots.get(request.user.id))
+
+class AdminBalanceAtView(views.APIView):
+    """
+    API для балансов пользователя на момент времени (только для админов).
+    Считается по журналу движений: последняя контрольная точка счета и движения после нее
+    """
+    authentication_classes = [APITokenAuthentication]
+    permission_classes = [IsAdmin]
+
+    def get(self, request, user_id):
+        """Балансы пользователя на момент ?at (по умолчанию - сейчас)"""
+        query = BalanceAtQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        get_object_or_404(User.objects.only('id'), id=user_id)
+
+        balances = ledger.balances_at(user_id, query.validated_data.get('at'))
+        return Response({ticker: amount for ticker, (amount, reserved) in sorted(balances.items())})
 
 class AdminBalanceDepositView(views.APIView):
     """API для пополнения баланса (только для админов)"""
@@ -58,14 +65,7 @@ class AdminBalanceDepositView(views.APIView):
             
             user = get_object_or_404(User, id=user_id)
             
-            balance, created = Balance.objects.get_or_create(
-                user=user,
-                ticker=ticker,
-                defaults={'amount': 0}
-            )
-            
-            balance.amount += amount
-            balance.save()
+            balance_services.credit(user.id, ticker, amount)
             
             return Response(OkSerializer({"success": True}).data)
         
@@ -88,22 +88,57 @@ class AdminBalanceWithdrawView(views.APIView):
             user = get_object_or_404(User, id=user_id)
             
             try:
-                balance = Balance.objects.get(user=user, ticker=ticker)
-            except Balance.DoesNotExist:
-                return Response(
-                    {"detail": f"Пользователь не имеет баланса {ticker}"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            
-            if balance.amount < amount:
+                balance_services.debit(user.id, ticker, amount)
+            except InsufficientFunds:
+                # Списание не прошло - читаем баланс только чтобы объяснить причину
+                if not Balance.objects.filter(user=user, ticker=ticker).exists():
+                    return Response(
+                        {"detail": f"Пользователь не имеет баланса {ticker}"},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                # Зарезервированное под ордера вывести нельзя
+                available = balance_services.available(user.id, ticker)
                 return Response(
-                    {"detail": f"Недостаточно средств. Доступно: {balance.amount}"},
+                    {"detail": f"Недостаточно средств. Доступно: {available}"},
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            balance.amount -= amount
-            balance.save()
-            
             return Response(OkSerializer({"success": True}).data)
         
         return Response(serializer.errors, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+# Сколько строк принимать одним запросом; большие файлы - командой bulk_balance
+MAX_BATCH_TRANSFERS = 10000
+
+class AdminBalanceBatchDepositView(views.APIView):
+    """
+    API для пакетного пополнения балансов (только для админов), например для раздачи токенов.
+    Строки проводятся пачками по одной транзакции, непроведенные строки возвращаются с причиной
+    """
+    authentication_classes = [APITokenAuthentication]
+    permission_classes = [IsAdmin]
+    withdraw = False
+
+    def post(self, request):
+        """Пакетное пополнение (вывод) балансов"""
+        serializer = DepositWithdrawSerializer(
+            data=request.data, many=True, allow_empty=False, max_length=MAX_BATCH_TRANSFERS
+        )
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        rows = [(item['user_id'], item['ticker'], item['amount']) for item in serializer.validated_data]
+        errors = balance_services.transfer_many(rows, withdraw=self.withdraw)
+
+        return Response(BatchTransferResponseSerializer({
+            'processed': len(rows),
+            'succeeded': len(rows) - len(errors),
+            'failed': [
+                {'index': index, 'user_id': rows[index][0], 'ticker': rows[index][1], 'detail': detail}
+                for index, detail in sorted(errors.items())
+            ],
+        }).data)
+
+class AdminBalanceBatchWithdrawView(AdminBalanceBatchDepositView):
+    """API для пакетного вывода средств с балансов (только для админов)"""
+    withdraw = True
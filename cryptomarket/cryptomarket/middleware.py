@@ -1,6 +1,17 @@
+import hashlib
 import json
 import logging
+import re
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import urlencode
 
 # Получаем уже настроенный логгер
 logger = logging.getLogger('api_requests')
@@ -48,4 +59,133 @@ class APILoggingMiddleware:
 
             logger.log(log_level, f"Response {response.status_code}: {json.dumps(response_body, ensure_ascii=False) if response_body else 'No content'}")
 
-        return response 
\ No newline at end of file
+            # Счетчики матчинга ордера (MATCHING_METRICS['LOG'])
+            matching_stats = getattr(request, 'matching_stats', None)
+            if matching_stats:
+                logger.info(f"Matching stats: {json.dumps(matching_stats, ensure_ascii=False)}")
+
+        return response 
+
+
+def micro_cache_settings() -> dict:
+    return getattr(settings, 'MICRO_CACHE', {})
+
+
+@lru_cache(maxsize=None)
+def _compile_paths(paths: tuple) -> list:
+    return [(re.compile(pattern), tuple(params)) for pattern, params in paths]
+
+
+class MicroCacheMiddleware:
+    """
+    Микрокэш ответов горячих публичных GET-эндпоинтов (MICRO_CACHE['PATHS']).
+
+    Ответ 200 хранится TTL секунд (0.05-0.5) по пути и параметрам запроса, от которых
+    зависит ответ (список у каждого пути в PATHS; остальные параметры в ключ не входят,
+    иначе ими можно без предела наполнять кэш). Хранится в памяти процесса и в общем
+    для воркеров кэше MICRO_CACHE['CACHE'].
+    Пересчет ключа объединяется: внутри процесса запросы ждут на блокировке ключа,
+    между воркерами пересчитывает тот, кто первым занял ключ блокировки (cache.add),
+    остальные до WAIT секунд ждут его результат в общем кэше, отпустив блокировку ключа.
+
+    Гарантию дают только блокировки внутри процесса. Объединение между процессами -
+    по возможности: в FileBasedCache add - это проверка и запись без блокировки, и два
+    процесса могут занять ключ одновременно, тогда оба пересчитают ответ. Это безопасно,
+    ответ просто посчитается лишний раз; атомарный add дают Redis и Memcached.
+    """
+    # Полосы блокировок для объединения запросов внутри процесса
+    LOCK_STRIPES = 64
+    # Сколько записей держать в памяти процесса до чистки устаревших
+    LOCAL_MAX_ENTRIES = 1000
+    POLL_INTERVAL = 0.005
+    HEADERS = ('Content-Type', 'ETag', 'Cache-Control', 'X-Next-Cursor')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self._local = {}
+
+    def __call__(self, request):
+        options = micro_cache_settings()
+        params = self._params(request, options) if options.get('ENABLED') and request.method == 'GET' else None
+        if params is None:
+            return self.get_response(request)
+
+        cache = caches[options.get('CACHE', 'default')]
+        key = self._key(request, params)
+        entry = self._get(cache, key)
+        if entry is not None:
+            return self._respond(request, entry)
+
+        with self._locks[hash(key) % self.LOCK_STRIPES]:
+            entry = self._get(cache, key)
+            if entry is not None:
+                return self._respond(request, entry)
+
+            lock_key = f'{key}:lock'
+            # В FileBasedCache add не атомарен: ключ могут занять двое, тогда оба пересчитают
+            if cache.add(lock_key, 1, options.get('LOCK_TIMEOUT', 1)):
+                try:
+                    return self._compute(request, cache, key, options)
+                finally:
+                    cache.delete(lock_key)
+
+        # Ключ пересчитывает другой воркер: ждем его результат, не держа блокировку ключа
+        deadline = time.monotonic() + options.get('WAIT', 0.25)
+        while time.monotonic() < deadline:
+            time.sleep(self.POLL_INTERVAL)
+            entry = self._get(cache, key)
+            if entry is not None:
+                return self._respond(request, entry)
+        return self._compute(request, cache, key, options)
+
+    def _compute(self, request, cache, key, options):
+        response = self.get_response(request)
+        if response.status_code == 200 and not response.streaming:
+            self._set(cache, key, response, options.get('TTL', 0.1))
+        return response
+
+    @staticmethod
+    def _params(request, options):
+        """Параметры запроса, входящие в ключ, или None, если путь не кэшируется"""
+        for pattern, params in _compile_paths(tuple(options.get('PATHS', {}).items())):
+            if pattern.match(request.path):
+                return params
+        return None
+
+    @staticmethod
+    def _key(request, params) -> str:
+        query = urlencode(sorted((name, request.GET.getlist(name)) for name in params if name in request.GET),
+                          doseq=True)
+        return 'microcache:' + hashlib.md5(f'{request.path}?{query}'.encode()).hexdigest()
+
+    def _get(self, cache, key):
+        now = time.time()
+        entry = self._local.get(key)
+        if entry is None or entry['expires'] <= now:
+            entry = cache.get(key)
+            if entry is None or entry['expires'] <= now:
+                return None
+            self._local[key] = entry
+        return entry
+
+    def _set(self, cache, key, response, ttl: float):
+        entry = {
+            'expires': time.time() + ttl,
+            'content': response.content,
+            'headers': {name: response[name] for name in self.HEADERS if name in response},
+        }
+        if len(self._local) >= self.LOCAL_MAX_ENTRIES:
+            now = time.time()
+            self._local = {k: v for k, v in self._local.items() if v['expires'] > now}
+        self._local[key] = entry
+        # Кэш хранит целые секунды, свежесть проверяется по expires
+        cache.set(key, entry, int(ttl) + 1)
+
+    @staticmethod
+    def _respond(request, entry):
+        response = HttpResponse(entry['content'])
+        for name, value in entry['headers'].items():
+            response[name] = value
+        # Условный запрос с совпавшим ETag получает 304
+        return get_conditional_response(request, etag=entry['headers'].get('ETag'), response=response)
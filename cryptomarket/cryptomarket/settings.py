@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from corsheaders.defaults import default_headers
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -59,9 +62,13 @@ MIDDLEWARE = [
     'cryptomarket.disable_csrf.DisableCSRF',
     'corsheaders.middleware.CorsMiddleware',
     'cryptomarket.middleware.APILoggingMiddleware',
+    'cryptomarket.middleware.MicroCacheMiddleware',
 ]
 
 CORS_ALLOW_ALL_ORIGINS = True
+# Условные запросы стакана из браузера: If-None-Match в запросе, ETag в ответе
+CORS_ALLOW_HEADERS = (*default_headers, 'if-none-match')
+CORS_EXPOSE_HEADERS = ['ETag', 'X-Next-Cursor']
 
 ROOT_URLCONF = 'cryptomarket.urls'
 
@@ -90,6 +97,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Потоки матчинга разных тикеров пишут параллельно:
+            # берем блокировку на запись сразу и ждем ее, а не падаем с "database is locked"
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -162,6 +175,90 @@ AUTH_USER_MODEL = 'users.User'
 
 API_PREFIX = '/api/v1/'
 
+# Тесты идут с кэшем в памяти и без журнала матчинга (cryptomarket.testing.TEST_SETTINGS)
+TEST_RUNNER = 'cryptomarket.testing.ExchangeTestRunner'
+
+# Матчинг: команды одного тикера выполняются по очереди в выделенном потоке.
+# Стаканы (order.book) и очереди тикеров живут в памяти процесса, поэтому матчингом владеет
+# один процесс: uvicorn запускается с одним воркером, синхронные представления - в пуле потоков (docker-entrypoint.sh).
+# Если стакан все же разошелся с базой (ордер изменен другим процессом), расчет сделки
+# откатывается и ордер матчится заново по перечитанному стакану (order.settlement.StaleBook)
+MATCHING_SEQUENCER = {
+    'ENABLED': True,
+    'TIMEOUT': 30,  # сколько HTTP-запрос ждет результат команды, секунд
+}
+
+# Журнал матчинга и снимки стаканов: после перезапуска стаканы восстанавливаются из них, а не из базы.
+# Включается только для сервера (MATCHING_JOURNAL=1 в docker-entrypoint.sh), чтобы тесты и manage.py shell
+# не писали в журнал сервера. Каталогом владеет один процесс (файл блокировки owner.lock), остальные
+# процессы работают без журнала и загружают стаканы из базы
+MATCHING_JOURNAL = {
+    'ENABLED': os.environ.get('MATCHING_JOURNAL') == '1',
+    'DIR': BASE_DIR / 'journal',
+    'FSYNC_EVERY': 100,  # fsync после стольких записей...
+    'FSYNC_INTERVAL': 0.05,  # ...или если с прошлого fsync прошло столько секунд
+    'SNAPSHOT_EVERY': 10000,  # снимок стаканов после стольких записей журнала
+}
+
+# Общий для процессов кэш: через него процессы узнают об изменении справочника инструментов,
+# API-ключей и балансов (ключи версий, по одному на пользователя), в нем же ответы MICRO_CACHE.
+# По умолчанию FileBasedCache хранит 300 файлов и при переполнении удаляет треть из них, в том числе
+# ключи версий, поэтому предел задан с запасом на всех пользователей, а вытесняется десятая часть.
+# Для нескольких серверов кэш нужно переносить в Redis или Memcached (django.core.cache.backends.redis)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+            'CULL_FREQUENCY': 10,
+        },
+    }
+}
+
+# Справочник инструментов в памяти; CHECK_INTERVAL - как часто (в секундах) сверять версию с общим кэшем
+INSTRUMENT_REGISTRY = {
+    'CHECK_INTERVAL': 1.0,
+}
+
+# Кэш API-ключей (users.authentication): MAX_ENTRIES и TTL (секунды) кэша в памяти процесса,
+# CHECK_INTERVAL - как часто сверять версию с общим кэшем
+API_KEY_CACHE = {
+    'MAX_ENTRIES': 10000,
+    'TTL': 60,
+    'CHECK_INTERVAL': 1.0,
+}
+
+# Снимки балансов для GET /api/v1/balance (balance.snapshots): сколько пользователей держать в памяти
+BALANCE_SNAPSHOTS = {
+    'MAX_ENTRIES': 10000,
+}
+
+# Микрокэш горячих публичных ответов (cryptomarket.middleware.MicroCacheMiddleware):
+# TTL в секундах (0.05-0.5), CACHE - общий для воркеров кэш, PATHS - регулярные выражения путей
+# и параметры запроса, от которых зависит ответ (только они входят в ключ),
+# LOCK_TIMEOUT - сколько живет блокировка пересчета ключа, WAIT - сколько ждать пересчета другим воркером
+# (объединение между процессами - по возможности: add в FileBasedCache не атомарен)
+MICRO_CACHE = {
+    'ENABLED': True,
+    'TTL': 0.2,
+    'CACHE': 'default',
+    'PATHS': {
+        r'^/api/v1/public/instrument$': (),
+        r'^/api/v1/public/orderbook/[^/]+$': ('limit',),
+        r'^/api/v1/public/transactions/[^/]+$': ('limit', 'cursor'),
+        r'^/api/v1/public/ticker/[^/]+$': (),
+        r'^/api/v1/public/candles/[^/]+$': ('interval', 'start', 'end', 'limit'),
+    },
+    'LOCK_TIMEOUT': 1.0,
+    'WAIT': 0.25,
+}
+
+# Метрики матчинга (GET /api/v1/admin/metrics/matching); LOG - писать счетчики ордера в лог запроса
+MATCHING_METRICS = {
+    'LOG': False,
+}
+
 # Настройки логирования
 LOGGING = {
     'version': 1,
@@ -192,6 +289,7 @@ LOGGING = {
             'filename': 'api_requests.log',
             'formatter': 'simple',
             'mode': 'a',
+            'delay': True,  # файл создается при первой записи, а не при каждом запуске manage.py
         }
     },
     'loggers': {
@@ -205,5 +303,10 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': False,
         },
+        'matching': {
+            'handlers': ['console', 'file'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     },
 }
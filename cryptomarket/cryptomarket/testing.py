@@ -0,0 +1,67 @@
+"""
+Общее для тестов приложений: настройки, базовый TestCase и TEST_RUNNER.
+
+Стаканы, справочник инструментов, кэш API-ключей, снимки балансов и статистика сделок
+живут в памяти процесса и переживают откат транзакции теста, поэтому базовый класс
+сбрасывает их перед каждым тестом. Новый кэш в памяти процесса добавляется в reset_process_state.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.runner import DiscoverRunner
+from rest_framework.test import APIClient
+
+TEST_SETTINGS = dict(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    MATCHING_JOURNAL={**settings.MATCHING_JOURNAL, 'ENABLED': False},
+    MICRO_CACHE={**settings.MICRO_CACHE, 'ENABLED': False},
+)
+
+
+def reset_process_state():
+    """Сбрасывает состояние процесса, которое не откатывается вместе с базой"""
+    from balance.snapshots import balance_snapshots
+    from order import book
+    from order.instruments import instruments
+    from order.rolling import rolling
+    from users.authentication import api_key_cache
+
+    book.reset_books()
+    rolling.reset()
+    instruments.reset()
+    api_key_cache.reset()
+    balance_snapshots.reset()
+    cache.clear()
+
+
+@override_settings(**TEST_SETTINGS)
+class ExchangeTestCase(TestCase):
+    """Тест на чистых стаканах и кэшах с инструментом MEM"""
+
+    def setUp(self):
+        from order.models import Instrument
+
+        reset_process_state()
+        Instrument.objects.create(ticker='MEM', name='Memcoin')
+
+    @staticmethod
+    def client_for(user) -> APIClient:
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'TOKEN {user.api_key}')
+        return client
+
+
+class ExchangeTestRunner(DiscoverRunner):
+    """
+    Применяет TEST_SETTINGS ко всему прогону, а не только к ExchangeTestCase:
+    создание тестовой базы и сигналы при нем не должны писать в кэш и журнал сервера
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._test_settings = override_settings(**TEST_SETTINGS)
+        self._test_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._test_settings.disable()
+        super().teardown_test_environment(**kwargs)
@@ -1,7 +1,8 @@
 from django.contrib import admin
-from .models import LimitOrder, MarketOrder, Transaction, Instrument
+from .models import LimitOrder, MarketOrder, Transaction, Instrument, Candle
 
 admin.site.register(LimitOrder)
 admin.site.register(MarketOrder)
 admin.site.register(Transaction)
 admin.site.register(Instrument)
+admin.site.register(Candle)
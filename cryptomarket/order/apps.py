@@ -5,3 +5,7 @@ class OrderConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'order'
     verbose_name = 'Order Management'
+
+    def ready(self):
+        """Подключаем сигналы при запуске приложения"""
+        import order.signals  # noqa
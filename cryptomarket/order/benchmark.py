@@ -0,0 +1,261 @@
+"""
+Нагрузочный бенчмарк матчинга.
+
+Генерирует синтетический поток заявок (несколько тикеров и пользователей,
+лимитные и рыночные ордера, случайное блуждание цены, отмены) и прогоняет его
+через движок (OrderMatcher) или через HTTP API (OrderView.post через Django test client).
+Считает ордера в секунду, перцентили задержки и число SQL-запросов на ордер.
+
+Запускается командой manage.py benchmark_matching на отдельной тестовой базе SQLite.
+"""
+import random
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+from django.db import connection
+from django.test import Client
+
+from balance.models import Balance
+from users.models import User
+from .book import reset_books
+from .matching import OrderRejected
+from .instruments import instruments
+from .metrics import QueryCounter, metrics
+from .models import Direction, Instrument, LimitOrder, OrderStatus, Transaction
+from .views import OrderDetailView, OrderView
+
+USER_RUB = 10 ** 12
+USER_TOKENS = 10 ** 9
+
+
+@dataclass
+class FlowConfig:
+    tickers: int = 2
+    users: int = 20
+    orders: int = 2000
+    market_ratio: float = 0.2
+    cancel_ratio: float = 0.1
+    start_price: int = 1000
+    volatility: float = 0.002
+    spread: float = 0.01
+    max_qty: int = 20
+    seed: int = 42
+
+
+@dataclass
+class Command:
+    kind: str  # 'limit', 'market' или 'cancel'
+    user: int
+    ticker: str
+    direction: str = Direction.BUY
+    qty: int = 0
+    price: Optional[int] = None
+
+
+def ticker_names(config: FlowConfig) -> List[str]:
+    return [f"BENCH{chr(ord('A') + i % 26)}{i // 26 or ''}" for i in range(config.tickers)]
+
+
+def generate_flow(config: FlowConfig) -> Iterator[Command]:
+    """Синтетический поток команд с детерминированным seed"""
+    rnd = random.Random(config.seed)
+    tickers = ticker_names(config)
+    mid = {ticker: float(config.start_price) for ticker in tickers}
+
+    for _ in range(config.orders):
+        ticker = rnd.choice(tickers)
+        user = rnd.randrange(config.users)
+        # Цена блуждает случайно, лимитные заявки выставляются вокруг середины
+        mid[ticker] = max(1.0, mid[ticker] * (1 + rnd.gauss(0, config.volatility)))
+
+        roll = rnd.random()
+        if roll < config.cancel_ratio:
+            yield Command('cancel', user, ticker)
+            continue
+
+        direction = rnd.choice([Direction.BUY, Direction.SELL])
+        qty = rnd.randint(1, config.max_qty)
+        if roll < config.cancel_ratio + config.market_ratio:
+            yield Command('market', user, ticker, direction, qty)
+            continue
+
+        offset = rnd.gauss(0, config.spread) * mid[ticker]
+        # Покупки чаще ниже середины, продажи - выше, но часть заявок пересекает спред
+        price = mid[ticker] - abs(offset) if direction == Direction.BUY else mid[ticker] + abs(offset)
+        if rnd.random() < 0.3:
+            price = mid[ticker] + offset
+        yield Command('limit', user, ticker, direction, qty, max(1, round(price)))
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(values: List[float], scale: float = 1.0, digits: int = 3) -> Dict[str, float]:
+    if not values:
+        return {}
+    return {
+        'mean': round(sum(values) / len(values) * scale, digits),
+        'p50': round(percentile(values, 50) * scale, digits),
+        'p95': round(percentile(values, 95) * scale, digits),
+        'p99': round(percentile(values, 99) * scale, digits),
+        'max': round(max(values) * scale, digits),
+    }
+
+
+@dataclass
+class DriverResult:
+    driver: str
+    orders: int = 0
+    elapsed_sec: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+    queries: List[int] = field(default_factory=list)
+    kinds: Dict[str, int] = field(default_factory=dict)
+    errors: int = 0
+
+    def report(self) -> dict:
+        return {
+            'driver': self.driver,
+            'orders': self.orders,
+            'errors': self.errors,
+            'elapsed_sec': round(self.elapsed_sec, 4),
+            'orders_per_sec': round(self.orders / self.elapsed_sec, 1) if self.elapsed_sec else 0.0,
+            'latency_ms': summarize(self.latencies, scale=1000),
+            'queries_per_order': summarize(self.queries, digits=2),
+            'commands': self.kinds,
+            'fills': Transaction.objects.count(),
+            'resting_orders': LimitOrder.objects.filter(
+                status__in=[OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]
+            ).count(),
+            # Счетчики самого матчинга (order.metrics) по этому прогону
+            'matching': metrics.snapshot(),
+        }
+
+
+class BenchmarkDriver(ABC):
+    """Базовый прогон потока: готовит пользователей и инструменты, меряет каждую команду"""
+    name = ''
+
+    def __init__(self, config: FlowConfig):
+        self.config = config
+        self.users: List[User] = []
+        # Выставленные лимитные ордера пользователей - кандидаты на отмену
+        self.placed: Dict[int, List] = {}
+        self.rnd = random.Random(config.seed + 1)
+
+    def setup(self):
+        reset_books()
+        metrics.reset()
+        tickers = ticker_names(self.config)
+        Instrument.objects.bulk_create(
+            [Instrument(ticker=ticker, name=ticker) for ticker in tickers], ignore_conflicts=True
+        )
+        # bulk_create не шлет сигналов
+        instruments.changed()
+        for i in range(self.config.users):
+            user = User.objects.create_user(name=f'bench-{self.name}-{i}')
+            self.users.append(user)
+        Balance.objects.filter(user__in=self.users, ticker='RUB').update(amount=USER_RUB)
+        Balance.objects.bulk_create([
+            Balance(user=user, ticker=ticker, amount=USER_TOKENS)
+            for user in self.users for ticker in tickers
+        ])
+
+    def cancel_target(self, command: Command):
+        placed = self.placed.get(command.user)
+        if not placed:
+            return None
+        return placed.pop(self.rnd.randrange(len(placed)))
+
+    @abstractmethod
+    def execute(self, command: Command) -> bool:
+        """Выполняет команду потока; False - команда отклонена"""
+
+    def run(self, flow: Iterator[Command]) -> DriverResult:
+        result = DriverResult(self.name)
+        started = time.perf_counter()
+        for command in flow:
+            counter = QueryCounter()
+            with connection.execute_wrapper(counter):
+                t0 = time.perf_counter()
+                ok = self.execute(command)
+                result.latencies.append(time.perf_counter() - t0)
+            result.queries.append(counter.count)
+            result.orders += 1
+            result.kinds[command.kind] = result.kinds.get(command.kind, 0) + 1
+            if not ok:
+                result.errors += 1
+        result.elapsed_sec = time.perf_counter() - started
+        return result
+
+
+class MatcherDriver(BenchmarkDriver):
+    """Движок без HTTP: те же OrderView._place_order и OrderDetailView._cancel_limit_order, что и у API"""
+    name = 'matcher'
+
+    def execute(self, command: Command) -> bool:
+        user = self.users[command.user]
+        if command.kind == 'cancel':
+            order_id = self.cancel_target(command)
+            if order_id is None:
+                return True
+            order = LimitOrder.objects.get(id=order_id)
+            if order.status not in [OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]:
+                return True
+            OrderDetailView._cancel_limit_order(order)
+            return True
+
+        data = {'ticker': command.ticker, 'direction': command.direction, 'qty': command.qty}
+        if command.kind == 'limit':
+            data['price'] = command.price
+        try:
+            order, transactions = OrderView()._place_order(user, data)
+        except OrderRejected:
+            return False
+        if command.kind == 'limit':
+            self.placed.setdefault(command.user, []).append(order.id)
+            return True
+        return bool(transactions)
+
+
+class HTTPDriver(BenchmarkDriver):
+    """Полный путь запроса: аутентификация, сериализатор, очередь тикера, матчинг"""
+    name = 'http'
+
+    def setup(self):
+        super().setup()
+        self.client = Client()
+
+    def headers(self, user: User) -> dict:
+        return {'HTTP_AUTHORIZATION': f'TOKEN {user.api_key}'}
+
+    def execute(self, command: Command) -> bool:
+        user = self.users[command.user]
+        if command.kind == 'cancel':
+            order_id = self.cancel_target(command)
+            if order_id is None:
+                return True
+            response = self.client.delete(f'/api/v1/order/{order_id}', **self.headers(user))
+            return response.status_code in (200, 400)
+
+        body = {'direction': command.direction, 'ticker': command.ticker, 'qty': command.qty}
+        if command.kind == 'limit':
+            body['price'] = command.price
+        response = self.client.post('/api/v1/order', body, content_type='application/json', **self.headers(user))
+        if response.status_code != 200:
+            return False
+        if command.kind == 'limit':
+            self.placed.setdefault(command.user, []).append(response.json()['order_id'])
+        return True
+
+
+DRIVERS = {
+    MatcherDriver.name: MatcherDriver,
+    HTTPDriver.name: HTTPDriver,
+}
@@ -0,0 +1,412 @@
+"""
+Биржевой стакан в памяти процесса.
+
+Для каждого тикера хранится отсортированный список ценовых уровней,
+на каждом уровне - FIFO-очередь активных лимитных ордеров (Price-Time Priority).
+Стакан загружается при первом обращении к тикеру из снимка и журнала (order.journal)
+или из таблицы limit_orders, дальше все решения о матчинге принимаются по нему, а в базу пишутся только
+результаты (ордера, сделки, балансы).
+"""
+import bisect
+import threading
+import uuid
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Set
+
+from django.db.models import F
+
+from .models import BookVersion, LimitOrder, Direction, OrderStatus
+
+ACTIVE_STATUSES = [OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]
+
+
+class BookOrder:
+    """Активный лимитный ордер в стакане"""
+    __slots__ = ('id', 'user_id', 'direction', 'price', 'qty', 'filled', 'timestamp')
+
+    def __init__(self, id, user_id, direction: str, price: int, qty: int, filled: int = 0, timestamp=None):
+        self.id = id
+        self.user_id = user_id
+        self.direction = direction
+        self.price = price
+        self.qty = qty
+        self.filled = filled
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_model(cls, order: LimitOrder) -> 'BookOrder':
+        return cls(
+            id=order.id,
+            user_id=order.user_id,
+            direction=order.direction,
+            price=order.price,
+            qty=order.qty,
+            filled=order.filled,
+            timestamp=order.timestamp
+        )
+
+    @property
+    def remaining(self) -> int:
+        return self.qty - self.filled
+
+    @property
+    def status(self) -> str:
+        if self.filled >= self.qty:
+            return OrderStatus.EXECUTED
+        if self.filled > 0:
+            return OrderStatus.PARTIALLY_EXECUTED
+        return OrderStatus.NEW
+
+    def __repr__(self):
+        return f"<BookOrder {self.id} {self.direction} {self.remaining}@{self.price}>"
+
+
+class BookSide:
+    """
+    Одна сторона стакана.
+    Уровни хранятся по ключу, отсортированному по возрастанию так,
+    что лучшая цена всегда первая: для ask ключ - цена, для bid - цена со знаком минус.
+    """
+
+    def __init__(self, direction: str):
+        self.direction = direction
+        self.levels: Dict[int, Deque[BookOrder]] = {}
+        # Суммарный неисполненный объем уровня, обновляется при каждом изменении стакана
+        self.volumes: Dict[int, int] = {}
+        # Цены уровней, изменившихся с последней рассылки (order.stream)
+        self.changed: Set[int] = set()
+        self._keys: List[int] = []
+
+    def _key(self, price: int) -> int:
+        return -price if self.direction == Direction.BUY else price
+
+    def _price(self, key: int) -> int:
+        return -key if self.direction == Direction.BUY else key
+
+    def add(self, order: BookOrder):
+        level = self.levels.get(order.price)
+        if level is None:
+            level = self.levels[order.price] = deque()
+            self.volumes[order.price] = 0
+            bisect.insort(self._keys, self._key(order.price))
+        level.append(order)
+        self.volumes[order.price] += order.remaining
+        self.changed.add(order.price)
+
+    def remove(self, order: BookOrder):
+        level = self.levels.get(order.price)
+        if level is None:
+            return
+        try:
+            level.remove(order)
+        except ValueError:
+            return
+        self.changed.add(order.price)
+        if not level:
+            del self.levels[order.price]
+            del self.volumes[order.price]
+            key = self._key(order.price)
+            del self._keys[bisect.bisect_left(self._keys, key)]
+        else:
+            self.volumes[order.price] -= order.remaining
+
+    def reduce(self, order: BookOrder, qty: int):
+        """Учитывает исполнение qty ордера этой стороны в объеме его уровня"""
+        if order.price in self.volumes:
+            self.volumes[order.price] -= qty
+            self.changed.add(order.price)
+
+    def changed_levels(self) -> List[dict]:
+        """Изменившиеся уровни от лучшей цены к худшей, у исчезнувших уровней объем 0"""
+        return [
+            {'price': price, 'qty': self.volumes.get(price, 0)}
+            for price in sorted(self.changed, reverse=self.direction == Direction.BUY)
+        ]
+
+    def depth(self, limit: Optional[int]) -> List[dict]:
+        """Лучшие limit уровней (None - все): цена и неисполненный объем"""
+        return [
+            {'price': self._price(key), 'qty': self.volumes[self._price(key)]}
+            for key in self._keys[:limit]
+        ]
+
+    def prices(self) -> Iterator[int]:
+        """
+        Цены уровней от лучшей к худшей.
+        Итерация устойчива к удалению уровней по ходу исполнения:
+        следующий уровень ищется бинарным поиском от последнего пройденного ключа.
+        """
+        last = None
+        while True:
+            pos = 0 if last is None else bisect.bisect_right(self._keys, last)
+            if pos >= len(self._keys):
+                return
+            last = self._keys[pos]
+            yield self._price(last)
+
+    def __iter__(self) -> Iterator[BookOrder]:
+        """Ордера в порядке приоритета исполнения"""
+        for price in self.prices():
+            level = self.levels.get(price)
+            if not level:
+                continue
+            for order in list(level):
+                if order.remaining > 0:
+                    yield order
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class OrderBook:
+    """Стакан одного инструмента"""
+
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.bids = BookSide(Direction.BUY)
+        self.asks = BookSide(Direction.SELL)
+        self.orders: Dict[object, BookOrder] = {}
+        # Все изменения и чтения стакана выполняются под этой блокировкой
+        self.lock = threading.RLock()
+        # Версия стакана: epoch различает экземпляры (после перезагрузки стакана),
+        # seq растет при каждом изменении
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        # Версия стакана в базе (BookVersion) после последнего изменения
+        self.db_version = 0
+
+    def side(self, direction: str) -> BookSide:
+        return self.bids if direction == Direction.BUY else self.asks
+
+    def opposite(self, direction: str) -> BookSide:
+        return self.asks if direction == Direction.BUY else self.bids
+
+    def add(self, order: BookOrder):
+        # Ордер мог попасть в стакан при его загрузке из базы - заменяем прежнюю запись
+        self.remove(order.id)
+        self.orders[order.id] = order
+        self.side(order.direction).add(order)
+        self.seq += 1
+
+    def remove(self, order_id) -> Optional[BookOrder]:
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            self.side(order.direction).remove(order)
+            self.seq += 1
+        return order
+
+    def fill(self, order: BookOrder, qty: int):
+        """Уменьшает остаток ордера, полностью исполненный ордер уходит из стакана"""
+        self.side(order.direction).reduce(order, qty)
+        order.filled += qty
+        self.seq += 1
+        if order.remaining <= 0:
+            self.remove(order.id)
+
+    def matching(self, direction: str, user_id, limit_price: Optional[int] = None) -> Iterator[BookOrder]:
+        """
+        Встречные ордера для заявки с направлением direction в порядке Price-Time Priority.
+        Собственные ордера пользователя пропускаются, но остаются в стакане.
+        limit_price ограничивает цену: для BUY - не выше, для SELL - не ниже.
+        """
+        for resting in self.opposite(direction):
+            if limit_price is not None:
+                if direction == Direction.BUY and resting.price > limit_price:
+                    return
+                if direction == Direction.SELL and resting.price < limit_price:
+                    return
+            if resting.user_id == user_id:
+                continue
+            yield resting
+
+    def etag(self, limit: int) -> str:
+        """ETag агрегированного стакана: меняется при любом изменении стакана"""
+        return f'"{self.epoch}:{self.seq}:{limit}"'
+
+    def l2(self, limit: Optional[int]) -> dict:
+        """Агрегированный по ценам стакан (L2), limit лучших уровней с каждой стороны"""
+        with self.lock:
+            return {
+                'bid_levels': self.bids.depth(limit),
+                'ask_levels': self.asks.depth(limit),
+            }
+
+    def has_liquidity(self, direction: str, user_id) -> bool:
+        return next(self.matching(direction, user_id), None) is not None
+
+    def advance_db_version(self) -> int:
+        """
+        Следующая версия стакана; пишется в базу в транзакции изменения (под блокировкой стакана,
+        матчингом владеет один процесс, поэтому версия в памяти совпадает с версией в базе)
+        """
+        self.db_version += 1
+        if not BookVersion.objects.filter(ticker=self.ticker).update(version=self.db_version):
+            BookVersion.objects.create(ticker=self.ticker, version=self.db_version)
+        return self.db_version
+
+    def load(self):
+        """Загружает активные лимитные ордера тикера из базы"""
+        self.bids = BookSide(Direction.BUY)
+        self.asks = BookSide(Direction.SELL)
+        self.orders = {}
+        self.seq += 1
+        # Версия читается до ордеров: изменение между чтениями только сделает версию старее ордеров
+        self.db_version = db_version(self.ticker)
+        active_orders = (
+            LimitOrder.objects
+            .filter(ticker=self.ticker, status__in=ACTIVE_STATUSES)
+            .order_by('timestamp')
+            .only('id', 'user', 'direction', 'price', 'qty', 'filled', 'timestamp')
+        )
+        for order in active_orders.iterator(chunk_size=2000):
+            if order.qty > order.filled:
+                self.add(BookOrder.from_model(order))
+
+
+class DepthWalk:
+    """
+    Проход по встречной стороне стакана в порядке приоритета ровно до нужного объема.
+    За один проход считает исполнимый объем и стоимость, а найденные ордера
+    служат курсором для последующего исполнения.
+    """
+
+    def __init__(self, book: OrderBook, direction: str, user_id, qty: int, limit_price: Optional[int] = None):
+        self.qty = qty
+        self.filled_qty = 0
+        self.cost = 0
+        self.orders: List[BookOrder] = []
+        # Сколько собственных ордеров пользователя пропущено по пути
+        self.skipped = 0
+        for resting in book.matching(direction, None, limit_price):
+            if resting.user_id == user_id:
+                self.skipped += 1
+                continue
+            take = min(qty - self.filled_qty, resting.remaining)
+            self.orders.append(resting)
+            self.filled_qty += take
+            self.cost += take * resting.price
+            if self.filled_qty >= qty:
+                break
+
+    @property
+    def fillable(self) -> bool:
+        """Хватает ли встречных ордеров на весь объем"""
+        return self.filled_qty >= self.qty
+
+    @property
+    def user_ids(self) -> set:
+        return {resting.user_id for resting in self.orders}
+
+    def __iter__(self) -> Iterator[BookOrder]:
+        return iter(self.orders)
+
+
+class LevelWalk:
+    """
+    Оценка рыночной заявки по агрегированным уровням встречной стороны - тот же проход,
+    что у DepthWalk, но без пользователя (собственные ордера не пропускаются).
+    Стакан не блокируется и не меняется: уровни читаются на ходу, поэтому при параллельном
+    исполнении оценка может отражать промежуточное состояние стакана
+    """
+
+    def __init__(self, book: OrderBook, direction: str, qty: int, limit_price: Optional[int] = None):
+        self.qty = qty
+        self.filled_qty = 0
+        self.cost = 0
+        self.levels = 0
+        self.worst_price: Optional[int] = None
+        side = book.opposite(direction)
+        try:
+            for price in side.prices():
+                if limit_price is not None:
+                    if direction == Direction.BUY and price > limit_price:
+                        break
+                    if direction == Direction.SELL and price < limit_price:
+                        break
+                volume = side.volumes.get(price, 0)
+                if volume <= 0:
+                    continue
+                take = min(qty - self.filled_qty, volume)
+                self.filled_qty += take
+                self.cost += take * price
+                self.levels += 1
+                self.worst_price = price
+                if self.filled_qty >= qty:
+                    break
+        except IndexError:
+            # Уровни удалены параллельным исполнением посреди прохода - оценка по пройденным
+            pass
+
+    @property
+    def fillable(self) -> bool:
+        return self.filled_qty >= self.qty
+
+    @property
+    def average_price(self) -> Optional[float]:
+        return round(self.cost / self.filled_qty, 4) if self.filled_qty else None
+
+
+_books: Dict[str, OrderBook] = {}
+_books_lock = threading.Lock()
+
+
+def get_book(ticker: str) -> OrderBook:
+    """Возвращает стакан тикера, при первом обращении загружает его из базы"""
+    book = _books.get(ticker)
+    if book is not None:
+        return book
+    with _books_lock:
+        book = _books.get(ticker)
+        if book is None:
+            from .journal import journal
+
+            # Быстрый путь - снимок и хвост журнала, иначе все активные ордера из базы
+            book = journal.recovered_book(ticker)
+            if book is None:
+                book = OrderBook(ticker)
+                book.load()
+            _books[ticker] = book
+        return book
+
+
+def loaded_book(ticker: str) -> Optional[OrderBook]:
+    """Стакан тикера, если он уже загружен в этом процессе"""
+    return _books.get(ticker)
+
+
+def db_version(ticker: str) -> int:
+    """Версия стакана тикера в базе"""
+    return BookVersion.objects.filter(ticker=ticker).values_list('version', flat=True).first() or 0
+
+
+def bump_db_version(ticker: str):
+    """
+    Увеличивает версию стакана в базе, не зная стакана в памяти (он не загружен или сброшен):
+    снимок и журнал с прежней версией с базой больше не сойдутся
+    """
+    if not BookVersion.objects.filter(ticker=ticker).update(version=F('version') + 1):
+        BookVersion.objects.create(ticker=ticker, version=1)
+
+
+def invalidate_book(ticker: str):
+    """
+    Сбрасывает стакан тикера, он будет перечитан из базы при следующем обращении.
+    Вызывается, когда транзакция матчинга откатилась и стакан мог разойтись с базой.
+    """
+    from .journal import journal, reset_event
+
+    # Изменения вне журнала (например, ордер, созданный до упавшего матчинга) остаются в базе
+    bump_db_version(ticker)
+    with _books_lock:
+        _books.pop(ticker, None)
+        # В снимок мог попасть стакан с изменениями откатившейся транзакции
+        journal.log_now([reset_event(ticker)])
+
+
+def loaded_books() -> List[OrderBook]:
+    return list(_books.values())
+
+
+def reset_books():
+    with _books_lock:
+        _books.clear()
@@ -0,0 +1,101 @@
+"""
+Свечи (OHLCV) по сделкам.
+
+Свечи всех интервалов обновляются в той же транзакции, что и сделки
+(Settlement.commit): сделки одной команды группируются по свечам в памяти,
+затем все затронутые свечи обновляются одним UPDATE, а отсутствующие создаются.
+График читает готовые свечи, а не таблицу transactions.
+"""
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Tuple
+
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Greatest, Least
+
+from .models import Candle, CandleInterval, Transaction
+
+INTERVAL_SECONDS = {
+    CandleInterval.MINUTE: 60,
+    CandleInterval.FIVE_MINUTES: 5 * 60,
+    CandleInterval.HOUR: 60 * 60,
+    CandleInterval.DAY: 24 * 60 * 60,
+}
+
+
+@dataclass
+class Bar:
+    open: int
+    high: int
+    low: int
+    close: int
+    volume: int
+    trades: int
+
+    def add(self, price: int, amount: int):
+        self.high = max(self.high, price)
+        self.low = min(self.low, price)
+        self.close = price
+        self.volume += amount
+        self.trades += 1
+
+
+def bucket_start(timestamp: datetime, seconds: int) -> datetime:
+    """Начало интервала длиной seconds, в который попадает timestamp (отсчет от эпохи UTC)"""
+    epoch = int(timestamp.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % seconds, tz=timezone.utc)
+
+
+def aggregate(trades: Iterable[Transaction]) -> Dict[Tuple[str, datetime], Bar]:
+    """Сделки (в порядке исполнения) по свечам всех интервалов: {(interval, start): Bar}"""
+    bars: Dict[Tuple[str, datetime], Bar] = {}
+    for trade in trades:
+        for interval, seconds in INTERVAL_SECONDS.items():
+            key = (interval, bucket_start(trade.timestamp, seconds))
+            bar = bars.get(key)
+            if bar is None:
+                bars[key] = Bar(trade.price, trade.price, trade.price, trade.price, trade.amount, 1)
+            else:
+                bar.add(trade.price, trade.amount)
+    return bars
+
+
+def record_trades(ticker: str, trades: Iterable[Transaction]):
+    """
+    Добавляет сделки к свечам тикера. Вызывается внутри транзакции матчинга,
+    команды одного тикера выполняются по очереди, поэтому свечи тикера не меняются параллельно
+    """
+    bars = aggregate(trades)
+    if not bars:
+        return
+
+    condition = Q()
+    high_whens, low_whens, close_whens, volume_whens, trades_whens = [], [], [], [], []
+    for (interval, start), bar in bars.items():
+        match = Q(interval=interval, start=start)
+        condition |= match
+        high_whens.append(When(match, then=Greatest(F('high'), Value(bar.high))))
+        low_whens.append(When(match, then=Least(F('low'), Value(bar.low))))
+        close_whens.append(When(match, then=Value(bar.close)))
+        volume_whens.append(When(match, then=F('volume') + bar.volume))
+        trades_whens.append(When(match, then=F('trades') + bar.trades))
+
+    candles = Candle.objects.filter(Q(ticker=ticker) & condition)
+    updated = candles.update(
+        high=Case(*high_whens),
+        low=Case(*low_whens),
+        close=Case(*close_whens),
+        volume=Case(*volume_whens),
+        trades=Case(*trades_whens)
+    )
+    if updated == len(bars):
+        return
+
+    # Первые сделки интервала - свечи создаются
+    existing = set(candles.values_list('interval', 'start'))
+    Candle.objects.bulk_create([
+        Candle(ticker=ticker, interval=interval, start=start, open=bar.open, high=bar.high,
+               low=bar.low, close=bar.close, volume=bar.volume, trades=bar.trades)
+        for (interval, start), bar in bars.items()
+        if (interval, start) not in existing
+    ])
@@ -0,0 +1,63 @@
+"""
+Быстрая сборка ответов со списками ордеров.
+
+LimitOrderSerializer/MarketOrderSerializer строят вложенный body через source='*'
+и пересобирают словарь в to_representation - на тысячах ордеров это основная часть
+времени запроса. Здесь строки берутся из базы кортежами (.values_list) по заранее
+заданным столбцам и сразу раскладываются в словари того же вида, что у сериализаторов.
+"""
+from datetime import datetime
+from typing import List
+
+from django.db.models import QuerySet
+from django.utils import timezone
+
+# Порядок столбцов совпадает с распаковкой в encode_*
+LIMIT_ORDER_COLUMNS = ('id', 'status', 'user_id', 'timestamp', 'filled', 'direction', 'ticker', 'qty', 'price')
+MARKET_ORDER_COLUMNS = ('id', 'status', 'user_id', 'timestamp', 'direction', 'ticker', 'qty')
+
+
+def _datetime_formatter():
+    """Форматирование времени как у DateTimeField из DRF: текущая зона, UTC - с суффиксом Z"""
+    current = timezone.get_current_timezone()
+
+    def format_datetime(value: datetime) -> str:
+        value = value.astimezone(current).isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+
+    return format_datetime
+
+
+def encode_limit_orders(orders: QuerySet) -> List[dict]:
+    """То же, что LimitOrderSerializer(orders, many=True).data"""
+    format_datetime = _datetime_formatter()
+    return [
+        {
+            'id': str(order_id),
+            'status': status,
+            'user_id': str(user_id),
+            'timestamp': format_datetime(timestamp),
+            'filled': filled,
+            'body': {'direction': direction, 'ticker': ticker, 'qty': qty, 'price': price},
+        }
+        for order_id, status, user_id, timestamp, filled, direction, ticker, qty, price
+        in orders.values_list(*LIMIT_ORDER_COLUMNS)
+    ]
+
+
+def encode_market_orders(orders: QuerySet) -> List[dict]:
+    """То же, что MarketOrderSerializer(orders, many=True).data"""
+    format_datetime = _datetime_formatter()
+    return [
+        {
+            'id': str(order_id),
+            'status': status,
+            'user_id': str(user_id),
+            'timestamp': format_datetime(timestamp),
+            'body': {'direction': direction, 'ticker': ticker, 'qty': qty},
+        }
+        for order_id, status, user_id, timestamp, direction, ticker, qty
+        in orders.values_list(*MARKET_ORDER_COLUMNS)
+    ]
@@ -0,0 +1,85 @@
+"""
+Справочник инструментов в памяти процесса.
+
+Инструменты меняются редко, а проверяются почти в каждом запросе, поэтому
+справочник читается из базы один раз и дальше отдается из памяти.
+Изменения инструментов (сигналы post_save/post_delete) записывают новую версию
+в общий кэш (CACHES['default'], общий для процессов сервера); каждый процесс
+сверяет свою версию с общей не чаще раза в INSTRUMENT_REGISTRY['CHECK_INTERVAL'] секунд
+и при расхождении перечитывает справочник.
+"""
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import Http404
+
+from .models import Instrument
+
+VERSION_KEY = 'instruments:version'
+
+
+def registry_settings() -> dict:
+    return getattr(settings, 'INSTRUMENT_REGISTRY', {})
+
+
+class InstrumentRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._instruments: Optional[Dict[str, Instrument]] = None
+        self._version: Optional[str] = None
+        self._checked_at = 0.0
+
+    def _current(self) -> Dict[str, Instrument]:
+        instruments = self._instruments
+        if (instruments is not None
+                and time.monotonic() - self._checked_at < registry_settings().get('CHECK_INTERVAL', 0)):
+            return instruments
+        with self._lock:
+            # Версия читается до базы: изменение, закоммиченное после чтения версии, вызовет еще одну перезагрузку
+            version = cache.get(VERSION_KEY)
+            if self._instruments is None or version != self._version:
+                self._instruments = {instrument.ticker: instrument for instrument in Instrument.objects.all()}
+                self._version = version
+            self._checked_at = time.monotonic()
+            return self._instruments
+
+    def all(self) -> List[Instrument]:
+        return list(self._current().values())
+
+    def get(self, ticker: str) -> Optional[Instrument]:
+        return self._current().get(ticker)
+
+    def exists(self, ticker: str) -> bool:
+        return ticker in self._current()
+
+    def get_or_404(self, ticker: str) -> Instrument:
+        instrument = self.get(ticker)
+        if instrument is None:
+            raise Http404("No Instrument matches the given query.")
+        return instrument
+
+    def reset(self):
+        """Сбрасывает справочник этого процесса"""
+        with self._lock:
+            self._instruments = None
+
+    def changed(self):
+        """
+        Инструменты изменены: этот процесс сбрасывает справочник сразу,
+        а остальные воркеры - после коммита, по новой версии в общем кэше
+        """
+        self.reset()
+
+        def publish():
+            self.reset()
+            cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+        transaction.on_commit(publish)
+
+
+instruments = InstrumentRegistry()
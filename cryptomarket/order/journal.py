@@ -0,0 +1,393 @@
+"""
+Журнал матчинга и снимки стаканов.
+
+Каждая принятая заявка, сделка и отмена дописывается строкой JSON в журнал (JSONL)
+после коммита своей транзакции. Запись идет в буфер ОС сразу, а fsync выполняется
+пачками - раз в FSYNC_EVERY записей или FSYNC_INTERVAL секунд.
+Каждые SNAPSHOT_EVERY записей в фоне пишется снимок загруженных стаканов,
+после чего журнал до снимка больше не нужен и удаляется.
+
+После перезапуска стакан тикера восстанавливается из последнего снимка и хвоста журнала,
+а не из всех активных LimitOrder. Каждая транзакция, меняющая стакан, увеличивает его версию
+в базе (BookVersion), записи журнала и снимок несут эту версию. Восстановленный стакан сверяется
+с базой одним чтением версии; при расхождении (например, хвост журнала потерян при сбое ОС
+или стакан менялся без журнала) стакан, как и раньше, загружается из базы целиком.
+Изменения limit_orders в обход матчинга (ручной SQL) версию не меняют - после них нужен
+invalidate_book, который ее увеличивает.
+
+Каталогом журнала владеет один процесс: он держит блокировку файла OWNER_LOCK.
+Процесс, не получивший блокировку, работает без журнала и загружает стаканы из базы.
+
+Записи хранят итоговые значения (filled после сделки), а не приращения, поэтому
+повторное применение записи, уже попавшей в снимок, ничего не меняет.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .book import ACTIVE_STATUSES, BookOrder, OrderBook, db_version
+
+logger = logging.getLogger('matching')
+
+SNAPSHOT_NAME = 'snapshot.json'
+OWNER_LOCK = 'owner.lock'
+SEGMENT_PREFIX = 'journal-'
+SEGMENT_SUFFIX = '.jsonl'
+
+
+def journal_settings() -> dict:
+    return getattr(settings, 'MATCHING_JOURNAL', {})
+
+
+def _timestamp(value) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def order_event(order) -> dict:
+    """Принятая заявка с итоговым исполнением (пишется после матчинга)"""
+    price = getattr(order, 'price', None)
+    return {
+        't': 'order',
+        'ticker': order.ticker,
+        'id': str(order.id),
+        'kind': 'market' if price is None else 'limit',
+        'user': str(order.user_id),
+        'dir': order.direction,
+        'qty': order.qty,
+        'price': price,
+        'filled': order.filled,
+        'status': order.status,
+        'ts': _timestamp(order.timestamp),
+    }
+
+
+def fill_event(ticker: str, resting: BookOrder, taker_id, qty: int) -> dict:
+    """Сделка с ордером из стакана; filled - исполнение встречного ордера после сделки"""
+    return {
+        't': 'fill',
+        'ticker': ticker,
+        'maker': str(resting.id),
+        'taker': str(taker_id),
+        'qty': qty,
+        'price': resting.price,
+        'filled': resting.filled,
+    }
+
+
+def cancel_event(ticker: str, order_id) -> dict:
+    return {'t': 'cancel', 'ticker': ticker, 'id': str(order_id)}
+
+
+def reset_event(ticker: str) -> dict:
+    """Стакан тикера сброшен и будет перечитан из базы"""
+    return {'t': 'reset', 'ticker': ticker}
+
+
+def apply_event(books: Dict[str, OrderBook], event: dict):
+    """Применяет запись журнала к восстанавливаемым стаканам"""
+    kind = event['t']
+    ticker = event['ticker']
+    if kind == 'reset':
+        books.pop(ticker, None)
+        return
+
+    book = books.get(ticker)
+    if book is None:
+        # Тикера нет в снимке - его стакан загрузится из базы
+        return
+
+    if kind == 'order':
+        order_id = uuid.UUID(event['id'])
+        existing = book.orders.get(order_id)
+        if existing is not None:
+            # Ордер уже есть в снимке: не переставляем его в конец очереди уровня
+            if event['filled'] > existing.filled:
+                book.fill(existing, event['filled'] - existing.filled)
+            if event['status'] not in ACTIVE_STATUSES:
+                book.remove(order_id)
+        elif event['kind'] == 'limit' and event['status'] in ACTIVE_STATUSES and event['qty'] > event['filled']:
+            book.add(BookOrder(
+                id=order_id,
+                user_id=uuid.UUID(event['user']),
+                direction=event['dir'],
+                price=event['price'],
+                qty=event['qty'],
+                filled=event['filled'],
+                timestamp=datetime.fromisoformat(event['ts']) if event['ts'] else None
+            ))
+    elif kind == 'fill':
+        resting = book.orders.get(uuid.UUID(event['maker']))
+        if resting is not None and event['filled'] > resting.filled:
+            book.fill(resting, event['filled'] - resting.filled)
+    elif kind == 'cancel':
+        book.remove(uuid.UUID(event['id']))
+    if 'v' in event:
+        book.db_version = event['v']
+
+
+def dump_book(book: OrderBook) -> dict:
+    """Версия и ордера стакана в порядке приоритета - при загрузке очереди уровней сохраняются"""
+    with book.lock:
+        return {
+            'version': book.db_version,
+            'orders': [
+                [str(o.id), str(o.user_id), o.direction, o.price, o.qty, o.filled, _timestamp(o.timestamp)]
+                for side in (book.bids, book.asks) for o in side
+            ],
+        }
+
+
+def restore_book(ticker: str, data: dict) -> OrderBook:
+    book = OrderBook(ticker)
+    book.db_version = data['version']
+    for order_id, user_id, direction, price, qty, filled, ts in data['orders']:
+        book.add(BookOrder(
+            id=uuid.UUID(order_id),
+            user_id=uuid.UUID(user_id),
+            direction=direction,
+            price=price,
+            qty=qty,
+            filled=filled,
+            timestamp=datetime.fromisoformat(ts) if ts else None
+        ))
+    return book
+
+
+def matches_database(book: OrderBook) -> bool:
+    """Восстановленный стакан отражает все изменения в базе: его версия совпадает с версией в базе"""
+    return book.db_version == db_version(book.ticker)
+
+
+class Journal:
+    """Журнал и снимки в каталоге MATCHING_JOURNAL['DIR']"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._file = None
+        self._seq = 0
+        self._unsynced = 0
+        self._synced_at = 0.0
+        self._since_snapshot = 0
+        self._snapshot_thread: Optional[threading.Thread] = None
+        # Восстановленные, но еще не запрошенные стаканы; None - восстановление еще не выполнялось
+        self._recovered: Optional[Dict[str, OrderBook]] = None
+        # Файл блокировки каталога; None - блокировка еще не запрашивалась
+        self._owner = None
+
+    @property
+    def enabled(self) -> bool:
+        return journal_settings().get('ENABLED', False) and self._acquire()
+
+    def _acquire(self) -> bool:
+        """
+        Блокировка каталога журнала на время жизни процесса. Снимок удаляет чужие файлы журнала,
+        поэтому пишет в каталог только процесс, получивший блокировку
+        """
+        if self._owner is None:
+            with self._lock:
+                if self._owner is None:
+                    self.directory.mkdir(parents=True, exist_ok=True)
+                    lock_file = open(self.directory / OWNER_LOCK, 'a')
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        lock_file.close()
+                        logger.warning("Journal directory %s is owned by another process, "
+                                       "order books are loaded from the database", self.directory)
+                        lock_file = False
+                    self._owner = lock_file
+        return bool(self._owner)
+
+    @property
+    def directory(self) -> Path:
+        return Path(journal_settings()['DIR'])
+
+    def _segments(self) -> List[Path]:
+        """Файлы журнала по возрастанию первого номера записи"""
+        if not self.directory.exists():
+            return []
+        return sorted(self.directory.glob(f'{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}'))
+
+    @staticmethod
+    def _read_segment(path: Path) -> Iterator[dict]:
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Недописанная последняя строка после сбоя
+                    return
+
+    def _read_snapshot(self) -> dict:
+        path = self.directory / SNAPSHOT_NAME
+        if not path.exists():
+            return {'seq': 0, 'books': {}}
+        with open(path, 'rb') as f:
+            return json.load(f)
+
+    # Восстановление
+
+    def _recover(self):
+        """Снимок + записи журнала после него; выполняется один раз за процесс"""
+        snapshot = self._read_snapshot()
+        books = {ticker: restore_book(ticker, data) for ticker, data in snapshot['books'].items()}
+        last_seq = snapshot['seq']
+        for path in self._segments():
+            for event in self._read_segment(path):
+                if event['seq'] > snapshot['seq']:
+                    apply_event(books, event)
+                last_seq = max(last_seq, event['seq'])
+        self._recovered = books
+        self._seq = last_seq
+
+    def recovered_book(self, ticker: str) -> Optional[OrderBook]:
+        """
+        Стакан тикера из снимка и журнала, если он сходится с базой.
+        None - стакан нужно загрузить из базы
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            if self._recovered is None:
+                self._recover()
+            book = self._recovered.pop(ticker, None)
+        if book is not None and not matches_database(book):
+            logger.warning("Journal: order book %s does not match the database, loading it from the database", ticker)
+            return None
+        return book
+
+    # Запись
+
+    def _open_segment(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f'{SEGMENT_PREFIX}{self._seq + 1:012d}{SEGMENT_SUFFIX}'
+        self._file = open(path, 'ab')
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def append(self, events: Iterable[dict]):
+        """Дописывает записи в журнал под очередными номерами"""
+        options = journal_settings()
+        with self._lock:
+            if self._recovered is None:
+                self._recover()
+            if self._file is None:
+                self._open_segment()
+            lines = []
+            for event in events:
+                self._seq += 1
+                event['seq'] = self._seq
+                lines.append(json.dumps(event, separators=(',', ':')).encode() + b'\n')
+                # Записи после восстановления относятся и к еще не запрошенным стаканам
+                apply_event(self._recovered, event)
+            if not lines:
+                return
+            self._file.write(b''.join(lines))
+            self._file.flush()
+            self._unsynced += len(lines)
+            if (self._unsynced >= options.get('FSYNC_EVERY', 1)
+                    or time.monotonic() - self._synced_at >= options.get('FSYNC_INTERVAL', 0)):
+                self._sync()
+
+            self._since_snapshot += len(lines)
+            snapshot_every = options.get('SNAPSHOT_EVERY')
+            if snapshot_every and self._since_snapshot >= snapshot_every and not self._snapshot_running():
+                self._since_snapshot = 0
+                self._snapshot_thread = threading.Thread(target=self.snapshot, name='journal-snapshot', daemon=True)
+                self._snapshot_thread.start()
+
+    def log(self, events: List[dict], book: Optional[OrderBook] = None):
+        """
+        Записывает события после коммита текущей транзакции (при откате они не попадут в журнал).
+        book - стакан, который изменили события: его версия растет в базе в этой же транзакции
+        (и при выключенном журнале - иначе снимок, записанный до выключения, сошелся бы с базой),
+        события получают новую версию
+        """
+        if book is not None:
+            version = book.advance_db_version()
+            for event in events:
+                event['v'] = version
+        if self.enabled and events:
+            transaction.on_commit(lambda: self.append(events))
+
+    def log_now(self, events: List[dict]):
+        """Записывает события сразу, вне транзакции"""
+        if self.enabled and events:
+            self.append(events)
+
+    def _snapshot_running(self) -> bool:
+        return self._snapshot_thread is not None and self._snapshot_thread.is_alive()
+
+    def snapshot(self):
+        """
+        Пишет снимок загруженных стаканов и удаляет журнал до него.
+        Сначала начинается новый файл журнала: все, что записано до него, уже отражено в стаканах.
+        Стаканы блокируются по одному, поэтому снимок можно делать на ходу
+        """
+        from .book import loaded_books
+
+        with self._snapshot_lock:
+            self._write_snapshot(loaded_books())
+
+    def _write_snapshot(self, loaded: List[OrderBook]):
+        with self._lock:
+            if self._recovered is None:
+                self._recover()
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+            seq = self._seq
+            self._open_segment()
+            # Еще не запрошенные стаканы меняются только под блокировкой журнала
+            books = {ticker: dump_book(book) for ticker, book in self._recovered.items()}
+
+        for book in loaded:
+            books[book.ticker] = dump_book(book)
+
+        path = self.directory / SNAPSHOT_NAME
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'seq': seq, 'created': timezone.now().isoformat(), 'books': books}, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        current = f'{SEGMENT_PREFIX}{seq + 1:012d}{SEGMENT_SUFFIX}'
+        for segment in self._segments():
+            if segment.name < current:
+                segment.unlink()
+
+    def close(self):
+        """
+        При остановке процесса, который писал в журнал, делает снимок,
+        чтобы следующий запуск не читал хвост журнала
+        """
+        with self._lock:
+            if self._file is None:
+                return
+        self.snapshot()
+        with self._lock:
+            self._sync()
+            self._file.close()
+            self._file = None
+
+
+journal = Journal()
+atexit.register(journal.close)
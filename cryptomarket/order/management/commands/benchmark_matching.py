@@ -0,0 +1,102 @@
+import json
+import logging
+import platform
+from dataclasses import asdict
+
+import django
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from order import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Бенчмарк матчинга на синтетическом потоке заявок. "
+        "Работает на отдельной тестовой базе, результат - JSON для сравнения прогонов"
+    )
+
+    def add_arguments(self, parser):
+        defaults = benchmark.FlowConfig()
+        parser.add_argument('--driver', choices=['all', *benchmark.DRIVERS], default='all')
+        parser.add_argument('--tickers', type=int, default=defaults.tickers)
+        parser.add_argument('--users', type=int, default=defaults.users)
+        parser.add_argument('--orders', type=int, default=defaults.orders)
+        parser.add_argument('--market-ratio', type=float, default=defaults.market_ratio)
+        parser.add_argument('--cancel-ratio', type=float, default=defaults.cancel_ratio)
+        parser.add_argument('--start-price', type=int, default=defaults.start_price)
+        parser.add_argument('--volatility', type=float, default=defaults.volatility)
+        parser.add_argument('--spread', type=float, default=defaults.spread)
+        parser.add_argument('--max-qty', type=int, default=defaults.max_qty)
+        parser.add_argument('--seed', type=int, default=defaults.seed)
+        parser.add_argument('--label', default='', help="Метка прогона (например, версия или ветка)")
+        parser.add_argument('--output', help="Файл для JSON-отчета (по умолчанию stdout)")
+
+    def handle(self, *args, **options):
+        config = benchmark.FlowConfig(
+            tickers=options['tickers'],
+            users=options['users'],
+            orders=options['orders'],
+            market_ratio=options['market_ratio'],
+            cancel_ratio=options['cancel_ratio'],
+            start_price=options['start_price'],
+            volatility=options['volatility'],
+            spread=options['spread'],
+            max_qty=options['max_qty'],
+            seed=options['seed'],
+        )
+        if config.market_ratio + config.cancel_ratio > 1:
+            raise CommandError("--market-ratio + --cancel-ratio must not exceed 1")
+        if config.users < 2 or config.tickers < 1:
+            raise CommandError("At least 2 users and 1 ticker are required")
+
+        drivers = list(benchmark.DRIVERS) if options['driver'] == 'all' else [options['driver']]
+        report = {
+            'label': options['label'],
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'config': asdict(config),
+            # Команды выполняются в потоке запроса, чтобы считать все SQL-запросы
+            'sequencer': False,
+            'results': [],
+        }
+
+        # Логи каждого запроса искажают замеры HTTP-пути
+        request_logger = logging.getLogger('api_requests')
+        request_logger.disabled = True
+        # Журнал и версии в кэше одноразовой базы (в том числе от сигналов при ее создании)
+        # не должны попасть к серверу
+        with override_settings(
+            MATCHING_SEQUENCER={'ENABLED': False},
+            MATCHING_JOURNAL={'ENABLED': False},
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        ):
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                for name in drivers:
+                    report['results'].append(self._run_driver(name, config))
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                request_logger.disabled = False
+
+        payload = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(payload)
+            self.stderr.write(f"Report written to {options['output']}")
+        else:
+            self.stdout.write(payload)
+
+    def _run_driver(self, name: str, config: benchmark.FlowConfig) -> dict:
+        """Каждый прогон начинается с пустой базы, чтобы они не влияли друг на друга"""
+        call_command('flush', interactive=False, verbosity=0)
+        driver = benchmark.DRIVERS[name](config)
+        driver.setup()
+        result = driver.run(benchmark.generate_flow(config))
+        self.stderr.write(f"{name}: {result.orders} commands in {result.elapsed_sec:.2f}s")
+        return result.report()
@@ -0,0 +1,124 @@
+import json
+import platform
+import random
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from order import benchmark
+from order.encoders import encode_limit_orders, encode_market_orders
+from order.models import Direction, LimitOrder, MarketOrder, OrderStatus
+from order.serializers import LimitOrderSerializer, MarketOrderSerializer
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Бенчмарк ответа GET /api/v1/order: сериализаторы DRF против order.encoders "
+        "на пользователе с большим числом ордеров. Работает на отдельной тестовой базе"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit-orders', type=int, default=5000)
+        parser.add_argument('--market-orders', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--label', default='', help="Метка прогона (например, версия или ветка)")
+        parser.add_argument('--output', help="Файл для JSON-отчета (по умолчанию stdout)")
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be positive")
+
+        report = {
+            'label': options['label'],
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'limit_orders': options['limit_orders'],
+            'market_orders': options['market_orders'],
+            'repeat': options['repeat'],
+        }
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            user = self._create_orders(options)
+            renderer = JSONRenderer()
+
+            def serializers():
+                return (
+                    LimitOrderSerializer(user.limit_orders.all(), many=True).data
+                    + MarketOrderSerializer(user.market_orders.all(), many=True).data
+                )
+
+            def encoders():
+                return encode_limit_orders(user.limit_orders.all()) + encode_market_orders(user.market_orders.all())
+
+            # Ответы должны совпадать байт в байт
+            report['identical'] = renderer.render(serializers()) == renderer.render(encoders())
+            report['results'] = {
+                name: self._measure(lambda: renderer.render(build()), options['repeat'])
+                for name, build in (('serializers', serializers), ('encoders', encoders))
+            }
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results = report['results']
+        report['speedup'] = round(results['serializers']['ms']['mean'] / results['encoders']['ms']['mean'], 2)
+        self.stderr.write(
+            f"serializers {results['serializers']['ms']['mean']}ms, "
+            f"encoders {results['encoders']['ms']['mean']}ms, x{report['speedup']}"
+        )
+
+        payload = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(payload)
+            self.stderr.write(f"Report written to {options['output']}")
+        else:
+            self.stdout.write(payload)
+
+    @staticmethod
+    def _create_orders(options) -> User:
+        rnd = random.Random(options['seed'])
+        user = User.objects.create_user(name='bench-serialization')
+        statuses = list(OrderStatus.values)
+        LimitOrder.objects.bulk_create([
+            LimitOrder(
+                user=user,
+                ticker='MEM',
+                direction=rnd.choice(Direction.values),
+                qty=rnd.randint(1, 100),
+                price=rnd.randint(1, 1000),
+                filled=rnd.randint(0, 1),
+                status=rnd.choice(statuses),
+            )
+            for _ in range(options['limit_orders'])
+        ], batch_size=1000)
+        MarketOrder.objects.bulk_create([
+            MarketOrder(
+                user=user,
+                ticker='MEM',
+                direction=rnd.choice(Direction.values),
+                qty=rnd.randint(1, 100),
+                status=rnd.choice(statuses),
+            )
+            for _ in range(options['market_orders'])
+        ], batch_size=1000)
+        return user
+
+    @staticmethod
+    def _measure(fn, repeat: int) -> dict:
+        """Время полного построения ответа (запрос, словари, JSON)"""
+        fn()
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - started)
+        return {'ms': benchmark.summarize(timings, scale=1000)}
@@ -1,190 +1,143 @@
-from decimal import Decimal
-from typing import Optional, List, Tuple
-from django.db import transaction
-from django.db.models import F
+import logging
+from typing import Optional, List
 
 from .models import LimitOrder, MarketOrder, Transaction, OrderStatus, Direction
-from balance.models import Balance
+from .book import OrderBook, BookOrder, DepthWalk, get_book, invalidate_book
+from .settlement import Settlement, StaleBook
+from .metrics import measure
+from .journal import journal, order_event
+from .stream import hub
+from balance import services as balance_services
 
-class OrderMatcher:
-    @staticmethod
-    def _update_balances(buyer, seller, ticker: str, amount: int, price: int):
-        """Обновляет балансы участников сделки"""
-        with transaction.atomic():
-            # Создаем или получаем балансы, если их нет
-            buyer_rub, _ = Balance.objects.get_or_create(user=buyer, ticker='RUB', defaults={'amount': 0})
-            buyer_token, _ = Balance.objects.get_or_create(user=buyer, ticker=ticker, defaults={'amount': 0})
-            seller_rub, _ = Balance.objects.get_or_create(user=seller, ticker='RUB', defaults={'amount': 0})
-            seller_token, _ = Balance.objects.get_or_create(user=seller, ticker=ticker, defaults={'amount': 0})
+logger = logging.getLogger('matching')
 
-            # Проверяем достаточность средств
-            if buyer_rub.amount < price * amount or seller_token.amount < amount:
-                raise ValueError("Insufficient funds")
+# Сколько раз матчить ордер заново по перечитанному из базы стакану, если стакан процесса устарел
+STALE_BOOK_ATTEMPTS = 3
 
-            # Обновляем балансы
-            buyer_rub.amount -= price * amount
-            buyer_token.amount += amount
-            seller_rub.amount += price * amount
-            seller_token.amount -= amount
 
-            # Сохраняем изменения
-            buyer_rub.save()
-            buyer_token.save()
-            seller_rub.save()
-            seller_token.save()
+class OrderRejected(Exception):
+    """Ордер отклонен до исполнения: не хватает средств или нет встречных заявок"""
 
-    @staticmethod
-    def _create_transaction(buyer, seller, ticker: str, amount: int, price: int) -> Transaction:
-        """Создает запись о совершенной сделке"""
-        return Transaction.objects.create(
-            ticker=ticker,
-            amount=amount,
-            price=price,
-            buyer=buyer,
-            seller=seller
-        )
 
+class OrderMatcher:
     @staticmethod
-    def _update_order_status(order, filled_qty: int):
-        """Обновляет статус ордера"""
-        order.filled += filled_qty
+    def _hold(direction: str, qty: int, price: Optional[int]) -> int:
+        """Резерв под qty лимитного ордера: RUB для покупки, токены для продажи; у рыночного резерва нет"""
+        if price is None:
+            return 0
+        return qty * price if direction == Direction.BUY else qty
+
+    @classmethod
+    def _execute_fill(cls, book: OrderBook, settlement: Settlement, order, resting: BookOrder, match_qty: int) -> Transaction:
+        """
+        Исполняет сделку между входящим ордером и ордером из стакана.
+        Цена исполнения - это цена ордера, который был в стакане первым.
+        Средства обеих сторон уже проверены (зарезервированы), сделка только снимает резерв
+        """
+        order_hold = cls._hold(order.direction, match_qty, getattr(order, 'price', None))
+        resting_hold = cls._hold(resting.direction, match_qty, resting.price)
+
+        # Определяем покупателя и продавца
+        if order.direction == Direction.BUY:
+            tx = settlement.fill(order.user_id, resting.user_id, match_qty, resting.price,
+                                 buyer_release=order_hold, seller_release=resting_hold)
+        else:
+            tx = settlement.fill(resting.user_id, order.user_id, match_qty, resting.price,
+                                 buyer_release=resting_hold, seller_release=order_hold)
+
+        # Обновляем статусы ордеров
+        order.filled += match_qty
         if order.filled >= order.qty:
             order.status = OrderStatus.EXECUTED
-        elif order.filled > 0:
+        else:
             order.status = OrderStatus.PARTIALLY_EXECUTED
-        elif order.filled == 0:
-            order.status = OrderStatus.NEW
-        order.save()
+
+        book.fill(resting, match_qty)
+        settlement.order_filled(resting, order.id, match_qty)
+        return tx
 
     @staticmethod
-    def _check_balance(user, ticker: str, amount: int, price: Optional[int] = None):
-        """Проверяет достаточно ли средств для совершения сделки"""
-        with transaction.atomic():
-            if price:  # Для покупателя проверяем RUB
-                balance, _ = Balance.objects.get_or_create(user=user, ticker='RUB', defaults={'amount': 0})
-                return balance.amount >= price * amount
-            else:  # Для продавца проверяем токены
-                balance, _ = Balance.objects.get_or_create(user=user, ticker=ticker, defaults={'amount': 0})
-                return balance.amount >= amount
+    def _with_fresh_book(match, order) -> List[Transaction]:
+        """
+        Матчит ордер; если стакан процесса разошелся с базой (StaleBook), откатывает попытку
+        и повторяет ее по стакану, перечитанному из базы
+        """
+        filled, status = order.filled, order.status
+        for _ in range(STALE_BOOK_ATTEMPTS):
+            try:
+                return match(order)
+            except StaleBook:
+                logger.warning("Order book %s is out of date, matching order %s again", order.ticker, order.id)
+                order.filled, order.status = filled, status
+        logger.error("Order %s was not matched: order book %s is still out of date", order.id, order.ticker)
+        return []
 
     @classmethod
     def match_limit_order(cls, order: LimitOrder) -> List[Transaction]:
+        """Исполняет лимитный ордер (см. _match_limit_order)"""
+        return cls._with_fresh_book(cls._match_limit_order, order)
+
+    @classmethod
+    def match_market_order(cls, order: MarketOrder) -> List[Transaction]:
+        """Исполняет рыночный ордер (см. _match_market_order)"""
+        return cls._with_fresh_book(cls._match_market_order, order)
+
+    @classmethod
+    def _match_limit_order(cls, order: LimitOrder) -> List[Transaction]:
         """
         Исполняет лимитный ордер по биржевым правилам:
         - Для BUY ордеров ищем самые дешевые предложения SELL
         - Для SELL ордеров ищем самые дорогие предложения BUY
         - Соблюдаем Price-Time Priority
+        Встречные ордера берутся из стакана в памяти, все изменения пишутся в базу одной пачкой.
+        Средства под ордер к этому моменту уже зарезервированы (см. OrderView._check_initial_balance)
         """
         transactions = []
-        
-        try:
-            with transaction.atomic():
-                # Проверяем баланс для всего ордера
-                if order.direction == Direction.BUY:
-                    if not cls._check_balance(order.user, 'RUB', order.qty, order.price):
-                        order.status = OrderStatus.CANCELLED
-                        order.save()
-                        return transactions
-                else:
-                    if not cls._check_balance(order.user, order.ticker, order.qty):
-                        order.status = OrderStatus.CANCELLED
+        book = get_book(order.ticker)
+
+        with measure(order, 'limit') as stats, book.lock:
+            try:
+                with stats.atomic():
+                    settlement = Settlement(order.ticker)
+
+                    # Для покупки идем от самых дешевых продаж, для продажи - от самых дорогих покупок,
+                    # пока цена не выходит за лимит нашего ордера
+                    walk = DepthWalk(book, order.direction, order.user_id, order.qty, order.price)
+                    stats.skipped = walk.skipped
+                    for resting in walk:
+                        match_qty = min(order.qty - order.filled, resting.remaining)
+                        transactions.append(cls._execute_fill(book, settlement, order, resting, match_qty))
+
+                    settlement.commit()
+                    if transactions:
                         order.save()
-                        return transactions
+                    # Сделки и сам ордер - одна версия стакана
+                    journal.log(settlement.events + [order_event(order)], book)
 
-                remaining_qty = order.qty
-
-                while remaining_qty > 0:
-                    # Ищем встречный ордер с лучшей ценой
-                    if order.direction == Direction.BUY:
-                        # Для покупки ищем самые дешевые предложения продажи
-                        matching_order = (
-                            LimitOrder.objects
-                            .select_for_update()  # Блокируем строки для атомарности
-                            .filter(
-                                ticker=order.ticker,
-                                direction=Direction.SELL,
-                                price__lte=order.price,  # Цена не выше нашей максимальной
-                                status__in=[OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]
-                            )
-                            .exclude(user=order.user)
-                            .order_by('price', 'timestamp')  # Сначала самые дешевые, потом по времени
-                            .first()
-                        )
+                    # Неисполненный остаток встает в стакан. Стакан, перечитанный из базы после StaleBook,
+                    # уже содержит сам ордер - исполненный полностью из него убираем
+                    if order.filled < order.qty:
+                        book.add(BookOrder.from_model(order))
                     else:
-                        # Для продажи ищем самые дорогие предложения покупки
-                        matching_order = (
-                            LimitOrder.objects
-                            .select_for_update()  # Блокируем строки для атомарности
-                            .filter(
-                                ticker=order.ticker,
-                                direction=Direction.BUY,
-                                price__gte=order.price,  # Цена не ниже нашей минимальной
-                                status__in=[OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]
-                            )
-                            .exclude(user=order.user)
-                            .order_by('-price', 'timestamp')  # Сначала самые дорогие, потом по времени
-                            .first()
-                        )
-
-                    if not matching_order:
-                        # Нет подходящих ордеров - оставляем в статусе NEW или PARTIALLY_EXECUTED
-                        break
+                        book.remove(order.id)
+                    hub.book_changed(book)
 
-                    # Определяем количество и цену для сделки
-                    match_qty = min(remaining_qty, matching_order.qty - matching_order.filled)
-                    
-                    # Цена исполнения - это цена ордера, который был в стакане первым
-                    match_price = matching_order.price
-                    
-                    # Определяем покупателя и продавца
-                    buyer = order.user if order.direction == Direction.BUY else matching_order.user
-                    seller = matching_order.user if order.direction == Direction.BUY else order.user
+            except StaleBook:
+                # Транзакция откатилась, ордер сматчится заново по перечитанному стакану
+                invalidate_book(order.ticker)
+                raise
+            except Exception:
+                logger.exception("Error during order matching: order %s", order.id)
+                # Транзакция откатилась, стакан перечитаем из базы
+                invalidate_book(order.ticker)
+                return []
 
-                    # Проверяем балансы обеих сторон
-                    if not cls._check_balance(buyer, 'RUB', match_qty, match_price) or \
-                       not cls._check_balance(seller, order.ticker, match_qty):
-                        # Если у какой-то стороны не хватает средств - отменяем встречный ордер
-                        matching_order.status = OrderStatus.CANCELLED
-                        matching_order.save()
-                        continue
-
-                    # Обновляем балансы
-                    cls._update_balances(buyer, seller, order.ticker, match_qty, match_price)
-                    
-                    # Создаем транзакцию
-                    tx = cls._create_transaction(buyer, seller, order.ticker, match_qty, match_price)
-                    transactions.append(tx)
-                    
-                    # Обновляем статусы ордеров
-                    order.filled += match_qty
-                    matching_order.filled += match_qty
-                    
-                    # Обновляем статус нашего ордера
-                    if order.filled >= order.qty:
-                        order.status = OrderStatus.EXECUTED
-                    else:
-                        order.status = OrderStatus.PARTIALLY_EXECUTED
-                    
-                    # Обновляем статус встречного ордера
-                    if matching_order.filled >= matching_order.qty:
-                        matching_order.status = OrderStatus.EXECUTED
-                    else:
-                        matching_order.status = OrderStatus.PARTIALLY_EXECUTED
-                    
-                    order.save()
-                    matching_order.save()
-                    
-                    remaining_qty -= match_qty
-
-        except Exception as e:
-            print(f"Error during order matching: {e}")
-            # В случае ошибки транзакция откатится автоматически
-            return []
+            stats.fills = len(transactions)
 
         return transactions
 
     @classmethod
-    def match_market_order(cls, order: MarketOrder) -> List[Transaction]:
+    def _match_market_order(cls, order: MarketOrder) -> List[Transaction]:
         """
         Исполняет рыночный ордер по биржевым правилам:
         - Для BUY берем лучшие предложения SELL по возрастанию цены
@@ -192,143 +145,51 @@ class OrderMatcher:
         - Исполняем по ценам в стакане
         """
         transactions = []
-        
-        try:
-            with transaction.atomic():
-                # Проверяем наличие встречных ордеров
-                if order.direction == Direction.BUY:
-                    matching_orders = (
-                        LimitOrder.objects
-                        .filter(
-                            ticker=order.ticker,
-                            direction=Direction.SELL,
-                            status__in=[OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]
-                        )
-                        .exclude(user=order.user)
-                        .order_by('price', 'timestamp')
-                    )
-                else:  # SELL
-                    matching_orders = (
-                        LimitOrder.objects
-                        .filter(
-                            ticker=order.ticker,
-                            direction=Direction.BUY,
-                            status__in=[OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]
-                        )
-                        .exclude(user=order.user)
-                        .order_by('-price', 'timestamp')
-                    )
-
-                # Проверяем, достаточно ли ордеров для исполнения
-                available_qty = sum(o.qty - o.filled for o in matching_orders)
-                if available_qty < order.qty:
-                    order.status = OrderStatus.CANCELLED
-                    order.save()
-                    return transactions
-
-                if order.direction == Direction.BUY:
-                    # Вычисляем необходимую сумму RUB для покупки
-                    required_rub = 0
-                    remaining = order.qty
-                    for o in matching_orders:
-                        match_qty = min(remaining, o.qty - o.filled)
-                        required_rub += match_qty * o.price
-                        remaining -= match_qty
-                        if remaining <= 0:
-                            break
-                    
-                    # Проверяем баланс RUB
-                    if not cls._check_balance(order.user, 'RUB', order.qty, required_rub // order.qty):
-                        order.status = OrderStatus.CANCELLED
-                        order.save()
-                        return transactions
-                else:  # SELL
-                    # Проверяем баланс токенов для продажи
-                    if not cls._check_balance(order.user, order.ticker, order.qty):
+        book = get_book(order.ticker)
+
+        with measure(order, 'market') as stats, book.lock:
+            try:
+                with stats.atomic():
+                    # Один проход по стакану до нужного объема: хватает ли ордеров и сколько это стоит
+                    walk = DepthWalk(book, order.direction, order.user_id, order.qty)
+                    stats.skipped = walk.skipped
+                    if not walk.fillable:
                         order.status = OrderStatus.CANCELLED
                         order.save()
+                        journal.log([order_event(order)])
+                        stats.cancelled = True
                         return transactions
 
-                remaining_qty = order.qty
-
-                while remaining_qty > 0:
-                    # Ищем встречный ордер с лучшей ценой
+                    # У рыночного ордера нет резерва - проверяем свободный остаток на весь объем
                     if order.direction == Direction.BUY:
-                        matching_order = (
-                            LimitOrder.objects
-                            .select_for_update()
-                            .filter(
-                                ticker=order.ticker,
-                                direction=Direction.SELL,
-                                status__in=[OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]
-                            )
-                            .exclude(user=order.user)
-                            .order_by('price', 'timestamp')
-                            .first()
-                        )
+                        balance_ticker, required = 'RUB', walk.cost
                     else:
-                        matching_order = (
-                            LimitOrder.objects
-                            .select_for_update()
-                            .filter(
-                                ticker=order.ticker,
-                                direction=Direction.BUY,
-                                status__in=[OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]
-                            )
-                            .exclude(user=order.user)
-                            .order_by('-price', 'timestamp')
-                            .first()
-                        )
-
-                    if not matching_order:
-                        # Нет подходящих ордеров - отменяем остаток
-                        if order.filled == 0:
-                            order.status = OrderStatus.CANCELLED
-                        elif order.filled < order.qty:
-                            order.status = OrderStatus.PARTIALLY_EXECUTED
+                        balance_ticker, required = order.ticker, order.qty
+                    if balance_services.available(order.user_id, balance_ticker) < required:
+                        order.status = OrderStatus.CANCELLED
                         order.save()
-                        break
-
-                    match_qty = min(remaining_qty, matching_order.qty - matching_order.filled)
-                    match_price = matching_order.price
-
-                    buyer = order.user if order.direction == Direction.BUY else matching_order.user
-                    seller = matching_order.user if order.direction == Direction.BUY else order.user
-
-                    try:
-                        # Проверяем балансы и обновляем их
-                        cls._update_balances(buyer, seller, order.ticker, match_qty, match_price)
-                        
-                        # Создаем транзакцию
-                        tx = cls._create_transaction(buyer, seller, order.ticker, match_qty, match_price)
-                        transactions.append(tx)
-
-                        # Обновляем статусы
-                        order.filled += match_qty
-                        matching_order.filled += match_qty
-
-                        if order.filled >= order.qty:
-                            order.status = OrderStatus.EXECUTED
-                        else:
-                            order.status = OrderStatus.PARTIALLY_EXECUTED
+                        journal.log([order_event(order)])
+                        stats.cancelled = True
+                        return transactions
 
-                        if matching_order.filled >= matching_order.qty:
-                            matching_order.status = OrderStatus.EXECUTED
-                        else:
-                            matching_order.status = OrderStatus.PARTIALLY_EXECUTED
+                    settlement = Settlement(order.ticker)
+                    for resting in walk:
+                        match_qty = min(order.qty - order.filled, resting.remaining)
+                        transactions.append(cls._execute_fill(book, settlement, order, resting, match_qty))
 
-                        order.save()
-                        matching_order.save()
+                    settlement.commit()
+                    order.save()
+                    journal.log(settlement.events + [order_event(order)], book)
+                    hub.book_changed(book)
 
-                        remaining_qty -= match_qty
-                    except ValueError:
-                        # Если не хватает средств, отменяем встречный ордер и продолжаем
-                        matching_order.status = OrderStatus.CANCELLED
-                        matching_order.save()
-                        continue
+            except StaleBook:
+                invalidate_book(order.ticker)
+                raise
+            except Exception:
+                logger.exception("Error during order matching: order %s", order.id)
+                invalidate_book(order.ticker)
+                return []
 
-        except Exception as e:
-            print(f"Error during order matching: {e}")
-            return []
+            stats.fills = len(transactions)
 
-        return transactions 
\ No newline at end of file
+        return transactions
@@ -0,0 +1,183 @@
+"""
+Метрики матчинга по каждому входящему ордеру.
+
+Для ордера считаются SQL-запросы, строки, измененные (и тем самым заблокированные до конца
+транзакции) запросами UPDATE/INSERT/DELETE, сделки, пропущенные собственные ордера
+пользователя и время внутри transaction.atomic(). Значения копятся в гистограммах
+в памяти процесса и отдаются администратору (GET /api/v1/admin/metrics/matching),
+а при MATCHING_METRICS['LOG'] попадают еще и в лог запроса.
+"""
+import heapq
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+from django.conf import settings
+from django.db import connection, transaction
+
+# Верхние границы корзин гистограмм
+BUCKETS: Dict[str, Sequence[float]] = {
+    'queries': (1, 2, 4, 8, 16, 32, 64, 128),
+    'rows_locked': (0, 1, 2, 4, 8, 16, 32, 64, 128),
+    'fills': (0, 1, 2, 5, 10, 20, 50, 100),
+    'skipped': (0, 1, 2, 5, 10, 20, 50, 100),
+    'atomic_ms': (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+}
+# Сколько самых медленных ордеров помнить
+SLOWEST_KEEP = 10
+
+
+def metrics_settings() -> dict:
+    return getattr(settings, 'MATCHING_METRICS', {})
+
+
+class QueryCounter:
+    """Считает SQL-запросы текущего соединения и измененные ими строки (connection.execute_wrapper)"""
+
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        result = execute(sql, params, many, context)
+        # Для SELECT rowcount равен -1
+        rowcount = getattr(context.get('cursor'), 'rowcount', -1)
+        if rowcount > 0:
+            self.rows += rowcount
+        return result
+
+
+@dataclass
+class OrderStats:
+    """Счетчики матчинга одного входящего ордера"""
+    kind: str
+    ticker: str
+    order_id: Optional[str] = None
+    queries: int = 0
+    rows_locked: int = 0
+    fills: int = 0
+    skipped: int = 0
+    cancelled: bool = False
+    atomic_ms: float = 0.0
+
+    @contextmanager
+    def atomic(self):
+        """transaction.atomic(), время внутри которого прибавляется к atomic_ms"""
+        started = time.perf_counter()
+        try:
+            with transaction.atomic():
+                yield
+        finally:
+            self.atomic_ms += (time.perf_counter() - started) * 1000
+
+    def as_dict(self) -> dict:
+        data = asdict(self)
+        data['atomic_ms'] = round(self.atomic_ms, 3)
+        return data
+
+
+@dataclass
+class Histogram:
+    bounds: Sequence[float]
+    counts: List[int] = field(default_factory=list)
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def __post_init__(self):
+        # Последняя корзина - все, что больше верхней границы
+        self.counts = [0] * (len(self.bounds) + 1)
+
+    def observe(self, value: float):
+        index = len(self.bounds)
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def as_dict(self) -> dict:
+        labels = [f"<={bound:g}" for bound in self.bounds] + [f">{self.bounds[-1]:g}"]
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 3) if self.count else 0,
+            'max': round(self.max, 3),
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+class MatchingMetrics:
+    """Гистограммы по типам ордеров и самые медленные ордера"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._histograms: Dict[str, Dict[str, Histogram]] = {}
+            self._orders: Dict[str, int] = {}
+            self._cancelled: Dict[str, int] = {}
+            # Куча (atomic_ms, порядковый номер, stats) - номер нужен, чтобы не сравнивать OrderStats
+            self._slowest: List[tuple] = []
+            self._seq = 0
+
+    def record(self, stats: OrderStats):
+        with self._lock:
+            histograms = self._histograms.get(stats.kind)
+            if histograms is None:
+                histograms = self._histograms[stats.kind] = {
+                    name: Histogram(bounds) for name, bounds in BUCKETS.items()
+                }
+            for name, histogram in histograms.items():
+                histogram.observe(getattr(stats, name))
+            self._orders[stats.kind] = self._orders.get(stats.kind, 0) + 1
+            if stats.cancelled:
+                self._cancelled[stats.kind] = self._cancelled.get(stats.kind, 0) + 1
+
+            self._seq += 1
+            entry = (stats.atomic_ms, self._seq, stats)
+            if len(self._slowest) < SLOWEST_KEEP:
+                heapq.heappush(self._slowest, entry)
+            else:
+                heapq.heappushpop(self._slowest, entry)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = {
+                kind: {
+                    'orders': self._orders.get(kind, 0),
+                    'cancelled': self._cancelled.get(kind, 0),
+                    **{name: histogram.as_dict() for name, histogram in histograms.items()},
+                }
+                for kind, histograms in self._histograms.items()
+            }
+            data['slowest'] = [stats.as_dict() for _, _, stats in sorted(self._slowest, reverse=True)]
+            return data
+
+
+metrics = MatchingMetrics()
+
+
+@contextmanager
+def measure(order, kind: str):
+    """
+    Собирает метрики матчинга ордера: все запросы внутри блока считаются через execute_wrapper.
+    По выходе счетчики записываются в общие гистограммы и сохраняются в order.match_stats
+    """
+    stats = OrderStats(kind=kind, ticker=order.ticker, order_id=str(order.id))
+    counter = QueryCounter()
+    try:
+        with connection.execute_wrapper(counter):
+            yield stats
+    finally:
+        stats.queries = counter.count
+        stats.rows_locked = counter.rows
+        order.match_stats = stats
+        metrics.record(stats)
@@ -0,0 +1,65 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:02
+
+from datetime import datetime, timezone
+
+from django.db import migrations, models
+
+INTERVAL_SECONDS = {'1m': 60, '5m': 5 * 60, '1h': 60 * 60, '1d': 24 * 60 * 60}
+
+
+def backfill_candles(apps, schema_editor):
+    """Свечи по уже совершенным сделкам"""
+    Transaction = apps.get_model('order', 'Transaction')
+    Candle = apps.get_model('order', 'Candle')
+
+    bars = {}
+    trades = Transaction.objects.order_by('timestamp').values_list('ticker', 'amount', 'price', 'timestamp')
+    for ticker, amount, price, timestamp in trades.iterator(chunk_size=2000):
+        epoch = int(timestamp.timestamp())
+        for interval, seconds in INTERVAL_SECONDS.items():
+            key = (ticker, interval, epoch - epoch % seconds)
+            bar = bars.get(key)
+            if bar is None:
+                bars[key] = [price, price, price, price, amount, 1]
+            else:
+                bar[1] = max(bar[1], price)
+                bar[2] = min(bar[2], price)
+                bar[3] = price
+                bar[4] += amount
+                bar[5] += 1
+
+    Candle.objects.bulk_create([
+        Candle(ticker=ticker, interval=interval, start=datetime.fromtimestamp(start, tz=timezone.utc),
+               open=o, high=h, low=l, close=c, volume=v, trades=n)
+        for (ticker, interval, start), (o, h, l, c, v, n) in bars.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0002_limitorder_limit_order_ticker_d90a0b_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Candle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ticker', models.CharField(max_length=10)),
+                ('interval', models.CharField(choices=[('1m', '1 minute'), ('5m', '5 minutes'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2)),
+                ('start', models.DateTimeField()),
+                ('open', models.PositiveIntegerField()),
+                ('high', models.PositiveIntegerField()),
+                ('low', models.PositiveIntegerField()),
+                ('close', models.PositiveIntegerField()),
+                ('volume', models.PositiveBigIntegerField(default=0)),
+                ('trades', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'candles',
+                'constraints': [models.UniqueConstraint(fields=('ticker', 'interval', 'start'), name='candle_ticker_interval_start_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_candles, migrations.RunPython.noop),
+    ]
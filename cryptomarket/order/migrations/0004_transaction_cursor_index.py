@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:04
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0003_candle'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='transaction',
+            name='transaction_ticker_5b5a49_idx',
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['ticker', 'timestamp', 'id'], name='transaction_ticker_7c7c0a_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0004_transaction_cursor_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookVersion',
+            fields=[
+                ('ticker', models.CharField(max_length=10, primary_key=True, serialize=False)),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'book_versions',
+            },
+        ),
+    ]
@@ -23,6 +23,17 @@ class Instrument(models.Model):
     class Meta:
         db_table = "instruments"
 
+class BookVersion(models.Model):
+    """
+    Версия стакана тикера: растет в каждой транзакции, меняющей его активные ордера.
+    Стакан, восстановленный из журнала, сверяется с базой по ней (order.journal)
+    """
+    ticker = models.CharField(max_length=10, primary_key=True)
+    version = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = "book_versions"
+
 class Order(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -79,5 +90,33 @@ class Transaction(models.Model):
         indexes = [
             models.Index(fields=['buyer']),
             models.Index(fields=['seller']),
-            models.Index(fields=['ticker', 'timestamp']),
+            # id - однозначный порядок сделок с одинаковым временем для постраничного чтения
+            models.Index(fields=['ticker', 'timestamp', 'id']),
+        ]
+
+class CandleInterval(models.TextChoices):
+    MINUTE = "1m", "1 minute"
+    FIVE_MINUTES = "5m", "5 minutes"
+    HOUR = "1h", "1 hour"
+    DAY = "1d", "1 day"
+
+class Candle(models.Model):
+    """OHLCV-свеча: сделки тикера за интервал, начинающийся в start (UTC)"""
+    ticker = models.CharField(max_length=10)
+    interval = models.CharField(max_length=2, choices=CandleInterval.choices)
+    start = models.DateTimeField()
+    open = models.PositiveIntegerField()
+    high = models.PositiveIntegerField()
+    low = models.PositiveIntegerField()
+    close = models.PositiveIntegerField()
+    volume = models.PositiveBigIntegerField(default=0)
+    trades = models.PositiveIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.ticker} {self.interval} {self.start:%Y-%m-%d %H:%M} O{self.open} H{self.high} L{self.low} C{self.close}"
+    
+    class Meta:
+        db_table = "candles"
+        constraints = [
+            models.UniqueConstraint(fields=['ticker', 'interval', 'start'], name='candle_ticker_interval_start_uniq'),
         ]
@@ -0,0 +1,195 @@
+"""
+Скользящая статистика тикера за 24 часа и последние сделки в памяти.
+
+Окно разбито на минутные корзины в кольцевом буфере: корзина хранит цену открытия,
+максимум, минимум, объем и оборот (сумму price * amount) за свою минуту,
+а слот с корзиной старше 24 часов переиспользуется новой минутой.
+Статистика тикера загружается из базы при первом обращении, дальше ее пополняют
+сделки после коммита (Settlement.commit) - запросы /public/ticker и первая страница
+истории сделок в базу не ходят.
+"""
+import threading
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Transaction
+
+WINDOW_SECONDS = 24 * 60 * 60
+BUCKET_SECONDS = 60
+BUCKET_COUNT = WINDOW_SECONDS // BUCKET_SECONDS
+# Сколько последних сделок держать в памяти (больше максимальной страницы истории)
+RECENT_TRADES = 200
+
+
+@dataclass
+class Bucket:
+    minute: int
+    open: int
+    high: int
+    low: int
+    volume: int
+    notional: int
+    trades: int
+
+
+def _minute(timestamp: datetime) -> int:
+    return int(timestamp.timestamp()) // BUCKET_SECONDS
+
+
+class TickerStats:
+    """Корзины за 24 часа, последняя цена и последние сделки одного тикера"""
+
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.lock = threading.Lock()
+        self.buckets: List[Optional[Bucket]] = [None] * BUCKET_COUNT
+        self.recent: deque = deque(maxlen=RECENT_TRADES)
+        self.last_price: Optional[int] = None
+        # Самая новая сделка, прочитанная при загрузке: сделки, закоммиченные во время
+        # загрузки, уже учтены и не должны попасть в статистику второй раз
+        self._loaded_until: Optional[datetime] = None
+        self._loaded_ids: Set = set()
+
+    def _add(self, price: int, amount: int, timestamp: datetime):
+        minute = _minute(timestamp)
+        slot = minute % BUCKET_COUNT
+        bucket = self.buckets[slot]
+        if bucket is None or bucket.minute < minute:
+            self.buckets[slot] = Bucket(minute, price, price, price, amount, price * amount, 1)
+        elif bucket.minute == minute:
+            bucket.high = max(bucket.high, price)
+            bucket.low = min(bucket.low, price)
+            bucket.volume += amount
+            bucket.notional += price * amount
+            bucket.trades += 1
+        # Сделка старше корзины в слоте уже вне окна
+
+    def load(self):
+        """Сделки за последние 24 часа и последние RECENT_TRADES сделок из базы"""
+        trades = Transaction.objects.filter(ticker=self.ticker)
+        since = timezone.now() - timedelta(seconds=WINDOW_SECONDS)
+        rows = (
+            trades.filter(timestamp__gte=since)
+            .order_by('timestamp', 'id')
+            .values_list('price', 'amount', 'timestamp')
+            .iterator(chunk_size=2000)
+        )
+        for price, amount, timestamp in rows:
+            self._add(price, amount, timestamp)
+
+        recent = list(
+            trades.only('id', 'ticker', 'amount', 'price', 'timestamp')
+            .order_by('-timestamp', '-id')[:RECENT_TRADES]
+        )
+        recent.reverse()
+        self.recent.extend(recent)
+        if recent:
+            self.last_price = recent[-1].price
+            self._loaded_until = recent[-1].timestamp
+            self._loaded_ids = {trade.id for trade in recent if trade.timestamp == self._loaded_until}
+
+    def add(self, trades: Iterable[Transaction]):
+        """Добавляет закоммиченные сделки (в порядке исполнения)"""
+        with self.lock:
+            for trade in trades:
+                if self._loaded_until is not None and (
+                    trade.timestamp < self._loaded_until
+                    or (trade.timestamp == self._loaded_until and trade.id in self._loaded_ids)
+                ):
+                    continue
+                self._add(trade.price, trade.amount, trade.timestamp)
+                self.recent.append(trade)
+                self.last_price = trade.price
+
+    def summary(self) -> dict:
+        """Статистика за последние 24 часа"""
+        oldest = _minute(timezone.now()) - BUCKET_COUNT
+        with self.lock:
+            buckets = sorted(
+                (bucket for bucket in self.buckets if bucket is not None and bucket.minute > oldest),
+                key=lambda bucket: bucket.minute
+            )
+            last_price = self.last_price
+        volume = sum(bucket.volume for bucket in buckets)
+        notional = sum(bucket.notional for bucket in buckets)
+        return {
+            'ticker': self.ticker,
+            'last_price': last_price,
+            'open_24h': buckets[0].open if buckets else None,
+            'high_24h': max((bucket.high for bucket in buckets), default=None),
+            'low_24h': min((bucket.low for bucket in buckets), default=None),
+            'volume_24h': volume,
+            'vwap_24h': round(notional / volume, 4) if volume else None,
+            'trades_24h': sum(bucket.trades for bucket in buckets),
+        }
+
+    def latest(self, limit: int) -> Optional[List[Transaction]]:
+        """
+        limit + 1 последних сделок, от новых к старым (лишняя - признак следующей страницы).
+        None - в памяти сделок меньше, чем нужно, а в базе могут быть еще
+        """
+        with self.lock:
+            if len(self.recent) <= limit and len(self.recent) == RECENT_TRADES:
+                return None
+            trades = list(self.recent)
+        # Тот же порядок, что и у постраничного чтения из базы
+        trades.sort(key=lambda trade: (trade.timestamp, trade.id), reverse=True)
+        return trades[:limit + 1]
+
+
+class RollingStats:
+    """Статистика тикеров, загруженных в этом процессе"""
+
+    def __init__(self):
+        self._stats: Dict[str, TickerStats] = {}
+        self._lock = threading.Lock()
+
+    def get(self, ticker: str) -> TickerStats:
+        """Статистика тикера, при первом обращении загружается из базы"""
+        stats = self._stats.get(ticker)
+        if stats is not None:
+            return stats
+        with self._lock:
+            stats = self._stats.get(ticker)
+            if stats is None:
+                stats = TickerStats(ticker)
+                with stats.lock:
+                    stats.load()
+                self._stats[ticker] = stats
+            return stats
+
+    def loaded(self, ticker: str) -> Optional[TickerStats]:
+        """Статистика тикера, если она уже загружена в этом процессе"""
+        return self._stats.get(ticker)
+
+    def trades_committed(self, ticker: str, trades: List[Transaction]):
+        """
+        Добавляет сделки после коммита текущей транзакции. Тикер может загрузиться
+        между матчингом и коммитом, поэтому загруженность проверяется уже после коммита
+        """
+        if trades:
+            transaction.on_commit(lambda: self._add(ticker, trades))
+
+    def _add(self, ticker: str, trades: List[Transaction]):
+        # Под блокировкой: если тикер сейчас загружается, сделки добавятся после загрузки
+        with self._lock:
+            stats = self._stats.get(ticker)
+        if stats is not None:
+            stats.add(trades)
+
+    def invalidate(self, ticker: str):
+        """Сбрасывает статистику тикера (например, после удаления сделок)"""
+        with self._lock:
+            self._stats.pop(ticker, None)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+rolling = RollingStats()
@@ -0,0 +1,114 @@
+"""
+Последовательная обработка команд матчинга по тикерам.
+
+Все команды одного тикера (создание и отмена ордеров) выполняются по очереди
+в одном выделенном потоке, разные тикеры обрабатываются параллельно.
+Вместо конкуренции за блокировки базы запросы просто ждут своей очереди.
+"""
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait as wait_futures
+from typing import Callable, Dict
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+
+def _sequencer_settings() -> dict:
+    return getattr(settings, 'MATCHING_SEQUENCER', {})
+
+
+class CommandTimeout(TimeoutError):
+    """
+    Команда не выполнилась за MATCHING_SEQUENCER['TIMEOUT'].
+    started=False - команда снята с очереди и уже не выполнится,
+    started=True - команда выполняется и завершится позже
+    """
+
+    def __init__(self, ticker: str, started: bool):
+        super().__init__(f"Matching queue {ticker} timeout")
+        self.ticker = ticker
+        self.started = started
+
+
+def _run_command(fn: Callable, args, kwargs):
+    """Выполняет команду в потоке тикера, соединение с базой живет как в обычном запросе"""
+    close_old_connections()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+class MatchingSequencer:
+    """Очередь команд с одним обработчиком на каждый тикер"""
+
+    def __init__(self):
+        self._executors: Dict[str, ThreadPoolExecutor] = {}
+        self._lock = threading.Lock()
+
+    def _executor(self, ticker: str) -> ThreadPoolExecutor:
+        executor = self._executors.get(ticker)
+        if executor is not None:
+            return executor
+        with self._lock:
+            executor = self._executors.get(ticker)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'matching-{ticker}')
+                self._executors[ticker] = executor
+            return executor
+
+    def submit(self, ticker: str, fn: Callable, *args, **kwargs) -> Future:
+        """Ставит команду в очередь тикера"""
+        return self._executor(ticker).submit(_run_command, fn, args, kwargs)
+
+    def run(self, ticker: str, fn: Callable, *args, **kwargs):
+        """
+        Выполняет команду в очереди тикера и ждет результат.
+        Если очередь отключена или вызывающий код уже внутри транзакции
+        (другой поток не увидел бы ее незакоммиченные данные), команда выполняется на месте.
+        Если результата нет за TIMEOUT - CommandTimeout; еще не начатая команда при этом снимается с очереди
+        """
+        options = _sequencer_settings()
+        if not options.get('ENABLED', True) or connection.in_atomic_block:
+            return fn(*args, **kwargs)
+        future = self.submit(ticker, fn, *args, **kwargs)
+        try:
+            return future.result(timeout=options.get('TIMEOUT'))
+        except FutureTimeoutError:
+            if future.done():
+                # TimeoutError бросила сама команда
+                raise
+            raise CommandTimeout(ticker, started=not future.cancel()) from None
+
+    def run_many(self, fn: Callable, calls: Dict[str, tuple]) -> Dict[str, Future]:
+        """
+        Выполняет fn(*args) в очередях нескольких тикеров ({ticker: args}) параллельно
+        и возвращает Future по тикерам (исключение команды остается в своем Future).
+        Не начатые за TIMEOUT команды снимаются с очереди (future.cancelled()),
+        уже начатые завершатся позже (future.done() - False)
+        """
+        options = _sequencer_settings()
+        if not options.get('ENABLED', True) or connection.in_atomic_block:
+            futures = {}
+            for ticker, args in calls.items():
+                future = futures[ticker] = Future()
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+            return futures
+        futures = {ticker: self.submit(ticker, fn, *args) for ticker, args in calls.items()}
+        wait_futures(futures.values(), timeout=options.get('TIMEOUT'))
+        for future in futures.values():
+            if not future.done():
+                future.cancel()
+        return futures
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executors, self._executors = self._executors, {}
+        for executor in executors.values():
+            executor.shutdown(wait=wait)
+
+
+sequencer = MatchingSequencer()
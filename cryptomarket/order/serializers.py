@@ -5,9 +5,20 @@ from .models import (
     Transaction, 
     Instrument, 
     Direction, 
-    OrderStatus
+    OrderStatus,
+    Candle,
+    CandleInterval
 )
+import base64
 import uuid
+from datetime import datetime
+
+from .instruments import instruments
+
+def known_instrument(ticker: str):
+    """Тикер есть в справочнике инструментов"""
+    if not instruments.exists(ticker):
+        raise serializers.ValidationError(f"Unknown instrument: {ticker}")
 
 class InstrumentSerializer(serializers.ModelSerializer):
     class Meta:
@@ -27,17 +38,79 @@ class TransactionSerializer(serializers.ModelSerializer):
         model = Transaction
         fields = ['ticker', 'amount', 'price', 'timestamp']
 
+class TransactionCursorField(serializers.CharField):
+    """Непрозрачный курсор истории сделок: время и id последней отданной сделки"""
+
+    @staticmethod
+    def encode(trade: Transaction) -> str:
+        raw = f"{trade.timestamp.isoformat()}|{trade.id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def to_internal_value(self, data):
+        value = super().to_internal_value(data)
+        try:
+            raw = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode()
+            timestamp, trade_id = raw.split('|')
+            return datetime.fromisoformat(timestamp), uuid.UUID(trade_id)
+        except ValueError:
+            raise serializers.ValidationError("Invalid cursor")
+
+class OrderBookQuerySerializer(serializers.Serializer):
+    """Параметры стакана: сколько уровней отдавать с каждой стороны"""
+    limit = serializers.IntegerField(min_value=1, max_value=25, default=10)
+
+class TransactionHistoryQuerySerializer(serializers.Serializer):
+    """Параметры истории сделок; cursor - значение заголовка X-Next-Cursor предыдущей страницы"""
+    limit = serializers.IntegerField(min_value=1, default=10)
+    cursor = TransactionCursorField(required=False)
+
+class TransactionExportQuerySerializer(serializers.Serializer):
+    """Параметры выгрузки сделок: формат и полуинтервал [start, end) по времени сделки"""
+    format = serializers.ChoiceField(choices=['ndjson', 'csv'], default='ndjson')
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+
+class QuoteQuerySerializer(serializers.Serializer):
+    """Параметры оценки рыночной заявки; price - необязательный предел цены"""
+    side = serializers.ChoiceField(choices=Direction.choices)
+    qty = serializers.IntegerField(min_value=1)
+    price = serializers.IntegerField(min_value=1, required=False)
+
+class CandleSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Candle
+        fields = ['start', 'open', 'high', 'low', 'close', 'volume', 'trades']
+
+class CandleQuerySerializer(serializers.Serializer):
+    """Параметры запроса свечей: интервал и полуинтервал [start, end) по началу свечи"""
+    interval = serializers.ChoiceField(choices=CandleInterval.choices, default=CandleInterval.MINUTE)
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=500)
+
+    def validate(self, data):
+        if 'start' in data and 'end' in data and data['start'] >= data['end']:
+            raise serializers.ValidationError("start должен быть раньше end")
+        return data
+
 class LimitOrderBodySerializer(serializers.Serializer):
     direction = serializers.ChoiceField(choices=Direction.choices)
-    ticker = serializers.CharField()
+    ticker = serializers.CharField(validators=[known_instrument])
     qty = serializers.IntegerField(min_value=1)
     price = serializers.IntegerField(min_value=1)
 
 class MarketOrderBodySerializer(serializers.Serializer):
     direction = serializers.ChoiceField(choices=Direction.choices)
-    ticker = serializers.CharField()
+    ticker = serializers.CharField(validators=[known_instrument])
     qty = serializers.IntegerField(min_value=1)
 
+class BatchOrderBodySerializer(serializers.Serializer):
+    """Ордер в пакете: с ценой - лимитный, без цены - рыночный"""
+    direction = serializers.ChoiceField(choices=Direction.choices)
+    ticker = serializers.CharField(validators=[known_instrument])
+    qty = serializers.IntegerField(min_value=1)
+    price = serializers.IntegerField(min_value=1, required=False)
+
 class LimitOrderSerializer(serializers.ModelSerializer):
     body = LimitOrderBodySerializer(source='*')
     
@@ -79,5 +152,12 @@ class CreateOrderResponseSerializer(serializers.Serializer):
     success = serializers.BooleanField(default=True)
     order_id = serializers.UUIDField()
 
+class BatchOrderResultSerializer(serializers.Serializer):
+    success = serializers.BooleanField()
+    order_id = serializers.UUIDField(allow_null=True)
+    status = serializers.CharField(allow_null=True)
+    filled = serializers.IntegerField()
+    detail = serializers.CharField(allow_null=True)
+
 class OkSerializer(serializers.Serializer):
     success = serializers.BooleanField(default=True) 
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""
+Расчеты по сделкам одного входящего ордера.
+
+Во время матчинга изменения балансов, исполнения встречных ордеров и сделки
+только накапливаются в памяти, а в конце пишутся в базу несколькими
+пакетными запросами в одной транзакции - вне зависимости от числа сделок.
+
+Средства под лимитные ордера зарезервированы заранее, поэтому отдельные сделки
+балансы не проверяют: каждая нога сделки списывает средства вместе с резервом.
+
+Исполнение встречных ордеров записывается условным UPDATE: строка меняется, только если
+ордер в базе все еще активен и исполнен ровно на столько, на сколько считает стакан.
+Если стакан процесса разошелся с базой, commit() бросает StaleBook и транзакция откатывается.
+"""
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from django.db import transaction
+from django.db.models import Case, Q, Value, When
+
+from .models import LimitOrder, Transaction
+from .book import ACTIVE_STATUSES, BookOrder
+from .journal import fill_event
+from .stream import hub
+from .rolling import rolling
+from . import candles
+from balance import services as balance_services
+
+# Сколько встречных ордеров обновлять одним UPDATE, чтобы не упереться в лимит параметров SQLite
+ORDER_UPDATE_CHUNK = 200
+
+
+class StaleBook(Exception):
+    """Встречный ордер в базе уже не такой, как в стакане процесса: стакан нужно перечитать"""
+
+    def __init__(self, ticker: str):
+        super().__init__(f"Order book {ticker} is out of date")
+        self.ticker = ticker
+
+
+class Settlement:
+    """Накапливает результаты исполнения одного ордера и записывает их пачкой"""
+
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.trades: List[Transaction] = []
+        self._deltas: Dict[Tuple[object, str], int] = defaultdict(int)
+        self._reserved_deltas: Dict[Tuple[object, str], int] = defaultdict(int)
+        self._filled: Dict[object, BookOrder] = {}
+        # Исполнение встречных ордеров до этой пачки сделок - условие их UPDATE
+        self._filled_before: Dict[object, int] = {}
+        self.events: List[dict] = []
+
+    def _move(self, user_id, ticker: str, amount: int, reserved: int = 0):
+        self._deltas[(user_id, ticker)] += amount
+        if reserved:
+            self._reserved_deltas[(user_id, ticker)] += reserved
+
+    def fill(self, buyer_id, seller_id, amount: int, price: int,
+             buyer_release: int = 0, seller_release: int = 0) -> Transaction:
+        """
+        Проводит сделку по балансам и возвращает (еще не сохраненную) запись о ней.
+        buyer_release/seller_release - сколько резерва снимает сделка с каждой стороны
+        (0 для рыночного ордера, у которого резерва нет)
+        """
+        cost = price * amount
+        self._move(buyer_id, 'RUB', -cost, -buyer_release)
+        self._move(buyer_id, self.ticker, amount)
+        self._move(seller_id, 'RUB', cost)
+        self._move(seller_id, self.ticker, -amount, -seller_release)
+
+        trade = Transaction(
+            ticker=self.ticker,
+            amount=amount,
+            price=price,
+            buyer_id=buyer_id,
+            seller_id=seller_id
+        )
+        self.trades.append(trade)
+        return trade
+
+    def order_filled(self, resting: BookOrder, taker_id, qty: int):
+        """Отмечает исполнение встречного ордера из стакана (вызывается после OrderBook.fill)"""
+        self._filled[resting.id] = resting
+        self._filled_before.setdefault(resting.id, resting.filled - qty)
+        self.events.append(fill_event(self.ticker, resting, taker_id, qty))
+
+    def commit(self):
+        """Записывает все накопленные изменения"""
+        if not self.trades and not self._deltas and not self._reserved_deltas:
+            return
+        # Вызывается внутри транзакции матчинга: при ошибке откатится ее точка сохранения,
+        # своя не нужна
+        with transaction.atomic(savepoint=False):
+            if self._filled:
+                self._update_filled()
+            if self.trades:
+                Transaction.objects.bulk_create(self.trades)
+                candles.record_trades(self.ticker, self.trades)
+            # Изменения применяются относительно текущего значения в базе,
+            # списание не пройдет, если баланс успели уменьшить параллельно
+            balance_services.apply_deltas(self._deltas, self._reserved_deltas)
+            hub.trades_committed(self.ticker, self.trades)
+            rolling.trades_committed(self.ticker, self.trades)
+
+    def _update_filled(self):
+        """Записывает исполнение встречных ордеров; если хоть один изменен в базе мимо стакана - StaleBook"""
+        orders = list(self._filled.values())
+        for start in range(0, len(orders), ORDER_UPDATE_CHUNK):
+            chunk = orders[start:start + ORDER_UPDATE_CHUNK]
+            condition = Q()
+            filled_whens = []
+            status_whens = []
+            for order in chunk:
+                condition |= Q(id=order.id, filled=self._filled_before[order.id])
+                filled_whens.append(When(id=order.id, then=Value(order.filled)))
+                status_whens.append(When(id=order.id, then=Value(order.status)))
+            updated = (
+                LimitOrder.objects
+                .filter(condition, status__in=ACTIVE_STATUSES)
+                .update(filled=Case(*filled_whens), status=Case(*status_whens))
+            )
+            if updated != len(chunk):
+                raise StaleBook(self.ticker)
@@ -0,0 +1,42 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Instrument, LimitOrder, Transaction
+from .book import bump_db_version, loaded_book
+from .journal import cancel_event, journal
+from .stream import hub
+from .rolling import rolling
+from .instruments import instruments
+
+
+@receiver(post_delete, sender=LimitOrder)
+def remove_deleted_order_from_book(sender, instance, **kwargs):
+    """
+    Убирает удаленный ордер из стакана в памяти
+    (например, при каскадном удалении пользователя)
+    """
+    events = [cancel_event(instance.ticker, instance.id)]
+    book = loaded_book(instance.ticker)
+    if book is not None:
+        with book.lock:
+            book.remove(instance.id)
+            journal.log(events, book)
+            hub.book_changed(book)
+    else:
+        # Стакан не загружен: растет только версия в базе, восстановленный из журнала стакан
+        # с ней не сойдется и загрузится из базы
+        bump_db_version(instance.ticker)
+        journal.log(events)
+
+
+@receiver(post_delete, sender=Transaction)
+def reset_rolling_stats(sender, instance, **kwargs):
+    """Удаленные сделки (например, при каскадном удалении пользователя) убираются из статистики"""
+    rolling.invalidate(instance.ticker)
+
+
+@receiver(post_save, sender=Instrument)
+@receiver(post_delete, sender=Instrument)
+def publish_instruments_change(sender, instance, **kwargs):
+    """Справочник инструментов перечитывается во всех воркерах"""
+    instruments.changed()
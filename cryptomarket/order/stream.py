@@ -0,0 +1,181 @@
+"""
+Рассылка рыночных данных подписчикам потока (Server-Sent Events).
+
+На каждый тикер - один канал: после коммита команды матчинга изменения стакана
+и сделки сериализуются один раз и раздаются всем подписчикам тикера.
+Подписчики живут в event loop ASGI-сервера, публикация идет из потока матчинга,
+поэтому сообщения передаются через loop.call_soon_threadsafe.
+
+Сообщения:
+- snapshot - весь агрегированный стакан (при подписке и после перезагрузки стакана);
+- levels - изменившиеся уровни (объем 0 - уровня больше нет);
+- trades - сделки одной команды.
+"""
+import asyncio
+import json
+import threading
+from typing import Dict, List, Optional, Set
+
+from django.db import transaction
+
+from .book import OrderBook
+from .models import Transaction
+
+# Сколько сообщений может ждать отправки одному подписчику
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+
+def sse(event: str, data: dict) -> bytes:
+    """Сообщение в формате text/event-stream"""
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+def snapshot_message(book: OrderBook) -> bytes:
+    """Весь агрегированный стакан; вызывается под блокировкой стакана"""
+    return sse('snapshot', {'ticker': book.ticker, 'seq': book.seq, **book.l2(None)})
+
+
+class Subscriber:
+    """Подписчик потока одного тикера"""
+
+    def __init__(self, ticker: str, loop: asyncio.AbstractEventLoop):
+        self.ticker = ticker
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.closed = False
+
+    def _put(self, message: bytes):
+        # Выполняется в event loop подписчика
+        if self.closed:
+            return
+        if self.queue.qsize() >= SUBSCRIBER_QUEUE_SIZE:
+            # Клиент не успевает читать: отключаем его, после переподключения он получит свежий снимок
+            self.closed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            return
+        self.queue.put_nowait(message)
+
+    def send(self, message: bytes):
+        """Передает сообщение в event loop подписчика (из любого потока)"""
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # Event loop уже закрыт
+            self.closed = True
+
+
+class Channel:
+    def __init__(self):
+        self.subscribers: Set[Subscriber] = set()
+        # Экземпляр стакана, от которого подписчики получили снимок
+        self.epoch: Optional[str] = None
+
+
+class MarketDataHub:
+    """Каналы рыночных данных по тикерам"""
+
+    def __init__(self):
+        self._channels: Dict[str, Channel] = {}
+        self._lock = threading.Lock()
+
+    def has_subscribers(self, ticker: str) -> bool:
+        channel = self._channels.get(ticker)
+        return channel is not None and bool(channel.subscribers)
+
+    def subscribe(self, book: OrderBook, loop: asyncio.AbstractEventLoop) -> Subscriber:
+        """Подписывает на тикер; первым сообщением подписчик получает снимок стакана"""
+        subscriber = Subscriber(book.ticker, loop)
+        with book.lock:
+            with self._lock:
+                channel = self._channels.setdefault(book.ticker, Channel())
+                if channel.epoch != book.epoch:
+                    # Перед этим подписчиков не было или стакан перезагружен:
+                    # остальные тоже получат новый снимок
+                    channel.epoch = book.epoch
+                    self._clear_changes(book)
+                    message = snapshot_message(book)
+                    for other in channel.subscribers:
+                        other.send(message)
+                channel.subscribers.add(subscriber)
+            subscriber.send(snapshot_message(book))
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        subscriber.closed = True
+        with self._lock:
+            channel = self._channels.get(subscriber.ticker)
+            if channel is not None:
+                channel.subscribers.discard(subscriber)
+                if not channel.subscribers:
+                    del self._channels[subscriber.ticker]
+
+    def _broadcast(self, ticker: str, message: bytes):
+        with self._lock:
+            channel = self._channels.get(ticker)
+            subscribers = list(channel.subscribers) if channel is not None else []
+        for subscriber in subscribers:
+            if subscriber.closed:
+                # Соединение уже закрыто, но поток подписчика не успел отписаться
+                self.unsubscribe(subscriber)
+            else:
+                subscriber.send(message)
+
+    @staticmethod
+    def _clear_changes(book: OrderBook):
+        book.bids.changed.clear()
+        book.asks.changed.clear()
+
+    def publish_book(self, book: OrderBook):
+        """Рассылает уровни стакана, изменившиеся с прошлой публикации"""
+        with book.lock:
+            with self._lock:
+                channel = self._channels.get(book.ticker)
+                if channel is None or not channel.subscribers:
+                    self._clear_changes(book)
+                    return
+                if channel.epoch != book.epoch:
+                    # Стакан перезагружен из базы - изменения неизвестны, отправляем его целиком
+                    channel.epoch = book.epoch
+                    self._clear_changes(book)
+                    message = snapshot_message(book)
+                else:
+                    if not book.bids.changed and not book.asks.changed:
+                        return
+                    message = sse('levels', {
+                        'ticker': book.ticker,
+                        'seq': book.seq,
+                        'bid_levels': book.bids.changed_levels(),
+                        'ask_levels': book.asks.changed_levels(),
+                    })
+                    self._clear_changes(book)
+        self._broadcast(book.ticker, message)
+
+    def publish_trades(self, ticker: str, trades: List[Transaction]):
+        if not trades or not self.has_subscribers(ticker):
+            return
+        self._broadcast(ticker, sse('trades', {
+            'ticker': ticker,
+            'trades': [
+                {'price': trade.price, 'qty': trade.amount, 'timestamp': trade.timestamp.isoformat()}
+                for trade in trades
+            ],
+        }))
+
+    def book_changed(self, book: OrderBook):
+        """Публикует изменения стакана после коммита текущей транзакции"""
+        if self.has_subscribers(book.ticker):
+            transaction.on_commit(lambda: self.publish_book(book))
+        else:
+            # Новый подписчик все равно начнет со снимка
+            with book.lock:
+                self._clear_changes(book)
+
+    def trades_committed(self, ticker: str, trades: List[Transaction]):
+        """Публикует сделки после коммита текущей транзакции"""
+        if trades and self.has_subscribers(ticker):
+            transaction.on_commit(lambda: self.publish_trades(ticker, trades))
+
+
+hub = MarketDataHub()
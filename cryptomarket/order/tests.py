@@ -1,3 +1,251 @@
-from django.test import TestCase
+import threading
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+
+from balance import services as balance_services
+from balance.models import Balance
+from cryptomarket.testing import ExchangeTestCase
+from users.models import User
+from . import book
+from .journal import dump_book, matches_database, restore_book
+from .models import LimitOrder, OrderStatus, Transaction
+from .sequencer import CommandTimeout, MatchingSequencer
+
+
+class MatchingTestCase(ExchangeTestCase):
+    """Ордера через API на чистых стаканах и кэшах"""
+
+    def user(self, name: str, rub: int = 0, mem: int = 0) -> User:
+        user = User.objects.create_user(name=name)
+        if rub:
+            balance_services.credit(user.id, 'RUB', rub)
+        if mem:
+            balance_services.credit(user.id, 'MEM', mem)
+        return user
+
+    def place(self, user: User, direction: str, qty: int, price: int = None) -> str:
+        data = {'direction': direction, 'ticker': 'MEM', 'qty': qty}
+        if price is not None:
+            data['price'] = price
+        response = self.client_for(user).post('/api/v1/order', data, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['order_id']
+
+    def cancel(self, user: User, order_id: str):
+        return self.client_for(user).delete(f'/api/v1/order/{order_id}')
+
+    @staticmethod
+    def balance(user: User, ticker: str) -> tuple:
+        return Balance.objects.filter(user=user, ticker=ticker).values_list('amount', 'reserved').get()
+
+    @staticmethod
+    def order(order_id: str) -> LimitOrder:
+        return LimitOrder.objects.get(id=order_id)
+
+
+class PriceTimePriorityTests(MatchingTestCase):
+    def test_best_price_then_earliest_order(self):
+        early = self.user('early', mem=10)
+        late = self.user('late', mem=10)
+        cheap = self.user('cheap', mem=10)
+        buyer = self.user('buyer', rub=10000)
+        early_order = self.place(early, 'SELL', 3, 100)
+        late_order = self.place(late, 'SELL', 3, 100)
+        cheap_order = self.place(cheap, 'SELL', 2, 90)
+
+        self.place(buyer, 'BUY', 4, 100)
+
+        trades = list(Transaction.objects.order_by('price').values_list('seller__name', 'amount', 'price'))
+        self.assertEqual(trades, [('cheap', 2, 90), ('early', 2, 100)])
+        self.assertEqual(self.order(cheap_order).status, OrderStatus.EXECUTED)
+        self.assertEqual((self.order(early_order).status, self.order(early_order).filled),
+                         (OrderStatus.PARTIALLY_EXECUTED, 2))
+        self.assertEqual(self.order(late_order).filled, 0)
+
+    def test_market_order_walks_levels(self):
+        seller = self.user('seller', mem=10)
+        buyer = self.user('buyer', rub=10000)
+        self.place(seller, 'SELL', 2, 100)
+        self.place(seller, 'SELL', 2, 110)
+
+        self.place(buyer, 'BUY', 3)
+
+        self.assertEqual(self.balance(buyer, 'RUB'), (10000 - 2 * 100 - 110, 0))
+        self.assertEqual(self.balance(buyer, 'MEM'), (3, 0))
+
+
+class SelfTradeTests(MatchingTestCase):
+    def test_own_orders_are_skipped(self):
+        trader = self.user('trader', rub=1000, mem=10)
+        other = self.user('other', rub=1000)
+        sell_order = self.place(trader, 'SELL', 5, 100)
+        buy_order = self.place(trader, 'BUY', 5, 100)
+
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(self.order(buy_order).status, OrderStatus.NEW)
+
+        # Собственный ордер остался в стакане и исполняется встречным ордером другого пользователя
+        self.place(other, 'BUY', 5, 100)
+        self.assertEqual(self.order(sell_order).status, OrderStatus.EXECUTED)
+        self.assertEqual(Transaction.objects.get().buyer, other)
+
+    def test_market_order_against_own_orders_only_is_rejected(self):
+        trader = self.user('trader', rub=1000, mem=10)
+        self.place(trader, 'SELL', 5, 100)
+
+        response = self.client_for(trader).post(
+            '/api/v1/order', {'direction': 'BUY', 'ticker': 'MEM', 'qty': 1}, format='json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Transaction.objects.exists())
+
+
+class PartialFillTests(MatchingTestCase):
+    def test_partial_fill_settles_both_sides(self):
+        seller = self.user('seller', mem=10)
+        buyer = self.user('buyer', rub=1000)
+        sell_order = self.place(seller, 'SELL', 10, 50)
+        buy_order = self.place(buyer, 'BUY', 4, 50)
+
+        self.assertEqual(self.order(buy_order).status, OrderStatus.EXECUTED)
+        self.assertEqual((self.order(sell_order).status, self.order(sell_order).filled),
+                         (OrderStatus.PARTIALLY_EXECUTED, 4))
+        self.assertEqual(self.balance(seller, 'MEM'), (6, 6))
+        self.assertEqual(self.balance(seller, 'RUB'), (200, 0))
+        self.assertEqual(self.balance(buyer, 'RUB'), (800, 0))
+        self.assertEqual(self.balance(buyer, 'MEM'), (4, 0))
+
+    def test_remainder_rests_in_book(self):
+        seller = self.user('seller', mem=10)
+        buyer = self.user('buyer', rub=1000)
+        self.place(seller, 'SELL', 3, 50)
+        buy_order = self.place(buyer, 'BUY', 5, 50)
+
+        self.assertEqual((self.order(buy_order).status, self.order(buy_order).filled),
+                         (OrderStatus.PARTIALLY_EXECUTED, 3))
+        self.assertEqual(book.get_book('MEM').l2(None)['bid_levels'], [{'price': 50, 'qty': 2}])
+        self.assertEqual(self.balance(buyer, 'RUB'), (850, 100))
+
+
+class ReservationTests(MatchingTestCase):
+    def test_fill_at_better_price_releases_whole_hold(self):
+        seller = self.user('seller', mem=10)
+        buyer = self.user('buyer', rub=1000)
+        self.place(seller, 'SELL', 4, 90)
+        buy_order = self.place(buyer, 'BUY', 10, 100)
+
+        # Резерв снят за 4 исполненных по цене лимита, списано по цене сделки
+        self.assertEqual(self.balance(buyer, 'RUB'), (1000 - 4 * 90, 6 * 100))
+
+        self.assertEqual(self.cancel(buyer, buy_order).status_code, 200)
+        self.assertEqual(self.balance(buyer, 'RUB'), (640, 0))
+        self.assertEqual(self.order(buy_order).status, OrderStatus.CANCELLED)
+
+    def test_cancel_sell_releases_tokens(self):
+        seller = self.user('seller', mem=10)
+        sell_order = self.place(seller, 'SELL', 7, 100)
+        self.assertEqual(self.balance(seller, 'MEM'), (10, 7))
+
+        self.cancel(seller, sell_order)
+        self.assertEqual(self.balance(seller, 'MEM'), (10, 0))
+        self.assertEqual(book.get_book('MEM').l2(None)['ask_levels'], [])
+
+    def test_failed_release_keeps_order_in_book(self):
+        seller = self.user('seller', mem=10)
+        sell_order = self.place(seller, 'SELL', 7, 100)
+        Balance.objects.filter(user=seller, ticker='MEM').update(reserved=3)
+
+        response = self.cancel(seller, sell_order)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.order(sell_order).status, OrderStatus.NEW)
+        self.assertEqual(book.get_book('MEM').l2(None)['ask_levels'], [{'price': 100, 'qty': 7}])
+
+    def test_reserved_funds_are_not_available(self):
+        trader = self.user('trader', rub=1000)
+        self.place(trader, 'BUY', 8, 100)
+
+        response = self.client_for(trader).post(
+            '/api/v1/order', {'direction': 'BUY', 'ticker': 'MEM', 'qty': 3, 'price': 100}, format='json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Available: 200', response.json()['detail'])
+
+
+class StaleBookTests(MatchingTestCase):
+    def test_order_filled_by_another_process_is_not_filled_again(self):
+        seller = self.user('seller', mem=10)
+        buyer = self.user('buyer', rub=1000)
+        first = self.place(seller, 'SELL', 5, 50)
+        second = self.place(seller, 'SELL', 5, 90)
+        # Другой процесс исполнил первый ордер, стакан этого процесса об этом не знает
+        LimitOrder.objects.filter(id=first).update(filled=5, status=OrderStatus.EXECUTED)
+        Balance.objects.filter(user=seller, ticker='MEM').update(amount=5, reserved=5)
+
+        with self.assertLogs('matching', 'WARNING'):
+            self.place(buyer, 'BUY', 5, 100)
+
+        self.assertEqual(list(Transaction.objects.values_list('price', 'amount')), [(90, 5)])
+        self.assertEqual(self.order(second).status, OrderStatus.EXECUTED)
+        self.assertEqual(self.balance(seller, 'MEM'), (0, 0))
+        self.assertEqual(self.balance(buyer, 'RUB'), (550, 0))
+        # Перечитанный стакан содержал и входящий ордер: исполненный, он не должен остаться в стакане
+        levels = book.get_book('MEM').l2(None)
+        self.assertEqual((levels['bid_levels'], levels['ask_levels']), ([], []))
+
+
+class JournalRecoveryTests(MatchingTestCase):
+    def test_snapshot_behind_database_does_not_match(self):
+        seller = self.user('seller', mem=10)
+        self.place(seller, 'SELL', 3, 100)
+        mem_book = book.get_book('MEM')
+        self.assertTrue(matches_database(mem_book))
+        snapshot = dump_book(mem_book)
+        self.assertTrue(matches_database(restore_book('MEM', snapshot)))
+
+        # Изменение, не попавшее в снимок (хвост журнала потерян)
+        self.place(seller, 'SELL', 3, 110)
+        self.assertFalse(matches_database(restore_book('MEM', snapshot)))
+        self.assertTrue(matches_database(mem_book))
+
+    def test_change_without_loaded_book_does_not_match(self):
+        seller = self.user('seller', mem=10)
+        self.place(seller, 'SELL', 3, 100)
+        snapshot = dump_book(book.get_book('MEM'))
+        book.reset_books()
+
+        seller.delete()
+
+        self.assertFalse(matches_database(restore_book('MEM', snapshot)))
+        self.assertEqual(book.get_book('MEM').l2(None)['ask_levels'], [])
+
+
+@override_settings(MATCHING_SEQUENCER={'ENABLED': True, 'TIMEOUT': 0.1})
+class SequencerTimeoutTests(SimpleTestCase):
+    def setUp(self):
+        self.sequencer = MatchingSequencer()
+        self.release = threading.Event()
+        self.addCleanup(self.sequencer.shutdown)
+        self.addCleanup(self.release.set)
+
+    def test_running_command_reports_started(self):
+        with self.assertRaises(CommandTimeout) as raised:
+            self.sequencer.run('MEM', self.release.wait)
+        self.assertTrue(raised.exception.started)
+
+    def test_queued_command_is_cancelled(self):
+        calls = []
+        self.sequencer.submit('MEM', self.release.wait)
+        with self.assertRaises(CommandTimeout) as raised:
+            self.sequencer.run('MEM', calls.append, 'late')
+        self.assertFalse(raised.exception.started)
+
+        self.release.set()
+        self.sequencer.run('MEM', calls.append, 'next')
+        self.assertEqual(calls, ['next'])
+
+    def test_run_many_cancels_queued_commands(self):
+        self.sequencer.submit('MEM', self.release.wait)
+        futures = self.sequencer.run_many(lambda value: value, {'MEM': (1,), 'AIR': (2,)})
+        self.assertTrue(futures['MEM'].cancelled())
+        self.assertEqual(futures['AIR'].result(), 2)
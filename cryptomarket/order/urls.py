@@ -3,5 +3,7 @@ from . import views
 
 urlpatterns = [
     path('order', views.OrderView.as_view(), name='order-list-create'),
+    path('order/batch', views.OrderBatchView.as_view(), name='order-batch'),
     path('order/<uuid:order_id>', views.OrderDetailView.as_view(), name='order-detail'),
+    path('admin/metrics/matching', views.MatchingMetricsView.as_view(), name='admin-matching-metrics'),
 ] 
\ No newline at end of file
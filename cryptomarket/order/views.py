@@ -4,9 +4,12 @@ from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
 from rest_framework.permissions import IsAuthenticated
 from users.authentication import APITokenAuthentication
+from cryptomarket.permissions import IsAdmin
 from django.db import transaction
-from balance.models import Balance
-from typing import Optional, Tuple
+from balance import services as balance_services
+from balance.services import InsufficientFunds
+from typing import List, Optional, Tuple, Union
+import uuid
 
 from .models import (
     LimitOrder,
@@ -25,9 +28,20 @@ from .serializers import (
     TransactionSerializer,
     OkSerializer,
     L2OrderBookSerializer,
-    InstrumentSerializer
+    InstrumentSerializer,
+    BatchOrderBodySerializer,
+    BatchOrderResultSerializer
 )
-from .matching import OrderMatcher
+from .matching import OrderMatcher, OrderRejected
+from .book import get_book
+from .sequencer import CommandTimeout, sequencer
+from .metrics import metrics, metrics_settings
+from .journal import cancel_event, journal
+from .stream import hub
+from .encoders import encode_limit_orders, encode_market_orders
+
+# Сколько ордеров можно передать в одном пакете
+MAX_BATCH_ORDERS = 100
 
 class OrderView(views.APIView):
     authentication_classes = [APITokenAuthentication]
@@ -38,29 +52,120 @@ class OrderView(views.APIView):
         limit_orders = request.user.limit_orders.all()
         market_orders = request.user.market_orders.all()
         
-        limit_serializer = LimitOrderSerializer(limit_orders, many=True)
-        market_serializer = MarketOrderSerializer(market_orders, many=True)
-        
-        return Response(limit_serializer.data + market_serializer.data)
+        # Ответ того же вида, что у LimitOrderSerializer/MarketOrderSerializer, но без них:
+        # у пользователей с тысячами ордеров сериализаторы - основная часть времени запроса
+        return Response(encode_limit_orders(limit_orders) + encode_market_orders(market_orders))
     
     def _check_initial_balance(self, user, ticker: str, qty: int, price: Optional[int] = None, direction: Direction = None) -> Tuple[bool, str]:
         """
-        Проверяет начальный баланс перед созданием ордера
+        Резервирует средства под лимитный ордер одним атомарным UPDATE
+        (для рыночного ордера только проверяет свободный остаток).
         Возвращает (True, '') если баланс достаточен, (False, error_message) если недостаточен
         """
-        if direction == Direction.BUY and price:
-            # Для покупки проверяем RUB
-            balance = Balance.objects.filter(user=user, ticker='RUB').first()
-            required_amount = price * qty
-            if not balance or balance.amount < required_amount:
-                return False, f"Insufficient RUB balance. Required: {required_amount}, Available: {balance.amount if balance else 0}"
-        elif direction == Direction.SELL:
-            # Для продажи проверяем токены
-            balance = Balance.objects.filter(user=user, ticker=ticker).first()
-            if not balance or balance.amount < qty:
-                return False, f"Insufficient {ticker} balance. Required: {qty}, Available: {balance.amount if balance else 0}"
+        if direction == Direction.BUY:
+            if not price:
+                # Стоимость рыночной покупки известна только после прохода по стакану
+                return True, ''
+            balance_ticker, required_amount = 'RUB', price * qty
+        else:
+            balance_ticker, required_amount = ticker, qty
+
+        try:
+            if price:
+                balance_services.reserve(user.id, balance_ticker, required_amount)
+            elif balance_services.available(user.id, balance_ticker) < required_amount:
+                raise InsufficientFunds(user.id, balance_ticker)
+        except InsufficientFunds:
+            available = balance_services.available(user.id, balance_ticker)
+            return False, f"Insufficient {balance_ticker} balance. Required: {required_amount}, Available: {available}"
         return True, ''
 
+    def _place_order(self, user, data, order_id=None) -> Tuple[Union[LimitOrder, MarketOrder], List[Transaction]]:
+        """
+        Создает и исполняет ордер. Выполняется в потоке матчинга тикера,
+        поэтому все ордера одного тикера обрабатываются строго по очереди.
+        order_id - id нового ордера, если он нужен вызывающему коду заранее
+        """
+        order_id = order_id or uuid.uuid4()
+        with transaction.atomic():
+            ticker = data['ticker']
+            direction = data['direction']
+            qty = data['qty']
+            price = data.get('price')
+            # Стакан загружаем до создания ордера, чтобы восстановленный из журнала
+            # стакан сверялся с базой без нового ордера
+            book = get_book(ticker)
+
+            # Проверяем начальный баланс
+            is_balance_sufficient, error_message = self._check_initial_balance(
+                user, ticker, qty, price, direction
+            )
+            if not is_balance_sufficient:
+                raise OrderRejected(error_message)
+
+            if price is not None:
+                order = LimitOrder.objects.create(
+                    id=order_id,
+                    user=user,
+                    ticker=ticker,
+                    direction=direction,
+                    qty=qty,
+                    price=price
+                )
+                # Пытаемся исполнить лимитный ордер
+                transactions = OrderMatcher.match_limit_order(order)
+            else:
+                # Проверяем существование встречных ордеров для рыночного ордера
+                with book.lock:
+                    if not book.has_liquidity(direction, user.id):
+                        raise OrderRejected("No matching orders available")
+
+                order = MarketOrder.objects.create(
+                    id=order_id,
+                    user=user,
+                    ticker=ticker,
+                    direction=direction,
+                    qty=qty
+                )
+                # Пытаемся исполнить рыночный ордер
+                transactions = OrderMatcher.match_market_order(order)
+
+                if not transactions:
+                    order.status = OrderStatus.CANCELLED
+                    order.save()
+
+            return order, transactions
+
+    @staticmethod
+    def _batch_result(order=None, detail: Optional[str] = None) -> dict:
+        return {
+            'success': detail is None,
+            'order_id': order.id if order is not None else None,
+            'status': order.status if order is not None else None,
+            'filled': order.filled if order is not None else 0,
+            'detail': detail,
+        }
+
+    def _place_batch(self, user, items: List[Tuple[int, dict]]) -> List[Tuple[int, dict]]:
+        """
+        Ордера одного тикера из пакета: одна транзакция на всю группу,
+        отклоненный ордер откатывает только свою точку сохранения (atomic в _place_order).
+        Возвращает [(номер ордера в пакете, результат)]
+        """
+        results = []
+        with transaction.atomic():
+            for index, data in items:
+                try:
+                    order, transactions = self._place_order(user, data)
+                except Exception as e:
+                    results.append((index, self._batch_result(detail=str(e))))
+                    continue
+                if isinstance(order, MarketOrder) and not transactions:
+                    results.append((index, self._batch_result(order, "Could not execute market order")))
+                else:
+                    results.append((index, self._batch_result(order)))
+        return results
+
     def post(self, request):
         """Create a new order"""
         data = request.data
@@ -73,74 +178,93 @@ class OrderView(views.APIView):
             serializer = MarketOrderBodySerializer(data=data)
         
         if serializer.is_valid():
+            # id известен заранее, чтобы вернуть его, даже если ордер не успел исполниться
+            order_id = uuid.uuid4()
             try:
-                with transaction.atomic():
-                    ticker = serializer.validated_data['ticker']
-                    direction = serializer.validated_data['direction']
-                    qty = serializer.validated_data['qty']
-                    price = serializer.validated_data.get('price')
-
-                    # Проверяем начальный баланс
-                    is_balance_sufficient, error_message = self._check_initial_balance(
-                        request.user, ticker, qty, price, direction
+                # Команда встает в очередь тикера, здесь только ждем результат
+                order, transactions = sequencer.run(
+                    serializer.validated_data['ticker'],
+                    self._place_order,
+                    request.user,
+                    serializer.validated_data,
+                    order_id
+                )
+            except CommandTimeout as e:
+                if e.started:
+                    return Response(
+                        {"detail": "Order is still being processed", "order_id": str(order_id)},
+                        status=status.HTTP_202_ACCEPTED
                     )
-                    if not is_balance_sufficient:
-                        return Response({"detail": error_message}, status=status.HTTP_400_BAD_REQUEST)
-
-                    # Проверяем существование встречных ордеров для рыночного ордера
-                    if not price:  # Рыночный ордер
-                        matching_orders = LimitOrder.objects.filter(
-                            ticker=ticker,
-                            direction=Direction.SELL if direction == Direction.BUY else Direction.BUY,
-                            status__in=[OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]
-                        ).exclude(user=request.user)
-
-                        if not matching_orders.exists():
-                            return Response(
-                                {"detail": "No matching orders available"},
-                                status=status.HTTP_400_BAD_REQUEST
-                            )
-
-                    if 'price' in data:
-                        order = LimitOrder.objects.create(
-                            user=request.user,
-                            ticker=ticker,
-                            direction=direction,
-                            qty=qty,
-                            price=price
-                        )
-                        # Пытаемся исполнить лимитный ордер
-                        transactions = OrderMatcher.match_limit_order(order)
-                    else:
-                        order = MarketOrder.objects.create(
-                            user=request.user,
-                            ticker=ticker,
-                            direction=direction,
-                            qty=qty
-                        )
-                        # Пытаемся исполнить рыночный ордер
-                        transactions = OrderMatcher.match_market_order(order)
-
-                    # Проверяем результат исполнения
-                    if isinstance(order, MarketOrder) and not transactions:
-                        order.status = OrderStatus.CANCELLED
-                        order.save()
-                        return Response(
-                            {"detail": "Could not execute market order"},
-                            status=status.HTTP_400_BAD_REQUEST
-                        )
-            
-                    response_serializer = CreateOrderResponseSerializer({
-                        'success': True,
-                        'order_id': order.id
-                    })
-                    return Response(response_serializer.data, status=status.HTTP_200_OK)
+                return Response(
+                    {"detail": "Matching queue timeout, order was not placed"},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE
+                )
             except Exception as e:
                 return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            # Счетчики матчинга подхватит APILoggingMiddleware
+            match_stats = getattr(order, 'match_stats', None)
+            if match_stats is not None and metrics_settings().get('LOG'):
+                request._request.matching_stats = match_stats.as_dict()
+
+            # Проверяем результат исполнения
+            if isinstance(order, MarketOrder) and not transactions:
+                return Response(
+                    {"detail": "Could not execute market order"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            response_serializer = CreateOrderResponseSerializer({
+                'success': True,
+                'order_id': order.id
+            })
+            return Response(response_serializer.data, status=status.HTTP_200_OK)
         
         return Response(serializer.errors, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
 
+class OrderBatchView(views.APIView):
+    authentication_classes = [APITokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        """Create several orders at once"""
+        serializer = BatchOrderBodySerializer(
+            data=request.data, many=True, allow_empty=False, max_length=MAX_BATCH_ORDERS
+        )
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        # Ордера группируются по тикерам, порядок внутри тикера сохраняется
+        groups = {}
+        for index, data in enumerate(serializer.validated_data):
+            groups.setdefault(data['ticker'], []).append((index, data))
+
+        # Группы разных тикеров исполняются параллельно, каждая в очереди своего тикера
+        order_view = OrderView()
+        futures = sequencer.run_many(
+            order_view._place_batch,
+            {ticker: (request.user, items) for ticker, items in groups.items()}
+        )
+
+        results = [None] * len(serializer.validated_data)
+        for ticker, future in futures.items():
+            if future.cancelled():
+                detail = "Matching queue timeout, orders were not placed"
+            elif not future.done():
+                detail = "Orders are still being processed"
+            elif future.exception() is not None:
+                detail = str(future.exception()) or "Order batch failed"
+            else:
+                for index, result in future.result():
+                    results[index] = result
+                continue
+            for index, _ in groups[ticker]:
+                results[index] = OrderView._batch_result(detail=detail)
+
+        return Response(BatchOrderResultSerializer(results, many=True).data)
+
+
 class OrderDetailView(views.APIView):
     authentication_classes = [APITokenAuthentication]
     permission_classes = [IsAuthenticated]
@@ -156,6 +280,38 @@ class OrderDetailView(views.APIView):
             except MarketOrder.DoesNotExist:
                 return None
     
+    @staticmethod
+    def _cancel_limit_order(order: LimitOrder):
+        """
+        Отменяет лимитный ордер в базе и освобождает резерв, затем снимает ордер со стакана.
+        Стакан меняется только после коммита: если резерв снять не удалось (InsufficientFunds),
+        транзакция откатывается, а ордер остается в стакане
+        """
+        book = get_book(order.ticker)
+        with book.lock:
+            with transaction.atomic():
+                # Берем остаток из стакана: он актуальнее, чем прочитанный до постановки в очередь ордер
+                resting = book.orders.get(order.id)
+                if resting is not None:
+                    order.filled = resting.filled
+                else:
+                    # Ордер мог исполниться, пока команда стояла в очереди
+                    order.refresh_from_db(fields=['status', 'filled'])
+                    if order.status not in [OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]:
+                        raise OrderRejected(f"Cannot cancel order in {order.status} status")
+                order.status = OrderStatus.CANCELLED
+                order.save()
+
+                remaining = order.qty - order.filled
+                if order.direction == Direction.BUY:
+                    balance_services.release(order.user_id, 'RUB', remaining * order.price)
+                else:
+                    balance_services.release(order.user_id, order.ticker, remaining)
+                journal.log([cancel_event(order.ticker, order.id)], book)
+
+            book.remove(order.id)
+            hub.book_changed(book)
+
     def get(self, request, order_id):
         """Get order details by ID"""
         order = self.get_order(order_id)
@@ -166,7 +322,7 @@ class OrderDetailView(views.APIView):
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        if order.user != request.user:
+        if order.user_id != request.user.id:
             return Response(
                 {"detail": "Not authorized to view this order"}, 
                 status=status.HTTP_403_FORBIDDEN
@@ -189,7 +345,7 @@ class OrderDetailView(views.APIView):
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        if order.user != request.user:
+        if order.user_id != request.user.id:
             return Response(
                 {"detail": "Not authorized to cancel this order"}, 
                 status=status.HTTP_403_FORBIDDEN
@@ -201,7 +357,43 @@ class OrderDetailView(views.APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        order.status = OrderStatus.CANCELLED
-        order.save()
+        if isinstance(order, LimitOrder):
+            # Отмена меняет стакан, поэтому проходит через очередь тикера
+            try:
+                sequencer.run(order.ticker, self._cancel_limit_order, order)
+            except OrderRejected as e:
+                return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            except InsufficientFunds:
+                # Резерв ордера расходится с балансом - отмена откатилась, ордер остался активным
+                return Response(
+                    {"detail": "Order reservation does not match the balance, order was not cancelled"},
+                    status=status.HTTP_409_CONFLICT
+                )
+            except CommandTimeout as e:
+                if e.started:
+                    return Response(
+                        {"detail": "Cancellation is still being processed", "order_id": str(order.id)},
+                        status=status.HTTP_202_ACCEPTED
+                    )
+                return Response(
+                    {"detail": "Matching queue timeout, order was not cancelled"},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE
+                )
+        else:
+            order.status = OrderStatus.CANCELLED
+            order.save()
         
         return Response(OkSerializer({"success": True}).data)
+
+
+class MatchingMetricsView(views.APIView):
+    """Гистограммы метрик матчинга с момента запуска процесса (или последнего сброса)"""
+    authentication_classes = [APITokenAuthentication]
+    permission_classes = [IsAdmin]
+
+    def get(self, request):
+        return Response(metrics.snapshot())
+
+    def delete(self, request):
+        metrics.reset()
+        return Response(OkSerializer({"success": True}).data)
@@ -1,3 +1,59 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.test import RequestFactory, SimpleTestCase
+from django.utils import timezone
+
+from cryptomarket.middleware import MicroCacheMiddleware
+from cryptomarket.testing import ExchangeTestCase
+from order.models import Transaction
+from users.models import User
+from .views import TransactionExportView
+
+
+class OrderBookLimitTests(ExchangeTestCase):
+    def get(self, limit):
+        return self.client.get('/api/v1/public/orderbook/MEM', {'limit': limit})
+
+    def test_valid_limit(self):
+        self.assertEqual(self.get(25).status_code, 200)
+        self.assertEqual(self.client.get('/api/v1/public/orderbook/MEM').status_code, 200)
+
+    def test_invalid_limit_is_rejected(self):
+        for limit in (0, -1, 26, 'abc'):
+            with self.subTest(limit=limit):
+                response = self.get(limit)
+                self.assertEqual(response.status_code, 422)
+                self.assertIn('limit', response.json())
+
+
+class MicroCacheKeyTests(SimpleTestCase):
+    def key(self, query):
+        return MicroCacheMiddleware._key(RequestFactory().get('/api/v1/public/orderbook/MEM', query), ('limit',))
+
+    def test_only_listed_params_make_the_key(self):
+        self.assertEqual(self.key({'limit': 5, 'nonce': 1}), self.key({'limit': 5, 'nonce': 2}))
+        self.assertEqual(self.key({'nonce': 1}), self.key({}))
+        self.assertNotEqual(self.key({'limit': 5}), self.key({'limit': 6}))
+
+
+class TransactionExportTests(ExchangeTestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user(name='trader')
+        now = timezone.now()
+        # Сделки с одинаковым временем попадают на границы пачек
+        self.trades = Transaction.objects.bulk_create([
+            Transaction(ticker='MEM', amount=1, price=price, timestamp=now + timedelta(seconds=price // 3),
+                        buyer=user, seller=user)
+            for price in range(1, 8)
+        ])
+
+    @mock.patch.object(TransactionExportView, 'EXPORT_CHUNK_SIZE', 2)
+    def test_chunks_cover_all_trades_in_order(self):
+        response = self.client.get('/api/v1/public/transactions/MEM/export')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+        expected = sorted(self.trades, key=lambda trade: (trade.timestamp, str(trade.id)))
+        self.assertEqual([row['id'] for row in rows], [str(trade.id) for trade in expected])
@@ -4,7 +4,12 @@ from . import views
 urlpatterns = [
     path('public/instrument', views.InstrumentListView.as_view(), name='instrument-list'),
     path('public/orderbook/<str:ticker>', views.OrderBookView.as_view(), name='orderbook'),
+    path('public/stream/<str:ticker>', views.MarketDataStreamView.as_view(), name='market-data-stream'),
     path('public/transactions/<str:ticker>', views.TransactionHistoryView.as_view(), name='transaction-history'),
+    path('public/transactions/<str:ticker>/export', views.TransactionExportView.as_view(), name='transaction-export'),
+    path('public/quote/<str:ticker>', views.QuoteView.as_view(), name='quote'),
+    path('public/ticker/<str:ticker>', views.TickerView.as_view(), name='ticker'),
+    path('public/candles/<str:ticker>', views.CandleView.as_view(), name='candles'),
     
     # Административные API для инструментов
     path('admin/instrument', views.AdminInstrumentView.as_view(), name='admin-instrument-create'),
@@ -1,8 +1,18 @@
+import asyncio
+import csv
+import io
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
+from django.views import View
 from rest_framework import status, views
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
 from django.db.models import Q
+from django.utils.http import parse_etags
 from cryptomarket.permissions import IsAdmin
 from users.authentication import APITokenAuthentication
 
@@ -10,16 +20,26 @@ from order.models import (
     Instrument,
     LimitOrder,
     Transaction,
-    Direction,
+    Candle,
     OrderStatus
 )
 from order.serializers import (
     InstrumentSerializer,
     L2OrderBookSerializer,
+    OrderBookQuerySerializer,
     TransactionSerializer,
-    LevelSerializer,
+    TransactionCursorField,
+    TransactionHistoryQuerySerializer,
+    TransactionExportQuerySerializer,
+    CandleSerializer,
+    CandleQuerySerializer,
+    QuoteQuerySerializer,
     OkSerializer
 )
+from order.book import LevelWalk, get_book, invalidate_book, loaded_book
+from order.stream import hub
+from order.rolling import rolling
+from order.instruments import instruments
 
 class InstrumentListView(views.APIView):
     """
@@ -29,8 +49,7 @@ class InstrumentListView(views.APIView):
     
     def get(self, request):
         """Список доступных инструментов"""
-        instruments = Instrument.objects.all()
-        serializer = InstrumentSerializer(instruments, many=True)
+        serializer = InstrumentSerializer(instruments.all(), many=True)
         return Response(serializer.data)
 
 class OrderBookView(views.APIView):
@@ -41,84 +60,266 @@ class OrderBookView(views.APIView):
     
     def get(self, request, ticker):
         """Текущие заявки"""
-        # Проверяем, что инструмент существует
-        instrument = get_object_or_404(Instrument, ticker=ticker)
-        
-        # Получаем лимит записей (максимум 25, по умолчанию 10)
-        limit = min(int(request.query_params.get('limit', 10)), 25)
-        
-        # Получаем активные лимитные ордера
-        active_orders = LimitOrder.objects.filter(
-            ticker=ticker,
-            status__in=[OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]
-        )
-        
-        # Разделяем на bid (покупка) и ask (продажа)
-        bid_orders = active_orders.filter(direction=Direction.BUY).order_by('-price')[:limit]
-        ask_orders = active_orders.filter(direction=Direction.SELL).order_by('price')[:limit]
-        
-        # Агрегируем ордера по ценовым уровням
-        bid_levels = []
-        ask_levels = []
-        
-        # Создаем уровни цен для покупок (bid)
-        bid_price_map = {}
-        for order in bid_orders:
-            if order.price in bid_price_map:
-                bid_price_map[order.price] += order.qty - order.filled
-            else:
-                bid_price_map[order.price] = order.qty - order.filled
-        
-        for price, qty in bid_price_map.items():
-            bid_levels.append({'price': price, 'qty': qty})
+        # Лимит уровней: от 1 до 25, по умолчанию 10
+        serializer = OrderBookQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        limit = serializer.validated_data['limit']
         
-        # Создаем уровни цен для продаж (ask)
-        ask_price_map = {}
-        for order in ask_orders:
-            if order.price in ask_price_map:
-                ask_price_map[order.price] += order.qty - order.filled
-            else:
-                ask_price_map[order.price] = order.qty - order.filled
+        # Уровни берем из стакана в памяти: объемы по ценам в нем поддерживаются
+        # при каждой постановке, сделке и отмене, база не нужна
+        book = loaded_book(ticker)
+        if book is not None:
+            # Стакан не менялся с прошлого запроса клиента - отвечаем 304 без сериализации
+            if book.etag(limit) in parse_etags(request.headers.get('If-None-Match', '')):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers=self._cache_headers(book.etag(limit)))
+        else:
+            # Проверяем, что инструмент существует, и загружаем стакан
+            instruments.get_or_404(ticker)
+            book = get_book(ticker)
         
-        for price, qty in ask_price_map.items():
-            ask_levels.append({'price': price, 'qty': qty})
-        
-        # Сортируем уровни
-        bid_levels.sort(key=lambda x: x['price'], reverse=True)
-        ask_levels.sort(key=lambda x: x['price'])
-        
-        # Ограничиваем количество уровней
-        bid_levels = bid_levels[:limit]
-        ask_levels = ask_levels[:limit]
-        
-        # Формируем ответ
-        orderbook = {
-            'bid_levels': bid_levels,
-            'ask_levels': ask_levels
-        }
+        with book.lock:
+            etag = book.etag(limit)
+            orderbook = book.l2(limit)
         
         serializer = L2OrderBookSerializer(orderbook)
-        return Response(serializer.data)
+        return Response(serializer.data, headers=self._cache_headers(etag))
+
+    @staticmethod
+    def _cache_headers(etag: str) -> dict:
+        # no-cache: кешировать можно, но каждый раз сверяясь по ETag
+        return {'ETag': etag, 'Cache-Control': 'no-cache'}
+
+class MarketDataStreamView(View):
+    """
+    Поток рыночных данных тикера (Server-Sent Events): сначала снимок стакана,
+    дальше изменения уровней и сделки. Работает только под ASGI (cryptomarket.asgi,
+    так сервер запускается в docker-entrypoint.sh), синхронный воркер держал бы поток на каждое соединение
+    """
+    # Комментарий раз в столько секунд, чтобы прокси не закрывали молчащее соединение
+    KEEPALIVE = 15
+
+    async def get(self, request, ticker):
+        if not isinstance(request, ASGIRequest):
+            return JsonResponse(
+                {"detail": "Streaming is only available when served by the ASGI application"},
+                status=status.HTTP_501_NOT_IMPLEMENTED
+            )
+        if not await sync_to_async(instruments.exists)(ticker):
+            return JsonResponse({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        book = await sync_to_async(get_book)(ticker)
+        subscriber = await sync_to_async(hub.subscribe)(book, asyncio.get_running_loop())
+
+        async def events():
+            try:
+                while True:
+                    try:
+                        message = await asyncio.wait_for(subscriber.queue.get(), timeout=self.KEEPALIVE)
+                    except asyncio.TimeoutError:
+                        yield b': keepalive\n\n'
+                        continue
+                    if message is None:
+                        # Отключен как медленный подписчик
+                        return
+                    yield message
+            finally:
+                hub.unsubscribe(subscriber)
+
+        response = StreamingHttpResponse(events(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # nginx не должен буферизовать поток
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 class TransactionHistoryView(views.APIView):
     """
-    API для получения истории сделок
+    API для получения истории сделок.
+    Страницы идут от новых сделок к старым; курсор следующей страницы отдается
+    в заголовке X-Next-Cursor, и страница читается по индексу (ticker, timestamp, id)
+    без OFFSET, поэтому глубина листания не влияет на скорость.
+    Первая страница отдается из последних сделок в памяти (order.rolling)
     """
     permission_classes = [AllowAny]
+    MAX_LIMIT = 100
     
     def get(self, request, ticker):
         """История сделок"""
-        # Проверяем, что инструмент существует
-        instrument = get_object_or_404(Instrument, ticker=ticker)
-        
+        serializer = TransactionHistoryQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        params = serializer.validated_data
+
         # Получаем лимит записей (максимум 100, по умолчанию 10)
-        limit = min(int(request.query_params.get('limit', 10)), 100)
-        
-        # Получаем транзакции для данного тикера
-        transactions = Transaction.objects.filter(ticker=ticker).order_by('-timestamp')[:limit]
+        limit = min(params['limit'], self.MAX_LIMIT)
+
+        stats = rolling.loaded(ticker)
+        if stats is None:
+            # Проверяем, что инструмент существует
+            instruments.get_or_404(ticker)
+            stats = rolling.get(ticker)
+
+        # Первая страница - из последних сделок в памяти
+        transactions = stats.latest(limit) if 'cursor' not in params else None
+        if transactions is None:
+            # Получаем транзакции для данного тикера, начиная после курсора
+            transactions = Transaction.objects.filter(ticker=ticker)
+            if 'cursor' in params:
+                timestamp, trade_id = params['cursor']
+                transactions = transactions.filter(
+                    Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=trade_id)
+                )
+            # Лишняя запись показывает, есть ли следующая страница
+            transactions = list(transactions.order_by('-timestamp', '-id')[:limit + 1])
         
-        serializer = TransactionSerializer(transactions, many=True)
-        return Response(serializer.data)
+        response = Response(TransactionSerializer(transactions[:limit], many=True).data)
+        if len(transactions) > limit:
+            response['X-Next-Cursor'] = TransactionCursorField.encode(transactions[limit - 1])
+        return response
+
+class TickerView(views.APIView):
+    """
+    API для получения статистики тикера за 24 часа: последняя цена, open/high/low,
+    объем, VWAP и число сделок. Считается в памяти по минутным корзинам (order.rolling)
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request, ticker):
+        """Статистика тикера за 24 часа"""
+        stats = rolling.loaded(ticker)
+        if stats is None:
+            instruments.get_or_404(ticker)
+            stats = rolling.get(ticker)
+        return Response(stats.summary())
+
+class QuoteView(views.APIView):
+    """
+    API для оценки рыночной заявки до ее отправки: сколько исполнится, за сколько
+    и по какой средней цене. Проход по уровням стакана в памяти без блокировок и записи
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request, ticker):
+        """Оценка стоимости рыночной заявки"""
+        serializer = QuoteQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        params = serializer.validated_data
+
+        instruments.get_or_404(ticker)
+        book = loaded_book(ticker) or get_book(ticker)
+
+        walk = LevelWalk(book, params['side'], params['qty'], params.get('price'))
+        return Response({
+            'ticker': ticker,
+            'side': params['side'],
+            'qty': params['qty'],
+            'fillable_qty': walk.filled_qty,
+            'fully_fillable': walk.fillable,
+            'cost': walk.cost,
+            'average_price': walk.average_price,
+            'worst_price': walk.worst_price,
+            'levels': walk.levels,
+        })
+
+class TransactionExportView(View):
+    """
+    Потоковая выгрузка всех сделок тикера (NDJSON или CSV) от старых к новым.
+    Сделки читаются из базы пачками по EXPORT_CHUNK_SIZE и сразу отдаются клиенту,
+    поэтому память не зависит от числа сделок. Каждая пачка - отдельный короткий запрос
+    после последней отданной сделки по (timestamp, id): открытый на всю выгрузку курсор
+    держал бы чтение SQLite и не давал коммитить сделки, пока клиент читает ответ.
+    Обычный View, а не APIView: параметр format в DRF занят выбором рендерера
+    """
+    EXPORT_CHUNK_SIZE = 2000
+    FIELDS = ['id', 'timestamp', 'price', 'amount']
+
+    def get(self, request, ticker):
+        serializer = TransactionExportQuerySerializer(data=request.GET)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        params = serializer.validated_data
+
+        if not instruments.exists(ticker):
+            return JsonResponse({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        transactions = Transaction.objects.filter(ticker=ticker)
+        if 'start' in params:
+            transactions = transactions.filter(timestamp__gte=params['start'])
+        if 'end' in params:
+            transactions = transactions.filter(timestamp__lt=params['end'])
+        rows = transactions.order_by('timestamp', 'id').values_list(*self.FIELDS)
+
+        if params['format'] == 'csv':
+            content, content_type = self._csv(rows), 'text/csv'
+        else:
+            content, content_type = self._ndjson(rows), 'application/x-ndjson'
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{ticker}-transactions.{params["format"]}"'
+        return response
+
+    def _chunks(self, rows):
+        """Строки пачками по EXPORT_CHUNK_SIZE - один запрос и один кусок ответа на пачку"""
+        after = Q()
+        while True:
+            chunk = list(rows.filter(after)[:self.EXPORT_CHUNK_SIZE])
+            if chunk:
+                yield chunk
+            if len(chunk) < self.EXPORT_CHUNK_SIZE:
+                return
+            trade_id, timestamp = chunk[-1][:2]
+            after = Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=trade_id)
+
+    def _ndjson(self, rows):
+        for chunk in self._chunks(rows):
+            yield ''.join(
+                json.dumps({
+                    'id': str(trade_id), 'timestamp': timestamp.isoformat(), 'price': price, 'amount': amount
+                }, separators=(',', ':')) + '\n'
+                for trade_id, timestamp, price, amount in chunk
+            )
+
+    def _csv(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.FIELDS)
+        for chunk in self._chunks(rows):
+            writer.writerows(
+                (trade_id, timestamp.isoformat(), price, amount)
+                for trade_id, timestamp, price, amount in chunk
+            )
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # Заголовок без сделок
+        if buffer.tell():
+            yield buffer.getvalue()
+
+class CandleView(views.APIView):
+    """
+    API для получения свечей (OHLCV). Свечи обновляются вместе со сделками,
+    поэтому запрос читает готовые свечи, а не историю сделок
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request, ticker):
+        """Последние limit свечей интервала в диапазоне [start, end), по возрастанию времени"""
+        serializer = CandleQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        params = serializer.validated_data
+
+        instruments.get_or_404(ticker)
+
+        candles = Candle.objects.filter(ticker=ticker, interval=params['interval'])
+        if 'start' in params:
+            candles = candles.filter(start__gte=params['start'])
+        if 'end' in params:
+            candles = candles.filter(start__lt=params['end'])
+        candles = list(candles.order_by('-start')[:params['limit']])
+        candles.reverse()
+
+        return Response(CandleSerializer(candles, many=True).data)
 
 class AdminInstrumentView(views.APIView):
     """
@@ -172,5 +373,8 @@ class AdminInstrumentDetailView(views.APIView):
         
         # Удаляем инструмент
         instrument.delete()
+        # Стакан удаленного инструмента больше не отдается
+        invalidate_book(ticker)
+        rolling.invalidate(ticker)
         
         return Response(OkSerializer({"success": True}).data)
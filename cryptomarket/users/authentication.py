@@ -1,8 +1,109 @@
+"""
+Аутентификация по API-ключу.
+
+Ключ -> пользователь кэшируется в памяти процесса (LRU + TTL), поэтому на горячем пути
+аутентификация не ходит в базу. Пользователь собирается из сохраненных значений полей
+(User.from_db) заново для каждого запроса. Изменение или удаление пользователя
+(сигналы users.signals) сбрасывает его ключ в этом процессе, а после коммита записывает
+новую версию в общий кэш - остальные воркеры сверяют версию не чаще раза
+в API_KEY_CACHE['CHECK_INTERVAL'] секунд и при расхождении очищают свой кэш.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
 from .models import User
 from django.shortcuts import get_object_or_404
 
+VERSION_KEY = 'users:api_keys:version'
+# Поля, из которых собирается пользователь запроса; остальные дочитываются при обращении.
+# Порядок - как в модели: User.from_db ждет значения в порядке ее полей
+PRINCIPAL_FIELDS = tuple(
+    field.attname for field in User._meta.concrete_fields
+    if field.attname in {'id', 'name', 'role', 'api_key', 'is_active', 'is_staff', 'is_superuser'}
+)
+
+
+def api_key_cache_settings() -> dict:
+    return getattr(settings, 'API_KEY_CACHE', {})
+
+
+class APIKeyCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # api_key -> (время устаревания, значения PRINCIPAL_FIELDS)
+        self._entries: OrderedDict = OrderedDict()
+        self._version: Optional[str] = None
+        self._checked_at = 0.0
+        # Растет при каждом сбросе: пользователь, прочитанный из базы до сброса, в кэш не попадет
+        self.generation = 0
+
+    def _check_version(self, options: dict):
+        now = time.monotonic()
+        if now - self._checked_at < options.get('CHECK_INTERVAL', 0):
+            return
+        version = cache.get(VERSION_KEY)
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self.generation += 1
+                self._version = version
+            self._checked_at = now
+
+    def get(self, api_key: str) -> Optional[User]:
+        options = api_key_cache_settings()
+        self._check_version(options)
+        with self._lock:
+            entry = self._entries.get(api_key)
+            if entry is None:
+                return None
+            expires, values = entry
+            if expires <= time.monotonic():
+                del self._entries[api_key]
+                return None
+            self._entries.move_to_end(api_key)
+        return User.from_db('default', PRINCIPAL_FIELDS, values)
+
+    def set(self, api_key: str, user: User, generation: int):
+        """Кэширует пользователя, прочитанного из базы при данном поколении кэша"""
+        options = api_key_cache_settings()
+        values = tuple(getattr(user, field) for field in PRINCIPAL_FIELDS)
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[api_key] = (time.monotonic() + options.get('TTL', 60), values)
+            self._entries.move_to_end(api_key)
+            while len(self._entries) > options.get('MAX_ENTRIES', 10000):
+                self._entries.popitem(last=False)
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def user_changed(self, user: User):
+        """Пользователь изменен или удален: сбрасывает его ключ здесь и, после коммита, во всех воркерах"""
+        with self._lock:
+            self._entries.pop(str(user.api_key), None)
+            self.generation += 1
+
+        def publish():
+            self.reset()
+            cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+        transaction.on_commit(publish)
+
+
+api_key_cache = APIKeyCache()
+
+
 class APITokenAuthentication(BaseAuthentication):
     def authenticate(self, request):
         auth_header = request.headers.get("Authorization")
@@ -12,7 +113,11 @@ class APITokenAuthentication(BaseAuthentication):
             token_type, api_key = auth_header.split()
             if token_type != "TOKEN":
                 raise AuthenticationFailed("Invalid token type. Expected 'TOKEN'")
-            user = get_object_or_404(User, api_key=api_key, is_active=True)
+            user = api_key_cache.get(api_key)
+            if user is None:
+                generation = api_key_cache.generation
+                user = get_object_or_404(User.objects.only(*PRINCIPAL_FIELDS), api_key=api_key, is_active=True)
+                api_key_cache.set(api_key, user, generation)
             return (user, None)
         except (ValueError, User.DoesNotExist):
-            raise AuthenticationFailed("Invalid or missing API key")
\ No newline at end of file
+            raise AuthenticationFailed("Invalid or missing API key")
@@ -1,10 +1,12 @@
-from django.db.models.signals import post_migrate, post_save
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete
 from django.dispatch import receiver
 from django.db import transaction
 import uuid
 from users.models import User
 from order.models import Instrument
-from balance.models import Balance
+from balance.models import Balance, LedgerKind
+from balance import ledger
+from users.authentication import api_key_cache
 
 @receiver(post_migrate)
 def create_initial_data(sender, **kwargs):
@@ -54,6 +56,7 @@ def create_initial_data(sender, **kwargs):
         )
         
         if created:
+            ledger.record(LedgerKind.OPENING, [(admin.id, 'RUB', balance.amount, 0)])
             print('Created initial admin balance')
 
 @receiver(post_save, sender=User)
@@ -67,4 +70,28 @@ def create_user_balance(sender, instance, created, **kwargs):
             ticker='RUB',
             defaults={'amount': 0}  # Начальный баланс 0 RUB
         ) 
-        print('Created initial user balance')
\ No newline at end of file
+        print('Created initial user balance')
+
+
+@receiver(pre_delete, sender=User)
+def close_user_balances(sender, instance, **kwargs):
+    """
+    Балансы удаляемого пользователя списываются в журнал движениями CLOSING
+    (в транзакции удаления, до каскадного удаления балансов): журнал пользователя остается,
+    и суммы по тикерам по-прежнему сходятся с балансами
+    """
+    balances = Balance.objects.filter(user=instance).values_list('ticker', 'amount', 'reserved')
+    ledger.record(LedgerKind.CLOSING, [
+        (instance.id, ticker, -amount, -reserved) for ticker, amount, reserved in balances
+    ])
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def reset_cached_api_key(sender, instance, created=False, **kwargs):
+    """
+    Изменение (is_active, роль, ключ) или удаление пользователя сбрасывает его API-ключ
+    в кэше аутентификации. Ключ нового пользователя еще не мог попасть в кэш
+    """
+    if not created:
+        api_key_cache.user_changed(instance)
@@ -12,9 +12,16 @@ echo "SUKA PYTHON"
 echo $DEBUG
 if [ "$DEBUG" == 1 ]; then
     echo "Запуск сервера в режиме разработки"
+    # runserver отдает WSGI: потоковая выдача рыночных данных отвечает 501
     exec poetry run python cryptomarket/manage.py runserver 0.0.0.0:8000
 else
     echo "Запуск сервера в режиме продакшена"
     cd cryptomarket/
-    exec poetry run gunicorn --bind 0.0.0.0:8000 cryptomarket.wsgi:application
+    # Стаканы, очереди матчинга и подписчики потока рыночных данных живут в памяти процесса,
+    # поэтому воркер ровно один (см. MATCHING_SEQUENCER в settings.py). Приложение ASGI:
+    # потоковая выдача (/api/v1/public/stream/<ticker>) работает только под ним, синхронные
+    # представления выполняются в пуле из ASGI_THREADS потоков
+    export MATCHING_JOURNAL=1
+    export ASGI_THREADS="${ASGI_THREADS:-8}"
+    exec poetry run uvicorn cryptomarket.asgi:application --workers 1 --host 0.0.0.0 --port 8000
 fi
\ No newline at end of file